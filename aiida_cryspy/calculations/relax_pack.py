@@ -0,0 +1,139 @@
+"""
+複数の構造を1つのジョブで緩和する CalcJob。
+
+1構造ごとに aiida-ase の CalcJob を投げると、ジョブ投入・Pythonの起動・MLポテンシャルの読み込みが
+構造の数だけ発生する。RelaxPackCalculation は K 個の構造を1つのジョブに詰め、
+1度だけ読み込んだ calculator で順番に緩和する (aiida_cryspy/engines/ase_relax.py を計算ノードで実行)。
+
+array_job=True の場合は K 個の構造を1つのアレイジョブとして投入し、
+各タスクが共通の入力ファイルから1構造ずつ緩和する。結果は results/ にまとめて回収される。
+
+engine='pool' / 'batched' の場合は ase_relax.py の代わりに engines/local_job.py を
+(`python -m aiida_cryspy.engines.local_job`) 実行し、プロセスプールまたはバッチ化した FIRE で緩和する
+(aiida_cryspy がインストールされたマシンで使う。optimization_WorkChain の executor='local' / 'batched')。
+"""
+import io
+import json
+import os
+
+from aiida.common import datastructures
+from aiida.engine import CalcJob
+from aiida.orm import Bool, Dict, Int, Str
+from aiida.plugins import DataFactory
+
+from aiida_cryspy.engines import ase_relax, local_job
+from aiida_cryspy.schedulers.sge_array import task_output_path
+
+StructureData = DataFactory("core.structure")
+CompressedTrajectoryData = DataFactory("aiida_cryspy.trajectory")
+
+# スケジューラごとのアレイジョブの指定 ({n}: タスク数)
+# core.sge などはアレイジョブのジョブIDとタスクの状態を扱えないため、対応したスケジューラだけを使う
+ARRAY_DIRECTIVES = {
+    "aiida_cryspy.sge_array": "#$ -t 1-{n}",
+    "aiida_cryspy.local_array": "#$ -t 1-{n}",
+}
+
+
+def get_array_directive(computer, n_tasks: int) -> str:
+    """
+    n_tasks 個のタスクのアレイジョブの指定。
+    metadata.options.custom_scheduler_commands に追加して使う。
+    """
+    try:
+        return ARRAY_DIRECTIVES[computer.scheduler_type].format(n=n_tasks)
+    except KeyError:
+        raise ValueError(
+            f"array_job is not supported for the scheduler `{computer.scheduler_type}` (supported: {', '.join(ARRAY_DIRECTIVES)})."
+        )
+
+
+def validate_inputs(inputs, _):
+    engine = inputs["engine"].value if "engine" in inputs else "serial"
+    if engine not in ("serial",) + local_job.ENGINES:
+        return f"unknown engine `{engine}` (use 'serial', {', '.join(repr(name) for name in local_job.ENGINES)})."
+    if "array_job" in inputs and inputs["array_job"].value:
+        if engine != "serial":
+            return "array_job requires engine='serial'."
+        try:
+            directive = get_array_directive(inputs["code"].computer, len(inputs["structures"]))
+        except ValueError as exception:
+            return str(exception)
+        custom_commands = inputs.get("metadata", {}).get("options", {}).get("custom_scheduler_commands", "")
+        if directive not in custom_commands.splitlines():
+            return f"array_job requires `{directive}` in metadata.options.custom_scheduler_commands."
+
+
+class RelaxPackCalculation(CalcJob):
+    """
+    structures の各構造を parameters (optimization_WorkChain と同じ形式) で緩和する。
+    structures のキー (cryspy_id) が出力 structures / results のキーになる。
+    """
+
+    _SCRIPT_NAME = "ase_relax.py"
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input_namespace("structures", valid_type=StructureData, dynamic=True, help="structures to relax, keyed by cryspy_id")
+        spec.input("parameters", valid_type=Dict, help="calculator / optimizer parameters")
+        spec.input("array_job", valid_type=Bool, default=lambda: Bool(False), help="submit as an array job (one task per structure)")
+        spec.input("engine", valid_type=Str, default=lambda: Str("serial"), help="'serial' (ase_relax.py), 'pool' (local process pool) or 'batched' (batched FIRE); see engines/local_job.py")
+        spec.input("max_workers", valid_type=Int, default=lambda: Int(0), help="number of worker processes of engine='pool' (0: number of CPUs)")
+        spec.input("trajectory", valid_type=Dict, required=False, help="trajectory retention {'policy': 'none' | 'last' | 'every' | 'full', 'interval': n}")
+        spec.inputs.validator = validate_inputs
+
+        spec.inputs["metadata"]["options"]["parser_name"].default = "aiida_cryspy.relax_pack"
+        spec.inputs["metadata"]["options"]["resources"].default = {"num_machines": 1}
+        spec.inputs["metadata"]["options"]["withmpi"].default = False
+        spec.inputs["metadata"]["options"]["output_filename"].default = "aiida.out"
+
+        spec.output_namespace("structures", valid_type=StructureData, dynamic=True, help="relaxed structures")
+        spec.output_namespace("results", valid_type=Dict, dynamic=True, help="total_energy, converged, nsteps of each structure")
+        spec.output("failures", valid_type=Dict, required=False, help="error message of each failed structure")
+        spec.output_namespace("trajectories", valid_type=CompressedTrajectoryData, dynamic=True, required=False, help="retained frames of each relaxation")
+
+        spec.exit_code(310, "ERROR_NO_RESULTS", message="The results folder was not retrieved.")
+        spec.exit_code(311, "ERROR_ALL_STRUCTURES_FAILED", message="The relaxation failed for all structures.")
+
+    def prepare_for_submission(self, folder):
+        structures = {
+            key: ase_relax.atoms_to_dict(node.get_ase()) for key, node in self.inputs.structures.items()
+        }
+        data = {"parameters": self.inputs.parameters.get_dict(), "structures": structures}
+        if "trajectory" in self.inputs:
+            data["trajectory"] = self.inputs.trajectory.get_dict()
+        engine = self.inputs.engine.value
+        if engine == "pool":
+            data["max_workers"] = self.inputs.max_workers.value
+        folder.create_file_from_filelike(io.StringIO(json.dumps(data)), ase_relax.INPUT_FILENAME, mode="w")
+
+        codeinfo = datastructures.CodeInfo()
+        codeinfo.code_uuid = self.inputs.code.uuid
+        if engine != "serial":
+            # aiida_cryspy のスクリプトを実行する (コピーしない)
+            codeinfo.cmdline_params = ["-m", local_job.__name__, engine]
+            codeinfo.stdout_name = self.options.output_filename
+        elif self.inputs.array_job.value:
+            # 各タスクの標準出力はスケジューラの出力ファイルに任せる
+            codeinfo.cmdline_params = [self._SCRIPT_NAME, ase_relax.ARRAY_FLAG]
+        else:
+            codeinfo.cmdline_params = [self._SCRIPT_NAME]
+            codeinfo.stdout_name = self.options.output_filename
+        if engine == "serial":
+            # 緩和スクリプトをそのまま計算ノードへコピーする
+            with open(os.path.abspath(ase_relax.__file__)) as handle:
+                folder.create_file_from_filelike(handle, self._SCRIPT_NAME, mode="w")
+
+        calcinfo = datastructures.CalcInfo()
+        calcinfo.codes_info = [codeinfo]
+        # 軌跡の .npz は一時的に回収し、パーサーが CompressedTrajectoryData にする (リポジトリには残さない)
+        calcinfo.retrieve_list = [(f"{ase_relax.RESULTS_DIRNAME}/*.json", ".", 2), self.options.output_filename]
+        if self.inputs.array_job.value:
+            # 各タスクの標準出力・標準エラー (_scheduler-stdout.<タスクID>.txt など)
+            calcinfo.retrieve_list += [
+                task_output_path(self.options.scheduler_stdout, "*"),
+                task_output_path(self.options.scheduler_stderr, "*"),
+            ]
+        calcinfo.retrieve_temporary_list = [(f"{ase_relax.RESULTS_DIRNAME}/*{ase_relax.TRAJECTORY_SUFFIX}", ".", 2)]
+        return calcinfo
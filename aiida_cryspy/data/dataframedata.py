@@ -1,13 +1,36 @@
+import io
+
+import numpy as np
 import pandas as pd
 from aiida.orm import Dict
 
+from aiida_cryspy.data.decoded_cache import DECODED_CACHE, dataframe_nbytes
+
 
 class DataframeData(Dict):
+    """pd.DataFrame
+
+    storage='columnar' (default):
+        each column (and the index) is saved as a .npy file in the node repository,
+        and only the column names / dtypes are kept in the attributes.
+    storage='dict':
+        legacy format, {column: list, '@INDEX': list} in the attributes.
+    """
 
     INDEX = "@INDEX"
+    STORAGE = "@STORAGE"
+    COLUMNS = "@COLUMNS"
+    INDEX_INFO = "@INDEX_INFO"
+    NROWS = "@NROWS"
 
-    def __init__(self, df: pd.DataFrame = None, **kwargs):
+    STORAGE_COLUMNAR = "columnar"
+    STORAGE_DICT = "dict"
+
+    def __init__(self, df: pd.DataFrame = None, storage: str = STORAGE_COLUMNAR, **kwargs):
         super().__init__(**kwargs)
+        if storage not in (self.STORAGE_COLUMNAR, self.STORAGE_DICT):
+            raise ValueError(f'unknown storage: {storage}')
+        self._storage = storage
         if df is not None:
             self._internal_validate(df)
             self.set_df(df)
@@ -16,9 +39,23 @@ class DataframeData(Dict):
         if not isinstance(df, pd.DataFrame):
             raise TypeError('df must be pd.DataFrame')
 
+    @property
+    def is_columnar(self) -> bool:
+        return self.base.attributes.get(self.STORAGE, None) == self.STORAGE_COLUMNAR
+
+    @property
+    def columns(self) -> list:
+        """column names, without reading the data"""
+        if self.is_columnar:
+            return [col["name"] for col in self.base.attributes.get(self.COLUMNS)]
+        return [key for key in self.get_dict() if key != self.INDEX]
+
     def set_df(self, df: pd.DataFrame) -> None:
         if df is not None:
             self._internal_validate(df)
+        if getattr(self, "_storage", self.STORAGE_COLUMNAR) == self.STORAGE_COLUMNAR:
+            self._set_df_columnar(df)
+            return None
         dic = {}
         for key in df.columns:
             dic[key] = df[key].values.tolist()
@@ -26,14 +63,92 @@ class DataframeData(Dict):
         self.set_dict(dic)
         return Dict(dict=dic)
 
-    def get_df(self) -> pd.DataFrame:
+    def _set_df_columnar(self, df: pd.DataFrame) -> None:
+        self.base.attributes.clear()
+        for name in self.base.repository.list_object_names():
+            self.base.repository.delete_object(name)
+
+        columns = []
+        for i, key in enumerate(df.columns):
+            filename = f"column_{i}.npy"
+            self._put_array(filename, df[key])
+            columns.append({"name": key, "dtype": str(df[key].dtype), "file": filename})
+
+        self._put_array("index.npy", df.index)
+        index_info = {"name": df.index.name, "dtype": str(df.index.dtype), "file": "index.npy"}
+
+        self.base.attributes.set(self.STORAGE, self.STORAGE_COLUMNAR)
+        self.base.attributes.set(self.COLUMNS, columns)
+        self.base.attributes.set(self.INDEX_INFO, index_info)
+        self.base.attributes.set(self.NROWS, len(df))
+
+    def _put_array(self, filename, values) -> None:
+        array = values.to_numpy()
+        handle = io.BytesIO()
+        # object列 (Spg_sym, Opt など) はpickleで保存する
+        np.save(handle, array, allow_pickle=array.dtype.hasobject)
+        self.base.repository.put_object_from_bytes(handle.getvalue(), filename)
+
+    def _get_array(self, filename, dtype: str):
+        with self.base.repository.open(filename, mode="rb") as handle:
+            array = np.load(io.BytesIO(handle.read()), allow_pickle=True)
+        if str(array.dtype) != dtype:
+            # category, Int64 などpandas独自のdtypeを復元
+            try:
+                return pd.Series(array).astype(dtype).array
+            except (TypeError, ValueError):
+                pass
+        return array
+
+    def get_df(self, columns: list = None) -> pd.DataFrame:
+        """
+        Args:
+            columns (list): read only these columns (default: all columns)
+
+        The whole DataFrame of a stored node is cached in this process
+        (see aiida_cryspy.data.decoded_cache); a copy is returned.
+        """
+        if columns is None:
+            return DECODED_CACHE.get(self, 'df', self._decode_df)
+        return self._read_df(columns)
+
+    def _decode_df(self):
+        df = self._read_df()
+        return df, dataframe_nbytes(df)
+
+    def _read_df(self, columns: list = None) -> pd.DataFrame:
+        if self.is_columnar:
+            return self._get_df_columnar(columns)
         d = self.get_dict()
         index = None
         if self.INDEX in d:
             index = d.pop(self.INDEX)
         df = pd.DataFrame(d, index=index)
+        if columns is not None:
+            df = df[list(columns)]
         return df
 
+    def _get_df_columnar(self, columns: list = None) -> pd.DataFrame:
+        column_infos = self.base.attributes.get(self.COLUMNS)
+        if columns is not None:
+            info_map = {col["name"]: col for col in column_infos}
+            missing = [name for name in columns if name not in info_map]
+            if missing:
+                raise KeyError(f"columns not found: {missing}")
+            column_infos = [info_map[name] for name in columns]
+
+        index_info = self.base.attributes.get(self.INDEX_INFO)
+        index = pd.Index(self._get_array(index_info["file"], index_info["dtype"]), name=index_info["name"])
+        data = {col["name"]: self._get_array(col["file"], col["dtype"]) for col in column_infos}
+        return pd.DataFrame(data, index=index, columns=[col["name"] for col in column_infos])
+
+    def to_columnar(self) -> "DataframeData":
+        """
+        Migration of legacy (storage='dict') nodes.
+        Returns a new unstored columnar DataframeData with the same content.
+        """
+        return DataframeData(self.get_df(), storage=self.STORAGE_COLUMNAR)
+
     @property
     def df(self) -> pd.DataFrame:
         return self.get_df()
@@ -0,0 +1,129 @@
+"""Per-process LRU cache of decoded payloads of stored data nodes
+
+Stored nodes are immutable, so the object decoded from the repository (or the
+attributes) of a RinData, EAData or DataframeData node can be reused by every later
+access in the same process (e.g. a daemon worker) instead of being read and
+unpickled again.
+
+Entries are keyed by node UUID and payload name and bounded by their approximate
+size in memory (least recently used entries are evicted first). Every access returns
+a defensive copy, so callers may modify the returned object freely:
+DataFrames (including the ea_info and ea_origin fields of EAData) are cached decoded
+and copied with DataFrame.copy(deep=True); other pickled payloads (rin, elite_struc,
+elite_fitness) are cached as their pickle bytes and unpickled on every access, which
+is faster than copy.deepcopy of the decoded object (see copy_payload).
+Unstored nodes are never cached.
+
+The size limit is read from the environment variable SIZE_VARIABLE [MiB]
+(default DEFAULT_SIZE_MB, 0 disables the cache).
+"""
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+SIZE_VARIABLE = 'AIIDA_CRYSPY_DECODED_CACHE_MB'
+DEFAULT_SIZE_MB = 256
+
+
+def copy_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    return df.copy(deep=True)
+
+
+def copy_payload(value):
+    """
+    copy of a cached pickled payload: pickle bytes are unpickled, a decoded DataFrame is copied.
+    Per access, pickle.loads is about 4x faster than copy.deepcopy for rin and elite_struc,
+    while DataFrame.copy(deep=True) is about 4x faster than pickle.loads for ea_origin.
+    """
+    if isinstance(value, bytes):
+        return pickle.loads(value)
+    return copy_dataframe(value)
+
+
+def dataframe_nbytes(df: pd.DataFrame) -> int:
+    """size in memory of a DataFrame (including the objects of object columns)"""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class DecodedCache:
+    """LRU cache {(node UUID, payload name): (decoded object, size)} bounded by max_bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, node, name: str, decode, copy=copy_dataframe):
+        """
+        Payload `name` of `node`, returned as copy(cached value).
+        decode() returns (value to cache, its approximate size in bytes) and is called on a miss;
+        the result is cached if the node is stored.
+        """
+        if not node.is_stored or self.max_bytes <= 0:
+            return copy(decode()[0])
+
+        key = (node.uuid, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            return copy(entry[0])
+
+        value, nbytes = decode()
+        with self._lock:
+            self.misses += 1
+            if nbytes <= self.max_bytes and key not in self._entries:
+                self._entries[key] = (value, nbytes)
+                self._nbytes += nbytes
+                while self._nbytes > self.max_bytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self._nbytes -= evicted
+                    self.evictions += 1
+        return copy(value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'nbytes': self._nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+def _max_bytes_from_environment() -> int:
+    try:
+        size_mb = float(os.environ.get(SIZE_VARIABLE, DEFAULT_SIZE_MB))
+    except ValueError:
+        size_mb = DEFAULT_SIZE_MB
+    return int(size_mb * 1024 ** 2)
+
+
+DECODED_CACHE = DecodedCache(_max_bytes_from_environment())
+
+
+def get_stats() -> dict:
+    """hit / miss statistics of the cache of this process"""
+    return DECODED_CACHE.get_stats()
+
+
+def clear() -> None:
+    DECODED_CACHE.clear()
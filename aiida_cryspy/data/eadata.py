@@ -1,26 +1,35 @@
 import pickle
 import pandas as pd
-import io
-from aiida.plugins import DataFactory
+from aiida.orm import Data
 
-SinglefileData = DataFactory('core.singlefile')
+from aiida_cryspy.data.decoded_cache import DECODED_CACHE, copy_payload, dataframe_nbytes
 
 
-class EAData(SinglefileData):
+class EAData(Data):
     """CrySPY ea_data
-    
+
+    ea_data = (gen, elite_struc, elite_fitness, ea_info, ea_origin)
+
+    gen and scalar summaries (n_elite) are saved as attributes,
+    and each heavy component is saved as its own pickle file in the repository,
+    so that they are deserialized only when accessed.
     """
+    FIELDS = ('elite_struc', 'elite_fitness', 'ea_info', 'ea_origin')
+    DATAFRAME_FIELDS = ('ea_info', 'ea_origin')
+
     def __init__(self, ea_data, **kwargs):
         """
-        SinglefileData requests file in __init__(), so ea_data must not be None.
+        ea_data must not be None.
         """
+        super().__init__(**kwargs)
         self._internal_validate(ea_data)
-        
-        content = pickle.dumps(ea_data)
-        handle = io.BytesIO(content)
-        super().__init__(file=handle, **kwargs)
-        
-        
+
+        gen, elite_struc, elite_fitness, ea_info, ea_origin = ea_data
+        self.base.attributes.set('gen', gen)
+        self.base.attributes.set('n_elite', len(elite_struc) if elite_struc is not None else 0)
+        for name, value in zip(self.FIELDS, ea_data[1:]):
+            self.base.repository.put_object_from_bytes(pickle.dumps(value), f'{name}.pkl')
+
     def _internal_validate(self, ea_data):
         if len(ea_data) != 5:
             raise TypeError('size of ea_data must be 5.')
@@ -43,12 +52,75 @@ class EAData(SinglefileData):
         if ea_data[4] is not None:
             if not isinstance(ea_data[4], pd.DataFrame):
                 raise TypeError('ea_data[4] must be pd.DataFrame')
-        
-    def get_ea_data(self):
-        with self.open(mode='rb') as handle:
+
+    @property
+    def is_legacy(self):
+        """
+        Nodes stored by the previous SinglefileData-based EAData
+        have the whole tuple in one pickle file.
+        """
+        return 'gen' not in self.base.attributes
+
+    def _read_object(self, filename):
+        with self.base.repository.open(filename, mode='rb') as handle:
             content = handle.read()
-        return pickle.loads(content)
-    
+        # DataFrames are cached decoded (DataFrame.copy is faster than unpickling), the rest as pickle bytes
+        if filename[:-len('.pkl')] in self.DATAFRAME_FIELDS:
+            value = pickle.loads(content)
+            if value is not None:
+                return value, dataframe_nbytes(value)
+        return content, len(content)
+
+    def _load_pickle(self, filename):
+        """
+        Unpickled content of a repository file.
+        The payload of a stored node is cached in this process (see aiida_cryspy.data.decoded_cache);
+        an independent copy is returned.
+        """
+        return DECODED_CACHE.get(self, filename, lambda: self._read_object(filename), copy=copy_payload)
+
+    def _get_legacy_ea_data(self):
+        return self._load_pickle(self.base.attributes.get('filename'))
+
+    def _get_field(self, name):
+        if self.is_legacy:
+            return self._get_legacy_ea_data()[self.FIELDS.index(name) + 1]
+        return self._load_pickle(f'{name}.pkl')
+
+    @property
+    def gen(self):
+        if self.is_legacy:
+            return self._get_legacy_ea_data()[0]
+        return self.base.attributes.get('gen')
+
+    @property
+    def n_elite(self):
+        if self.is_legacy:
+            elite_struc = self._get_legacy_ea_data()[1]
+            return len(elite_struc) if elite_struc is not None else 0
+        return self.base.attributes.get('n_elite')
+
+    @property
+    def elite_struc(self):
+        return self._get_field('elite_struc')
+
+    @property
+    def elite_fitness(self):
+        return self._get_field('elite_fitness')
+
+    @property
+    def ea_info(self):
+        return self._get_field('ea_info')
+
+    @property
+    def ea_origin(self):
+        return self._get_field('ea_origin')
+
+    def get_ea_data(self):
+        if self.is_legacy:
+            return self._get_legacy_ea_data()
+        return (self.gen,) + tuple(self._get_field(name) for name in self.FIELDS)
+
     @property
     def ea_data(self):
-        return self.get_ea_data()
\ No newline at end of file
+        return self.get_ea_data()
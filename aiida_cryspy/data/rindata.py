@@ -1,14 +1,19 @@
 import pickle
 import io
 from aiida.plugins import DataFactory
+
+from aiida_cryspy.data.decoded_cache import DECODED_CACHE, copy_payload
 SinglefileData = DataFactory('core.singlefile')
 
 
 class RinData(SinglefileData):
     """CrySPY rin
+
+    run_uuid (attribute) is the UUID of the search whose CrySPY files are in the
+    sandbox (see aiida_cryspy.utils.sandbox). None means the current working directory.
     """
 
-    def __init__(self, rin, **kwargs):
+    def __init__(self, rin, run_uuid=None, **kwargs):
         """
         SinglefileData requests file in __init__(), so rin must not be None.
         """
@@ -17,16 +22,28 @@ class RinData(SinglefileData):
         content = pickle.dumps(rin)
         handle = io.BytesIO(content)
         super().__init__(file=handle, **kwargs)
+        if run_uuid is not None:
+            self.base.attributes.set('run_uuid', run_uuid)
 
     def _internal_validate(self, rin):
         pass
 
     def get_rin(self):
+        """
+        The rin of a stored node is cached in this process
+        (see aiida_cryspy.data.decoded_cache); the pickle is cached and unpickled on every call.
+        """
+        return DECODED_CACHE.get(self, 'rin', self._read_content, copy=copy_payload)
+
+    def _read_content(self):
         with self.open(mode='rb') as handle:
             content = handle.read()
-        return pickle.loads(content)
+        return content, len(content)
 
     @property
     def rin(self):
         return self.get_rin()
 
+    @property
+    def run_uuid(self):
+        return self.base.attributes.get('run_uuid', None)
@@ -1,37 +1,179 @@
-from aiida.orm import Dict
-from pymatgen.core import Structure
+import numpy as np
+from aiida.orm import ArrayData
+from pymatgen.core import Lattice, Structure
+from pymatgen.core.periodic_table import get_el_sp
 
 
-class StructureCollectionData(Dict):
+def pack_structures(structures: dict) -> tuple:
+    """
+    Pack a dict of pymatgen.core.Structure into flat numpy arrays.
+
+    The number of sites of every structure is counted first, so the concatenated
+    arrays are allocated once and each structure is written into its slice
+    offsets[i]:offsets[i+1] in a single pass.
+    The site property 'kind_name' (AiiDA kind names, see aiida_cryspy.utils.groups) is kept;
+    other site properties are not.
+
+    Args:
+        structures (dict): {ID: Structure, ...}
+
+    Returns:
+        (arrays, species)
+        arrays = {
+            'ids': (N,) int,
+            'lattices': (N, 3, 3) float,
+            'frac_coords': (M, 3) float, concatenated over all structures,
+            'species_indices': (M,) int, index of the species table,
+            'offsets': (N+1,) int, sites of the i-th structure are offsets[i]:offsets[i+1],
+            only if a structure has the site property 'kind_name':
+            'kind_indices': (M,) int, index of 'kind_names' (-1 for structures without kind names),
+            'kind_names': (K,) str, kind name table,
+        }
+        species = list of species symbols (species table, sorted)
+    """
+    n = len(structures)
+    strucs = list(structures.values())
+    ids = np.fromiter((int(ID) for ID in structures), dtype=np.int64, count=n)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(struc) for struc in strucs), dtype=np.int64, count=n), out=offsets[1:])
+
+    lattices = np.empty((n, 3, 3), dtype=float)
+    frac_coords = np.empty((offsets[-1], 3), dtype=float)
+    species_indices = np.empty(offsets[-1], dtype=np.int64)
+    table = {}  # {species symbol: index in the order of appearance}
+    kind_table = {}
+    kind_indices = None
+    for i, struc in enumerate(strucs):
+        start, end = offsets[i], offsets[i + 1]
+        lattices[i] = struc.lattice.matrix
+        frac_coords[start:end] = struc.frac_coords
+        species_indices[start:end] = [table.setdefault(site.species_string, len(table)) for site in struc]
+        if len(struc) and 'kind_name' in struc[0].properties:
+            if kind_indices is None:
+                kind_indices = np.full(offsets[-1], -1, dtype=np.int64)
+            kind_indices[start:end] = [kind_table.setdefault(site.properties['kind_name'], len(kind_table)) for site in struc]
+
+    disordered = [symbol for symbol in table if ':' in symbol]
+    if disordered:
+        raise ValueError(f'disordered sites cannot be packed: {disordered}')
+    # species table in sorted order (independent of the order of the structures)
+    species = sorted(table)
+    remap = np.empty(len(table), dtype=np.int64)
+    remap[[table[symbol] for symbol in species]] = np.arange(len(species))
+
+    arrays = {
+        'ids': ids,
+        'lattices': lattices,
+        'frac_coords': frac_coords,
+        'species_indices': remap[species_indices] if len(species_indices) else species_indices,
+        'offsets': offsets,
+    }
+    if kind_indices is not None:
+        arrays['kind_indices'] = kind_indices
+        arrays['kind_names'] = np.array(list(kind_table), dtype=str)
+    return arrays, species
+
+
+def _species_table(species: list) -> np.ndarray:
+    """species symbols -> Element / Species objects (parsed once per table, not once per site)"""
+    table = np.empty(len(species), dtype=object)
+    table[:] = [get_el_sp(symbol) for symbol in species]
+    return table
+
+
+def unpack_structures(arrays: dict, species: list, ids=None) -> dict:
+    """
+    Inverse of pack_structures.
+
+    Args:
+        arrays (dict): arrays made by pack_structures
+        species (list): species table
+        ids (Iterable[int]): decode only these IDs (default: all)
+
+    Returns:
+        {ID: Structure, ...}
+    """
+    all_ids = arrays['ids']
+    if ids is None:
+        positions = range(len(all_ids))
+    else:
+        where = {int(ID): i for i, ID in enumerate(all_ids)}
+        positions = [where[int(ID)] for ID in ids]
+
+    table = _species_table(species)
+    offsets = arrays['offsets']
+    lattices = arrays['lattices']
+    frac_coords = arrays['frac_coords']
+    species_indices = arrays['species_indices']
+    kind_indices = arrays.get('kind_indices')
+    kind_names = arrays.get('kind_names')
+    structures = {}
+    for i in positions:
+        start, end = offsets[i], offsets[i + 1]
+        structures[int(all_ids[i])] = _make_structure(
+            lattices[i],
+            table[species_indices[start:end]],
+            frac_coords[start:end],
+            kind_names, None if kind_indices is None else kind_indices[start:end],
+        )
+    return structures
+
+
+def _make_structure(lattice, species, frac_coords, kind_names=None, kind_indices=None) -> Structure:
+    site_properties = None
+    if kind_indices is not None and len(kind_indices) and kind_indices[0] >= 0:
+        site_properties = {'kind_name': kind_names[kind_indices].tolist()}
+    return Structure(Lattice(lattice), species.tolist(), frac_coords, site_properties=site_properties)
+
+
+def read_npy_rows(handle, start: int, end: int) -> np.ndarray:
+    """
+    Read rows start:end of the npy file opened as handle without reading the other rows.
+    Returns None if the array cannot be read partially (Fortran order or object dtype).
+    """
+    version = np.lib.format.read_magic(handle)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+    if fortran_order or dtype.hasobject:
+        return None
+    row_shape = shape[1:]
+    row_bytes = dtype.itemsize * int(np.prod(row_shape, dtype=np.int64))
+    end = min(end, shape[0])
+    count = max(end - start, 0)
+    handle.seek(handle.tell() + start * row_bytes)
+    buffer = handle.read(count * row_bytes)
+    return np.frombuffer(buffer, dtype=dtype).reshape((count,) + row_shape)
+
+
+class StructureCollectionData(ArrayData):
     """
     structures is a dict of pymatgen.core.Structure.,
     structures= {0: pymatgen.core.Structure, 1: pymatgen.core.Structure, ...}
 
-    The internal type is
-    {'0': pymatgen.core.Structure.as_dict(), '1': pymatgen.core.Structure.as_dict(), ...}
+    The internal type is the packed numpy arrays made by pack_structures()
+    ('ids', 'lattices', 'frac_coords', 'species_indices', 'offsets')
+    and the species table in the attribute 'species'.
+
+    Nodes stored by the previous Dict-based version
+    ({'0': pymatgen.core.Structure.as_dict(), ...} in the attributes) can still be read.
     """
 
+    ARRAY_NAMES = ('ids', 'lattices', 'frac_coords', 'species_indices', 'offsets')
+    KIND_ARRAY_NAMES = ('kind_indices', 'kind_names')
+
     def __init__(self, structures: dict=None, **kwargs):
         """
         structures is a dict of pymatgen.core.Structure.,
 
         Args:
-            structures (List[Structure]): structure.
+            structures (dict): structures.
         """
         super().__init__(**kwargs)
 
         if structures is not None:
-            self._internal_validate(structures)
-        if False:
-            struc_dict_dict = {}
-            for ID, value in structures.items():
-                struc = value.as_dict()
-                key = str(ID)
-                struc_dict_dict[key] = struc
-            self.set_dict(struc_dict_dict)
-        else:
-            if structures is not None:
-                self.set_structurecollection(structures)
+            self.set_structurecollection(structures)
 
     def _internal_validate(self, structures: dict):
         """
@@ -40,7 +182,7 @@ class StructureCollectionData(Dict):
         all the values of structures are Structure.
 
         Args:
-            structures (List[Structure]): structure.
+            structures (dict): structures.
         """
 
 
@@ -56,6 +198,22 @@ class StructureCollectionData(Dict):
             if not isinstance(value, Structure):
                 raise TypeError('structures.values must be a type of Structure.')
 
+    @property
+    def is_legacy(self) -> bool:
+        return f'{self.array_prefix}ids' not in self.base.attributes
+
+    @property
+    def ids(self) -> list:
+        """IDs of the structures, without decoding them."""
+        if self.is_legacy:
+            return [int(key) for key in self.base.attributes.keys()]
+        return self.get_array('ids').tolist()
+
+    def __len__(self) -> int:
+        if self.is_legacy:
+            return len(self.base.attributes.keys())
+        return self.get_shape('ids')[0]
+
     def set_structurecollection(self, structures: dict):
         """
         set StrucDict
@@ -65,21 +223,70 @@ class StructureCollectionData(Dict):
         """
         if structures is not None:
             self._internal_validate(structures)
-        struc_dict_dict = {}
-        for ID, value in structures.items():
-            struc = value.as_dict()
-            key = str(ID)
-            struc_dict_dict[key] = struc
-        self.set_dict(dictionary=struc_dict_dict)
-
-    def get_structurecollection(self) -> dict:
-        structuresdic = self.get_dict()
-        _structuresdic = {}
-        for key, value in structuresdic.items():
-            ID = int(key)
-            struc = Structure.from_dict(value)
-            _structuresdic[ID] = struc
-        return _structuresdic
+        arrays, species = pack_structures(structures)
+        for name in self.ARRAY_NAMES + self.KIND_ARRAY_NAMES:
+            if name in arrays:
+                self.set_array(name, arrays[name])
+        self.base.attributes.set('species', species)
+
+    @property
+    def has_kind_names(self) -> bool:
+        return 'kind_indices' in self.get_arraynames()
+
+    def _get_arrays(self) -> dict:
+        names = self.ARRAY_NAMES + (self.KIND_ARRAY_NAMES if self.has_kind_names else ())
+        return {name: self.get_array(name) for name in names}
+
+    def get_structurecollection(self, ids=None) -> dict:
+        """
+        Args:
+            ids (Iterable[int]): decode only these IDs (default: all)
+        """
+        if self.is_legacy:
+            structuresdic = self.base.attributes.all
+            if ids is not None:
+                structuresdic = {str(ID): structuresdic[str(ID)] for ID in ids}
+            _structuresdic = {}
+            for key, value in structuresdic.items():
+                ID = int(key)
+                struc = Structure.from_dict(value)
+                _structuresdic[ID] = struc
+            return _structuresdic
+        return unpack_structures(self._get_arrays(), self.base.attributes.get('species'), ids=ids)
+
+    def get_structure(self, ID: int) -> Structure:
+        """
+        Decode a single structure without decoding the rest.
+        Only 'ids', 'offsets' and the rows of this structure are read from the repository.
+        """
+        if self.is_legacy:
+            return self.get_structurecollection(ids=[ID])[int(ID)]
+        ids = self.get_array('ids')
+        positions = np.flatnonzero(ids == int(ID))
+        if len(positions) == 0:
+            raise KeyError(ID)
+        i = int(positions[0])
+        start, end = (int(offset) for offset in self.get_array('offsets')[i:i + 2])
+        table = _species_table(self.base.attributes.get('species'))
+        kind_names = kind_indices = None
+        if self.has_kind_names:
+            kind_names = self.get_array('kind_names')
+            kind_indices = self.get_array_rows('kind_indices', start, end)
+        return _make_structure(
+            self.get_array_rows('lattices', i, i + 1)[0],
+            table[self.get_array_rows('species_indices', start, end)],
+            self.get_array_rows('frac_coords', start, end),
+            kind_names, kind_indices,
+        )
+
+    def get_array_rows(self, name: str, start: int, end: int) -> np.ndarray:
+        """Rows start:end of the array `name`, reading only those rows of a stored node."""
+        if self.is_stored:
+            with self.base.repository.open(f'{name}.npy', mode='rb') as handle:
+                rows = read_npy_rows(handle, start, end)
+            if rows is not None:
+                return rows
+        return self.get_array(name)[start:end]
 
     @property
     def structurecollection(self) -> dict:
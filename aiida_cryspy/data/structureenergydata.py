@@ -0,0 +1,106 @@
+import numpy as np
+from aiida.orm import ArrayData
+
+from aiida_cryspy.data.structurecollectiondata import pack_structures, unpack_structures
+
+
+class StructureEnergyData(ArrayData):
+    """
+    Optimized structures of one generation with their energies, in packed numpy arrays.
+
+    arrays:
+        'ids': (N,) int, cryspy_id
+        'energies': (N,) float, total energy [eV]
+        'enthalpies': (N,) float, enthalpy per atom (E + PV) / N [eV/atom]
+        'volumes': (N,) float, cell volume [A^3]
+        'lattices', 'frac_coords', 'species_indices', 'offsets' (and 'kind_indices', 'kind_names'):
+            packed structures (see pack_structures)
+    attributes:
+        'species': species table
+
+    Use sorted_by() to get the best structures without decoding the others.
+    """
+
+    STRUCTURE_ARRAYS = ('lattices', 'frac_coords', 'species_indices', 'offsets')
+    KIND_ARRAYS = ('kind_indices', 'kind_names')
+    VALUE_ARRAYS = {'energy': 'energies', 'enthalpy': 'enthalpies', 'volume': 'volumes'}
+
+    def __init__(self, structures: dict=None, energies: dict=None, enthalpies: dict=None, **kwargs):
+        """
+        Args:
+            structures (dict): {ID: pymatgen.core.Structure}
+            energies (dict): {ID: total energy [eV]}
+            enthalpies (dict): {ID: enthalpy per atom [eV/atom]}
+        """
+        super().__init__(**kwargs)
+        if structures is not None:
+            self.set_structure_energies(structures, energies, enthalpies)
+
+    def set_structure_energies(self, structures: dict, energies: dict, enthalpies: dict) -> None:
+        structures = {int(ID): struc for ID, struc in structures.items()}
+        energies = {int(ID): value for ID, value in energies.items()}
+        enthalpies = {int(ID): value for ID, value in enthalpies.items()}
+        arrays, species = pack_structures(structures)
+        self.set_array('ids', arrays['ids'])
+        for name in self.STRUCTURE_ARRAYS + self.KIND_ARRAYS:
+            if name in arrays:
+                self.set_array(name, arrays[name])
+        self.set_array('energies', np.array([energies[ID] for ID in structures], dtype=float))
+        self.set_array('enthalpies', np.array([enthalpies[ID] for ID in structures], dtype=float))
+        self.set_array('volumes', np.abs(np.linalg.det(arrays['lattices'])) if structures else np.empty(0))
+        self.base.attributes.set('species', species)
+
+    @property
+    def ids(self) -> list:
+        return self.get_array('ids').tolist()
+
+    def __len__(self) -> int:
+        return self.get_shape('ids')[0]
+
+    def get_values(self, name: str='enthalpy') -> dict:
+        """{ID: value} of 'energy', 'enthalpy' or 'volume'"""
+        return dict(zip(self.ids, self._get_value_array(name).tolist()))
+
+    def _get_value_array(self, name: str) -> np.ndarray:
+        if name not in self.VALUE_ARRAYS:
+            raise ValueError(f"unknown value `{name}` (use one of {', '.join(self.VALUE_ARRAYS)})")
+        return self.get_array(self.VALUE_ARRAYS[name])
+
+    def get_structures(self, ids=None) -> dict:
+        """
+        Args:
+            ids (Iterable[int]): decode only these IDs (default: all)
+
+        Returns:
+            {ID: pymatgen.core.Structure}
+        """
+        names = ('ids',) + self.STRUCTURE_ARRAYS
+        if 'kind_indices' in self.get_arraynames():
+            names += self.KIND_ARRAYS
+        arrays = {name: self.get_array(name) for name in names}
+        return unpack_structures(arrays, self.base.attributes.get('species'), ids=ids)
+
+    def sorted_by(self, name: str='enthalpy', k: int=None, reverse: bool=False, structures: bool=True) -> list:
+        """
+        Top-k entries sorted by 'energy', 'enthalpy' or 'volume' (ascending unless reverse).
+        Only the structures of the returned entries are decoded (NaN values are last).
+
+        Returns:
+            [{'id', 'energy', 'enthalpy', 'volume', 'structure'}, ...]
+        """
+        values = self._get_value_array(name)
+        order = np.argsort(-values if reverse else values, kind='stable')
+        if k is not None:
+            order = order[:k]
+
+        ids = self.get_array('ids')[order].tolist()
+        decoded = self.get_structures(ids=ids) if structures else {}
+        columns = {key: self.get_array(array)[order].tolist() for key, array in self.VALUE_ARRAYS.items()}
+        entries = []
+        for i, ID in enumerate(ids):
+            entry = {'id': ID}
+            entry.update({key: column[i] for key, column in columns.items()})
+            if structures:
+                entry['structure'] = decoded[ID]
+            entries.append(entry)
+        return entries
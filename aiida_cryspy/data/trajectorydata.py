@@ -0,0 +1,109 @@
+import io
+
+import numpy as np
+from aiida.orm import Data
+
+
+class CompressedTrajectoryData(Data):
+    """
+    Frames of a relaxation (positions, cell, energy, forces) stored as float32 arrays.
+
+    The frames are split into chunks of `chunk_size` frames, and each chunk is saved as a
+    compressed .npz file in the node repository. get_frame() decompresses only the chunk of
+    the requested frame.
+
+    attributes:
+        'symbols': chemical symbols
+        'pbc': periodic boundary conditions
+        'steps': optimizer step of each frame
+        'chunk_size': number of frames in one chunk
+    """
+
+    CHUNK_SIZE = 32
+    FIELDS = ('positions', 'cells', 'energies', 'forces')
+
+    def __init__(self, arrays: dict=None, chunk_size: int=CHUNK_SIZE, **kwargs):
+        """
+        Args:
+            arrays (dict): {'symbols', 'pbc', 'steps', 'positions', 'cells', 'energies', 'forces'}
+                (the output of ase_relax.TrajectoryRecorder.as_arrays())
+            chunk_size (int): number of frames in one chunk
+        """
+        super().__init__(**kwargs)
+        if arrays is not None:
+            self.set_frames(arrays, chunk_size)
+
+    def set_frames(self, arrays: dict, chunk_size: int=CHUNK_SIZE) -> None:
+        steps = np.asarray(arrays['steps'], dtype=np.int64)
+        fields = {name: np.asarray(arrays[name], dtype=np.float32) for name in self.FIELDS}
+        for name, values in fields.items():
+            if len(values) != len(steps):
+                raise ValueError(f'`{name}` has {len(values)} frames but `steps` has {len(steps)}')
+
+        for start in range(0, len(steps), chunk_size):
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, **{name: values[start:start + chunk_size] for name, values in fields.items()})
+            self.base.repository.put_object_from_bytes(buffer.getvalue(), self._chunk_name(start // chunk_size))
+
+        self.base.attributes.set('symbols', list(arrays['symbols']))
+        self.base.attributes.set('pbc', [bool(value) for value in arrays.get('pbc', (True, True, True))])
+        self.base.attributes.set('steps', steps.tolist())
+        self.base.attributes.set('chunk_size', int(chunk_size))
+
+    @staticmethod
+    def _chunk_name(index: int) -> str:
+        return f'chunk_{index:05d}.npz'
+
+    def _load_chunk(self, index: int) -> dict:
+        content = self.base.repository.get_object_content(self._chunk_name(index), mode='rb')
+        with np.load(io.BytesIO(content)) as chunk:
+            return {name: chunk[name] for name in self.FIELDS}
+
+    @property
+    def symbols(self) -> list:
+        return self.base.attributes.get('symbols')
+
+    @property
+    def steps(self) -> list:
+        return self.base.attributes.get('steps')
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def get_frame(self, index: int) -> dict:
+        """
+        Returns:
+            {'step', 'positions', 'cell', 'energy', 'forces'} of the index-th frame (negative index is allowed)
+        """
+        n_frames = len(self)
+        if not -n_frames <= index < n_frames:
+            raise IndexError(f'frame {index} out of range ({n_frames} frames)')
+        index %= n_frames
+        chunk_size = self.base.attributes.get('chunk_size')
+        chunk = self._load_chunk(index // chunk_size)
+        i = index % chunk_size
+        return {
+            'step': self.steps[index],
+            'positions': chunk['positions'][i],
+            'cell': chunk['cells'][i],
+            'energy': float(chunk['energies'][i]),
+            'forces': chunk['forces'][i],
+        }
+
+    def get_atoms(self, index: int=-1):
+        """ase.Atoms of the index-th frame (energy and forces in a SinglePointCalculator)"""
+        from ase import Atoms
+        from ase.calculators.singlepoint import SinglePointCalculator
+
+        frame = self.get_frame(index)
+        atoms = Atoms(symbols=self.symbols, positions=frame['positions'], cell=frame['cell'], pbc=self.base.attributes.get('pbc'))
+        atoms.calc = SinglePointCalculator(atoms, energy=frame['energy'], forces=frame['forces'])
+        return atoms
+
+    def get_array(self, name: str) -> np.ndarray:
+        """All frames of 'positions', 'cells', 'energies' or 'forces' (decompresses every chunk)"""
+        if name not in self.FIELDS:
+            raise ValueError(f"unknown array `{name}` (use one of {', '.join(self.FIELDS)})")
+        chunk_size = self.base.attributes.get('chunk_size')
+        n_chunks = -(-len(self) // chunk_size)
+        return np.concatenate([self._load_chunk(k)[name] for k in range(n_chunks)]) if n_chunks else np.empty(0, dtype=np.float32)
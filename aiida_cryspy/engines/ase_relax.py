@@ -0,0 +1,261 @@
+"""
+ASEによる構造緩和 (optimization_WorkChain の parameters と同じ形式の辞書を使う)。
+
+このファイルは RelaxPackCalculation によって計算ノードにそのままコピーされ、
+`python ase_relax.py` として実行される。そのため ase と numpy 以外
+(aiida, aiida_cryspy など) には依存しないこと。
+
+parameters = {
+    'calculator': {'name': 'emt', 'args': {...}},
+    'optimizer': {
+        'name': 'BFGS',
+        'run_args': {'fmax': 0.01, 'steps': 3000},
+        'args': {'maxstep': 0.01},
+        'setup': {'FixSymmetry': True, 'FrechetCellFilter': True, 'ExpCellFilter': False, 'scalar_pressure': 3},
+    },
+    'extra_imports': [['mattersim.forcefield', 'MatterSimCalculator'], 'torch'],
+    'pre_lines': ['custom_calculator = MatterSimCalculator'],
+}
+pre_lines で custom_calculator が定義されていればそれを、なければ calculator.name の
+ASE calculator を使う。post_lines と atoms_getters は aiida-ase 用なので使わない。
+
+緩和の軌跡は trajectory = {'policy': 'none' | 'last' | 'every' | 'full', 'interval': n} に従って
+(every は n ステップごとと最後のフレーム) float32 で記録し、results/<key>.traj.npz に書き出す。
+"""
+import importlib
+import json
+import os
+import sys
+import traceback
+
+import numpy
+
+INPUT_FILENAME = "aiida_relax_input.json"
+RESULTS_DIRNAME = "results"
+ARRAY_FLAG = "--array"
+# アレイジョブのタスク番号 (1始まり) が入る環境変数
+ARRAY_TASK_ID_VARIABLES = ("SGE_TASK_ID", "SLURM_ARRAY_TASK_ID", "PBS_ARRAY_INDEX")
+TRAJECTORY_POLICIES = ("none", "last", "every", "full")
+TRAJECTORY_SUFFIX = ".traj.npz"
+
+
+def keep_frame(step: int, policy: str, interval: int) -> bool:
+    """step 番目のフレームを残すか (最後のフレームは policy が none 以外なら常に残す)"""
+    if policy == "full":
+        return True
+    if policy == "every":
+        return step % max(interval, 1) == 0
+    return False
+
+
+class TrajectoryRecorder:
+    """
+    緩和中の atoms のフレーム (positions, cell, energy, forces) を記録する。
+    エネルギーと力は calculator が計算済みの値を使う (optimizer の observer として呼ぶ)。
+    """
+
+    def __init__(self, atoms, policy: str = "none", interval: int = 1):
+        if policy not in TRAJECTORY_POLICIES:
+            raise ValueError(f"unknown trajectory policy `{policy}` (use one of {', '.join(TRAJECTORY_POLICIES)})")
+        self.atoms = atoms
+        self.policy = policy
+        self.interval = interval
+        self.frames = []
+
+    @classmethod
+    def from_settings(cls, atoms, trajectory: dict = None):
+        trajectory = trajectory or {}
+        return cls(atoms, trajectory.get("policy", "none"), trajectory.get("interval", 1))
+
+    def record(self, step: int, force: bool = False) -> None:
+        if self.policy == "none" or (self.frames and self.frames[-1][0] == step):
+            return
+        if not (force or keep_frame(step, self.policy, self.interval)):
+            return
+        atoms = self.atoms
+        self.frames.append((
+            step,
+            atoms.get_positions(),
+            atoms.cell.array.copy(),
+            atoms.get_potential_energy(),
+            atoms.get_forces(apply_constraint=False),
+        ))
+
+    def finish(self, step: int) -> None:
+        """最後のフレームを記録する"""
+        self.record(step, force=True)
+
+    def as_arrays(self) -> dict:
+        steps, positions, cells, energies, forces = zip(*self.frames) if self.frames else ((),) * 5
+        n_atoms = len(self.atoms)
+        return {
+            "symbols": self.atoms.get_chemical_symbols(),
+            "pbc": self.atoms.pbc.tolist(),
+            "steps": numpy.array(steps, dtype=numpy.int64),
+            "positions": numpy.array(positions, dtype=numpy.float32).reshape(-1, n_atoms, 3),
+            "cells": numpy.array(cells, dtype=numpy.float32).reshape(-1, 3, 3),
+            "energies": numpy.array(energies, dtype=numpy.float32),
+            "forces": numpy.array(forces, dtype=numpy.float32).reshape(-1, n_atoms, 3),
+        }
+
+
+def build_calculator(parameters: dict):
+    """parameters から ASE calculator を作る"""
+    namespace = {"numpy": numpy}
+    for item in parameters.get("extra_imports", []):
+        if isinstance(item, str):
+            namespace[item.split(".")[0]] = importlib.import_module(item)
+        else:
+            module_name, name = item[0], item[1]
+            alias = item[2] if len(item) > 2 else name
+            namespace[alias] = getattr(importlib.import_module(module_name), name)
+    for line in parameters.get("pre_lines", []):
+        exec(line, namespace)
+
+    calculator_params = parameters.get("calculator", {})
+    calculator_class = namespace.get("custom_calculator")
+    if calculator_class is None:
+        name = calculator_params["name"]
+        module = importlib.import_module(f"ase.calculators.{name.lower()}")
+        calculator_class = next(getattr(module, attr) for attr in dir(module) if attr.lower() == name.lower())
+    return calculator_class(**calculator_params.get("args", {}))
+
+
+def get_scalar_pressure(parameters: dict) -> float:
+    """scalar_pressure [GPa] (存在しない、または None の場合は 0.0)"""
+    setup = parameters.get("optimizer", {}).get("setup", {})
+    pressure = setup.get("scalar_pressure", 0.0)
+    return 0.0 if pressure is None else float(pressure)
+
+
+def prepare_atoms(atoms, parameters: dict, calculator):
+    """
+    calculator と制約を設定し、optimizer に渡す対象 (atoms または cell filter) を返す。
+    """
+    from ase import units
+
+    setup = parameters.get("optimizer", {}).get("setup", {})
+    atoms.calc = calculator
+    if setup.get("FixSymmetry", False):
+        from ase.constraints import FixSymmetry
+        atoms.set_constraint(FixSymmetry(atoms))
+
+    pressure = get_scalar_pressure(parameters) * units.GPa
+    if setup.get("FrechetCellFilter", False):
+        from ase.filters import FrechetCellFilter
+        return FrechetCellFilter(atoms, scalar_pressure=pressure)
+    if setup.get("ExpCellFilter", False):
+        from ase.filters import ExpCellFilter
+        return ExpCellFilter(atoms, scalar_pressure=pressure)
+    return atoms
+
+
+def relax_atoms(atoms, parameters: dict, calculator, trajectory=None, recorder=None) -> dict:
+    """
+    atoms をその場で緩和する。
+    recorder (TrajectoryRecorder) があれば各ステップのフレームを記録する。
+
+    Returns:
+        {'total_energy': float [eV], 'converged': bool, 'nsteps': int}
+    """
+    from ase import optimize
+
+    optimizer_params = parameters.get("optimizer", {})
+    target = prepare_atoms(atoms, parameters, calculator)
+    optimizer_class = getattr(optimize, optimizer_params.get("name", "BFGS"))
+    optimizer = optimizer_class(target, logfile=None, trajectory=trajectory, **optimizer_params.get("args", {}))
+    if recorder is not None and recorder.policy in ("every", "full"):
+        optimizer.attach(lambda: recorder.record(optimizer.nsteps))
+    converged = optimizer.run(**optimizer_params.get("run_args", {}))
+    if recorder is not None:
+        recorder.finish(optimizer.nsteps)
+    return {
+        "total_energy": float(atoms.get_potential_energy()),
+        "converged": bool(converged),
+        "nsteps": int(optimizer.nsteps),
+    }
+
+
+def atoms_to_dict(atoms) -> dict:
+    return {
+        "symbols": atoms.get_chemical_symbols(),
+        "cell": atoms.cell.array.tolist(),
+        "positions": atoms.positions.tolist(),
+        "pbc": atoms.pbc.tolist(),
+    }
+
+
+def atoms_from_dict(dic: dict):
+    from ase import Atoms
+    return Atoms(symbols=dic["symbols"], cell=dic["cell"], positions=dic["positions"], pbc=dic["pbc"])
+
+
+def relax_one(structure: dict, parameters: dict, calculator, trajectory: dict = None) -> dict:
+    """
+    1構造を緩和して結果の辞書を返す (失敗しても例外は投げない)。
+    trajectory の policy が none 以外なら、記録したフレームを result['trajectory'] に入れる。
+    """
+    try:
+        atoms = atoms_from_dict(structure)
+        recorder = TrajectoryRecorder.from_settings(atoms, trajectory)
+        result = relax_atoms(atoms, parameters, calculator, recorder=recorder)
+        atoms.set_constraint()
+        result["structure"] = atoms_to_dict(atoms)
+        if recorder.policy != "none":
+            result["trajectory"] = recorder.as_arrays()
+    except Exception:
+        result = {"error": traceback.format_exc()}
+    return result
+
+
+def write_result(key: str, result: dict) -> None:
+    """results/<key>.json (軌跡があれば先に results/<key>.traj.npz) を書き出す"""
+    os.makedirs(RESULTS_DIRNAME, exist_ok=True)
+    trajectory = result.pop("trajectory", None)
+    if trajectory is not None:
+        tmp_path = os.path.join(RESULTS_DIRNAME, f".{key}{TRAJECTORY_SUFFIX}")
+        numpy.savez_compressed(tmp_path, **trajectory)
+        os.replace(tmp_path, os.path.join(RESULTS_DIRNAME, f"{key}{TRAJECTORY_SUFFIX}"))
+    tmp_path = os.path.join(RESULTS_DIRNAME, f".{key}.json")
+    with open(tmp_path, "w") as handle:
+        json.dump(result, handle)
+    os.replace(tmp_path, os.path.join(RESULTS_DIRNAME, f"{key}.json"))
+
+
+def get_array_task_id() -> int:
+    for name in ARRAY_TASK_ID_VARIABLES:
+        value = os.environ.get(name)
+        if value and value.isdigit():
+            return int(value)
+    raise RuntimeError(f"array task id is not set (checked {', '.join(ARRAY_TASK_ID_VARIABLES)})")
+
+
+def main(argv=None) -> int:
+    """
+    INPUT_FILENAME の全構造を、1つの calculator で順番に緩和する。
+    結果は1構造ごとに results/<key>.json に書き出す (1構造の失敗で他の結果を失わない)。
+
+    ARRAY_FLAG を付けた場合はアレイジョブの1タスクとして、
+    タスク番号 i 番目 (1始まり) の構造だけを緩和する。
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    with open(INPUT_FILENAME) as handle:
+        data = json.load(handle)
+    parameters = data["parameters"]
+    structures = data["structures"]
+    trajectory = data.get("trajectory")
+
+    if ARRAY_FLAG in argv:
+        key = list(structures)[get_array_task_id() - 1]
+        structures = {key: structures[key]}
+
+    calculator = build_calculator(parameters)
+    for key, structure in structures.items():
+        if os.path.isfile(os.path.join(RESULTS_DIRNAME, f"{key}.json")):
+            continue # 再実行時は終わった構造を飛ばす
+        write_result(key, relax_one(structure, parameters, calculator, trajectory))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
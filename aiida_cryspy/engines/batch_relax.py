@@ -0,0 +1,218 @@
+"""
+複数の構造をまとめて緩和する (バッチ化した FIRE)。
+
+小さなセルを1構造ずつ緩和すると、MLポテンシャルの1回の計算が小さすぎてCPUを使い切れない。
+relax_batch は K 個の構造を同時に1ステップずつ進める:
+  1. 未収束の構造のエネルギー・力・応力を1回の呼び出しでまとめて計算する
+  2. FIRE の更新を全構造の座標を連結した配列に対して一度に行う (構造ごとの dt, a, Nsteps を持つ)
+  3. fmax 以下になった構造はバッチから外す
+
+calculator が calculate_batch(atoms_list) を持っていれば1回で全構造を計算する
+(戻り値は構造ごとの {'energy', 'forces', 'stress'} のリスト)。持っていなければ1構造ずつ計算する。
+
+parameters は optimization_WorkChain と同じ形式で、optimizer.run_args の fmax, steps、
+optimizer.setup (FixSymmetry, FrechetCellFilter, ExpCellFilter, scalar_pressure)、
+optimizer.args の FIRE のパラメータ (dt, maxstep, dtmax, Nmin, finc, fdec, astart, fa) を使う。
+optimizer.name に関係なく FIRE で緩和する。
+"""
+import json
+import traceback
+
+import numpy
+
+from aiida_cryspy.engines import ase_relax
+
+FIRE_DEFAULTS = {
+    "dt": 0.1, "maxstep": 0.2, "dtmax": 1.0, "Nmin": 5,
+    "finc": 1.1, "fdec": 0.5, "astart": 0.1, "fa": 0.99,
+}
+
+# このプロセスで使い回す calculator (parameters が変わったら作り直す)
+_calculator = None
+_calculator_key = None
+
+
+def get_calculator(parameters: dict):
+    global _calculator, _calculator_key
+    key = json.dumps(parameters, sort_keys=True)
+    if _calculator is None or _calculator_key != key:
+        _calculator = ase_relax.build_calculator(parameters)
+        _calculator_key = key
+    return _calculator
+
+
+def get_fire_parameters(parameters: dict) -> dict:
+    args = parameters.get("optimizer", {}).get("args", {})
+    fire = dict(FIRE_DEFAULTS)
+    for name in fire:
+        if args.get(name) is not None:
+            fire[name] = args[name]
+    if args.get("maxmove") is not None:
+        fire["maxstep"] = args["maxmove"]
+    return fire
+
+
+def evaluate(atoms_list: list, calculator, need_stress: bool) -> list:
+    """
+    atoms_list のエネルギー・力・応力を計算する。
+
+    Returns:
+        構造ごとの {'energy', 'forces', 'stress'} (失敗した構造は例外オブジェクト)
+    """
+    if hasattr(calculator, "calculate_batch"):
+        try:
+            return calculator.calculate_batch(atoms_list)
+        except Exception:
+            pass # 1構造ずつ計算して失敗した構造を特定する
+
+    results = []
+    for atoms in atoms_list:
+        try:
+            atoms.calc = calculator
+            result = {
+                "energy": atoms.get_potential_energy(),
+                "forces": atoms.get_forces(apply_constraint=False),
+            }
+            if need_stress:
+                result["stress"] = atoms.get_stress(apply_constraint=False)
+            results.append(result)
+        except Exception as exception:
+            results.append(exception)
+    return results
+
+
+def _segment_sum(values, starts):
+    return numpy.add.reduceat(values, starts) if len(values) else numpy.zeros(0)
+
+
+def relax_batch(atoms_list: list, parameters: dict, calculator, recorders: list = None) -> list:
+    """
+    atoms_list をその場でまとめて緩和する。
+    recorders (構造ごとの ase_relax.TrajectoryRecorder) があれば各ステップのフレームを記録する。
+
+    Returns:
+        構造ごとの {'total_energy', 'converged', 'nsteps'} (失敗した構造は {'error': ...})
+    """
+    from ase.calculators.singlepoint import SinglePointCalculator
+
+    run_args = parameters.get("optimizer", {}).get("run_args", {})
+    fmax = run_args.get("fmax", 0.05)
+    max_steps = run_args.get("steps", 100000000)
+    fire = get_fire_parameters(parameters)
+
+    n = len(atoms_list)
+    results = [None] * n
+    targets = [None] * n
+    for i, atoms in enumerate(atoms_list):
+        try:
+            targets[i] = ase_relax.prepare_atoms(atoms, parameters, None)
+        except Exception:
+            results[i] = {"error": traceback.format_exc()}
+    need_stress = any(target is not None and target is not atoms for target, atoms in zip(targets, atoms_list))
+
+    dt = numpy.full(n, float(fire["dt"]))
+    alpha = numpy.full(n, float(fire["astart"]))
+    n_positive = numpy.zeros(n, dtype=int)
+    nsteps = numpy.zeros(n, dtype=int)
+    velocities = [None] * n
+
+    active = [i for i in range(n) if results[i] is None]
+    while active:
+        # 1. まとめて計算
+        evaluated = evaluate([atoms_list[i] for i in active], calculator, need_stress)
+        still_active = []
+        for i, result in zip(active, evaluated):
+            if isinstance(result, Exception):
+                results[i] = {"error": "".join(traceback.format_exception(result))}
+                continue
+            atoms_list[i].calc = SinglePointCalculator(atoms_list[i], **result)
+            still_active.append(i)
+        active = still_active
+        if not active:
+            break
+
+        # 2. 収束判定 (optimizer.run と同じく、ステップの前に判定する)
+        forces = [targets[i].get_forces() for i in active]
+        fmax_now = numpy.array([numpy.sqrt((f ** 2).sum(axis=1)).max() for f in forces])
+        done = (fmax_now < fmax) | (nsteps[active] >= max_steps)
+        for i, is_done, f in zip(active, done, fmax_now):
+            if recorders is not None:
+                recorders[i].record(int(nsteps[i]), force=bool(is_done))
+            if is_done:
+                results[i] = {
+                    "total_energy": float(atoms_list[i].get_potential_energy()),
+                    "converged": bool(f < fmax),
+                    "nsteps": int(nsteps[i]),
+                }
+        forces = [f for f, is_done in zip(forces, done) if not is_done]
+        active = [i for i, is_done in zip(active, done) if not is_done]
+        if not active:
+            break
+
+        # 3. FIRE の更新 (全構造の座標を連結して一度に計算)
+        idx = numpy.array(active)
+        sizes = numpy.array([len(f) for f in forces])
+        starts = numpy.concatenate([[0], numpy.cumsum(sizes)[:-1]])
+        seg = numpy.repeat(numpy.arange(len(active)), sizes)
+        F = numpy.concatenate(forces)
+        V = numpy.concatenate([
+            numpy.zeros_like(f) if velocities[i] is None else velocities[i] for i, f in zip(active, forces)
+        ])
+        first = numpy.array([velocities[i] is None for i in active])
+
+        vf = _segment_sum((F * V).sum(axis=1), starts)
+        f_norm = numpy.sqrt(_segment_sum((F * F).sum(axis=1), starts))
+        v_norm = numpy.sqrt(_segment_sum((V * V).sum(axis=1), starts))
+        a, d, npos = alpha[idx], dt[idx], n_positive[idx]
+
+        downhill = (vf > 0.0) & ~first
+        reset = ~downhill & ~first
+        mix = numpy.where(downhill, a, 0.0)
+        scale = numpy.where(f_norm > 0.0, mix * v_norm / numpy.where(f_norm > 0.0, f_norm, 1.0), 0.0)
+        V = numpy.where(downhill[seg, None], (1.0 - mix[seg, None]) * V + scale[seg, None] * F, V)
+        V[reset[seg]] = 0.0
+
+        speed_up = downhill & (npos > fire["Nmin"])
+        d = numpy.where(speed_up, numpy.minimum(d * fire["finc"], fire["dtmax"]), d)
+        a = numpy.where(speed_up, a * fire["fa"], a)
+        npos = numpy.where(downhill, npos + 1, npos)
+        d = numpy.where(reset, d * fire["fdec"], d)
+        a = numpy.where(reset, fire["astart"], a)
+        npos = numpy.where(reset, 0, npos)
+
+        V = V + d[seg, None] * F
+        dR = d[seg, None] * V
+        dr_norm = numpy.sqrt(_segment_sum((dR * dR).sum(axis=1), starts))
+        shrink = numpy.where(dr_norm > fire["maxstep"], fire["maxstep"] / numpy.where(dr_norm > 0, dr_norm, 1.0), 1.0)
+        dR = dR * shrink[seg, None]
+
+        alpha[idx], dt[idx], n_positive[idx] = a, d, npos
+        nsteps[idx] += 1
+        for k, i in enumerate(active):
+            block = slice(starts[k], starts[k] + sizes[k])
+            velocities[i] = V[block]
+            targets[i].set_positions(targets[i].get_positions() + dR[block])
+
+    for atoms in atoms_list:
+        atoms.set_constraint()
+    return results
+
+
+def relax_structures(structures: dict, parameters: dict, trajectory: dict = None) -> dict:
+    """
+    structures ({key: ase_relax.atoms_to_dict の辞書}) をまとめて緩和する。
+
+    Returns:
+        {key: ase_relax.relax_one と同じ形式の結果}
+    """
+    calculator = get_calculator(parameters)
+    keys = list(structures)
+    atoms_list = [ase_relax.atoms_from_dict(structures[key]) for key in keys]
+    recorders = [ase_relax.TrajectoryRecorder.from_settings(atoms, trajectory) for atoms in atoms_list]
+    results = relax_batch(atoms_list, parameters, calculator, recorders)
+    for atoms, recorder, result in zip(atoms_list, recorders, results):
+        if "error" not in result:
+            result["structure"] = ase_relax.atoms_to_dict(atoms)
+            if recorder.policy != "none":
+                result["trajectory"] = recorder.as_arrays()
+    return dict(zip(keys, results))
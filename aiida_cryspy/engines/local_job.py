@@ -0,0 +1,53 @@
+"""
+RelaxPackCalculation の engine='pool' / 'batched' のジョブで実行するスクリプト。
+
+    python -m aiida_cryspy.engines.local_job pool|batched
+
+ase_relax.py と同じ入力ファイル (ase_relax.INPUT_FILENAME) を読み、結果を同じ形式で
+results/<key>.json に書き出す (パーサーは共通)。
+  pool: プロセスプールで1構造ずつ緩和する (engines/local_pool.py)
+  batched: 全構造をまとめて FIRE で緩和する (engines/batch_relax.py)
+ase_relax.py と違い aiida_cryspy を import するため、aiida_cryspy がインストールされた Python で実行すること
+(optimization_WorkChain の executor='local' / 'batched' ではこのマシンの Python を使う)。
+"""
+import json
+import os
+import sys
+
+from aiida_cryspy.engines import ase_relax, batch_relax, local_pool
+
+ENGINES = ("pool", "batched")
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    engine = argv[0] if argv else "pool"
+    if engine not in ENGINES:
+        raise SystemExit(f"unknown engine `{engine}` (use one of {', '.join(ENGINES)})")
+
+    with open(ase_relax.INPUT_FILENAME) as handle:
+        data = json.load(handle)
+    parameters = data["parameters"]
+    trajectory = data.get("trajectory")
+    # 再実行時は終わった構造を飛ばす
+    structures = {
+        key: structure for key, structure in data["structures"].items()
+        if not os.path.isfile(os.path.join(ase_relax.RESULTS_DIRNAME, f"{key}.json"))
+    }
+    if not structures:
+        return 0
+
+    if engine == "batched":
+        results = batch_relax.relax_structures(structures, parameters, trajectory)
+    else:
+        try:
+            results = local_pool.relax_structures(structures, parameters, data.get("max_workers") or None, trajectory)
+        finally:
+            local_pool.shutdown_pool()
+    for key, result in results.items():
+        ase_relax.write_result(key, result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
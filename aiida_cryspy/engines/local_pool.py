@@ -0,0 +1,99 @@
+"""
+ASEの構造緩和をローカルのプロセスプールで実行する。
+
+concurrent.futures.ProcessPoolExecutor のワーカーで ase_relax.relax_one を実行する
+(RelaxPackCalculation の engine='pool' として、engines/local_job.py から使う)。
+各ワーカーは起動時に1度だけ calculator を作り、以降のタスクで使い回す
+(MLポテンシャルの読み込みは1ワーカーにつき1回)。
+プールはプロセスの終了時に閉じる。
+"""
+import atexit
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from aiida_cryspy.engines import ase_relax
+
+# ワーカープロセス内の calculator
+_worker_calculator = None
+_worker_parameters = None
+
+# このプロセスで使い回すプール (parameters が変わったら作り直す)
+_pool = None
+_pool_key = None
+
+
+def _init_worker(parameters: dict) -> None:
+    global _worker_calculator, _worker_parameters
+    _worker_parameters = parameters
+    _worker_calculator = ase_relax.build_calculator(parameters)
+
+
+def _relax_in_worker(structure: dict, trajectory: dict = None) -> dict:
+    return ase_relax.relax_one(structure, _worker_parameters, _worker_calculator, trajectory)
+
+
+def get_pool(parameters: dict, max_workers: int = None) -> ProcessPoolExecutor:
+    """
+    parameters の calculator を読み込んだワーカーのプールを返す。
+    同じ parameters と max_workers であれば前回のプールをそのまま使う。
+    """
+    global _pool, _pool_key
+    max_workers = max_workers or os.cpu_count()
+    key = (json.dumps(parameters, sort_keys=True), max_workers)
+    if _pool is not None and _pool_key == key:
+        return _pool
+    shutdown_pool()
+    # AiiDAのプロセス (イベントループ, DB接続) を fork しないように spawn で起動する
+    _pool = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(parameters,),
+    )
+    _pool_key = key
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool, _pool_key
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+    _pool = None
+    _pool_key = None
+
+
+atexit.register(shutdown_pool)
+
+
+def relax_structures(structures: dict, parameters: dict, max_workers: int = None, trajectory: dict = None) -> dict:
+    """
+    structures ({key: ase_relax.atoms_to_dict の辞書}) をプールで並列に緩和する。
+
+    ワーカーが異常終了した (BrokenProcessPool) 場合は、プールを作り直して終わっていない構造を
+    1つずつ緩和し直し、ワーカーを異常終了させた構造だけを失敗 ({'error': ...}) にする。
+
+    Returns:
+        {key: ase_relax.relax_one の結果}
+    """
+    pool = get_pool(parameters, max_workers)
+    futures = {key: pool.submit(_relax_in_worker, structure, trajectory) for key, structure in structures.items()}
+    results = {}
+    for key, future in futures.items():
+        try:
+            results[key] = future.result()
+        except BrokenProcessPool:
+            pass
+
+    retry = [key for key in structures if key not in results]
+    if retry:
+        shutdown_pool()
+    for key in retry:
+        try:
+            results[key] = get_pool(parameters, max_workers).submit(_relax_in_worker, structures[key], trajectory).result()
+        except BrokenProcessPool:
+            results[key] = {"error": f"the worker process terminated abruptly while relaxing `{key}`"}
+            shutdown_pool()
+    return {key: results[key] for key in structures}
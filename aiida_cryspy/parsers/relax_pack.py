@@ -0,0 +1,68 @@
+import json
+import os
+
+import numpy as np
+from aiida.orm import Dict
+from aiida.parsers import Parser
+from aiida.plugins import DataFactory
+
+from aiida_cryspy.engines import ase_relax
+
+StructureData = DataFactory("core.structure")
+CompressedTrajectoryData = DataFactory("aiida_cryspy.trajectory")
+
+
+class RelaxPackParser(Parser):
+    """
+    RelaxPackCalculation の results/<cryspy_id>.json を読み、
+    緩和後の構造とエネルギーを cryspy_id ごとに出力する。
+    失敗した構造があっても、成功した構造の結果は出力する。
+    軌跡 (results/<cryspy_id>.traj.npz) は一時的に回収したフォルダから読み、CompressedTrajectoryData にする。
+    """
+
+    def parse(self, **kwargs):
+        retrieved = self.retrieved
+        if ase_relax.RESULTS_DIRNAME not in retrieved.base.repository.list_object_names():
+            return self.exit_codes.ERROR_NO_RESULTS
+
+        temporary_folder = kwargs.get("retrieved_temporary_folder")
+        structures = {}
+        results = {}
+        trajectories = {}
+        failures = {}
+        for key in self.node.inputs.structures.keys():
+            path = f"{ase_relax.RESULTS_DIRNAME}/{key}.json"
+            try:
+                result = json.loads(retrieved.base.repository.get_object_content(path))
+            except FileNotFoundError:
+                failures[key] = "no result (the job may have been killed)"
+                continue
+            if "error" in result:
+                failures[key] = result["error"]
+                continue
+            structures[key] = StructureData(ase=ase_relax.atoms_from_dict(result.pop("structure")))
+            results[key] = Dict(result)
+            trajectory = self.parse_trajectory(temporary_folder, key)
+            if trajectory is not None:
+                trajectories[key] = trajectory
+
+        if structures:
+            self.out("structures", structures)
+            self.out("results", results)
+        if trajectories:
+            self.out("trajectories", trajectories)
+        if failures:
+            self.out("failures", Dict(failures))
+            self.logger.warning(f"relaxation failed for {len(failures)} structure(s): {sorted(failures)}")
+        if not structures:
+            return self.exit_codes.ERROR_ALL_STRUCTURES_FAILED
+
+    @staticmethod
+    def parse_trajectory(temporary_folder, key):
+        if temporary_folder is None:
+            return None
+        path = os.path.join(temporary_folder, ase_relax.RESULTS_DIRNAME, f"{key}{ase_relax.TRAJECTORY_SUFFIX}")
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as arrays:
+            return CompressedTrajectoryData({name: arrays[name] for name in arrays.files})
@@ -0,0 +1,48 @@
+"""
+アレイジョブをローカルのコアで実行するスケジューラ (SGE の代わりのテスト用)。
+
+core.direct と同様にジョブをローカルで実行するが、custom_scheduler_commands に
+SGE形式のアレイジョブ指定 (`#$ -t 1-N`) があれば、タスク 1..N を
+SGE_TASK_ID を設定して並列に実行する (同時に実行するタスク数は tot_num_mpiprocs)。
+各タスクの標準出力・標準エラーは SgeArrayScheduler と同じく `_scheduler-stdout.<タスクID>.txt` などに書く。
+"""
+from aiida.schedulers.plugins.direct import DirectScheduler
+
+from aiida_cryspy.schedulers.sge_array import ARRAY_DIRECTIVE, task_output_path
+
+
+class LocalArrayScheduler(DirectScheduler):
+    """core.direct + SGE形式のアレイジョブ"""
+
+    def get_submit_script(self, job_tmpl):
+        self._array_job = None
+        commands = job_tmpl.custom_scheduler_commands or ""
+        match = ARRAY_DIRECTIVE.search(commands)
+        if match:
+            self._array_job = (int(match.group(1)), int(match.group(2)), job_tmpl.job_resource.get_tot_num_mpiprocs())
+            self._task_outputs = (job_tmpl.sched_output_path, job_tmpl.sched_error_path)
+            job_tmpl.custom_scheduler_commands = ARRAY_DIRECTIVE.sub("", commands).strip()
+        try:
+            return super().get_submit_script(job_tmpl)
+        finally:
+            job_tmpl.custom_scheduler_commands = commands
+            self._array_job = None
+
+    def _get_run_line(self, codes_info, codes_run_mode):
+        run_line = super()._get_run_line(codes_info, codes_run_mode)
+        if not self._array_job:
+            return run_line
+
+        first, last, max_parallel = self._array_job
+        redirects = ""
+        for operator, path in zip((">", "2>"), self._task_outputs):
+            if path:
+                redirects += f' {operator} "{task_output_path(path, "${SGE_TASK_ID}")}"'
+        return "\n".join([
+            f"for SGE_TASK_ID in $(seq {first} {last}); do",
+            f"    while [ \"$(jobs -rp | wc -l)\" -ge {max_parallel} ]; do wait -n; done",
+            "    export SGE_TASK_ID",
+            f"    {run_line}{redirects} &",
+            "done",
+            "wait",
+        ])
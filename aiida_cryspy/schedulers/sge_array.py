@@ -0,0 +1,75 @@
+"""
+SGE のアレイジョブ (`#$ -t 1-N`) に対応したスケジューラ。
+
+core.sge のままアレイジョブを投入すると、`qsub -terse` が返す "<id>.1-N:1" がジョブIDとして保存されるが、
+qstat は各タスクを "<id>" として返すため、ジョブIDが一致せずに投入直後に終わったと判定される。
+SgeArrayScheduler は:
+
+- 投入時の出力からタスクの範囲を取り除いて "<id>" をジョブIDにする
+- qstat のタスクごとの行を1つのジョブにまとめる (どれかのタスクが残っている間は終わっていない)
+- 各タスクの標準出力・標準エラーを別のファイル (`_scheduler-stdout.<タスクID>.txt` など) に書く
+"""
+import os
+import re
+
+from aiida.schedulers.datastructures import JobState
+from aiida.schedulers.plugins.sge import SgeScheduler
+
+ARRAY_DIRECTIVE = re.compile(r"^#\$\s+-t\s+(\d+)-(\d+)\s*$", re.MULTILINE)
+
+# タスクの状態が混ざっている場合にジョブ全体の状態とする順番
+_STATE_PRIORITY = (
+    JobState.RUNNING,
+    JobState.SUSPENDED,
+    JobState.QUEUED,
+    JobState.QUEUED_HELD,
+    JobState.UNDETERMINED,
+    JobState.DONE,
+)
+
+
+def task_output_path(path: str, task_id: str) -> str:
+    """スケジューラの出力ファイル名にタスクIDを入れる ("_scheduler-stdout.txt" -> "_scheduler-stdout.<task_id>.txt")"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{task_id}{ext}"
+
+
+class SgeArrayScheduler(SgeScheduler):
+    """core.sge + アレイジョブ"""
+
+    def get_submit_script(self, job_tmpl):
+        if not ARRAY_DIRECTIVE.search(job_tmpl.custom_scheduler_commands or ""):
+            return super().get_submit_script(job_tmpl)
+
+        # SGE は -o / -e のパスの $TASK_ID をタスクIDに置き換える
+        output_path, error_path = job_tmpl.sched_output_path, job_tmpl.sched_error_path
+        if output_path:
+            job_tmpl.sched_output_path = task_output_path(output_path, "$TASK_ID")
+        if error_path:
+            job_tmpl.sched_error_path = task_output_path(error_path, "$TASK_ID")
+        try:
+            return super().get_submit_script(job_tmpl)
+        finally:
+            job_tmpl.sched_output_path, job_tmpl.sched_error_path = output_path, error_path
+
+    def _parse_submit_output(self, retval, stdout, stderr):
+        job_id = super()._parse_submit_output(retval, stdout, stderr)
+        # アレイジョブでは "<id>.<first>-<last>:<step>" が返る
+        return job_id.split(".", 1)[0]
+
+    def _parse_joblist_output(self, retval, stdout, stderr):
+        jobs = {}
+        for job in super()._parse_joblist_output(retval, stdout, stderr):
+            if job.job_id not in jobs:
+                jobs[job.job_id] = job
+                continue
+            merged = jobs[job.job_id]
+            states = [state for state in (merged.job_state, job.job_state) if state is not None]
+            if states:
+                merged.job_state = min(states, key=_STATE_PRIORITY.index)
+            if job.job_state == JobState.RUNNING and job.num_mpiprocs:
+                # core.sge は num_mpiprocs を文字列で返す
+                merged.num_mpiprocs = int(merged.num_mpiprocs or 0) + int(job.num_mpiprocs)
+            if not merged.queue_name and job.queue_name:
+                merged.queue_name = job.queue_name
+        return list(jobs.values())
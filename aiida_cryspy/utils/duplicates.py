@@ -0,0 +1,146 @@
+"""
+最適化後の構造の重複を、安価な記述子で候補を絞ってから StructureMatcher で判定するためのインデックス。
+
+蓄積した全構造に対して StructureMatcher を総当たりすると O(N^2) になるため、
+  1. 組成とエンタルピー (eV/atom) のバケットで候補を探す
+  2. 1原子あたりの体積と、ペア距離のヒストグラム (NumPy でまとめて計算) で候補を絞る
+  3. 残った少数の候補にだけ StructureMatcher.fit を使う
+の順に判定する。記述子は候補になった構造についてだけ計算し、インデックスの中で使い回す。
+
+記述子の許容誤差は、緩和後に同じ構造へ落ちたもの (体積・原子間距離がほぼ一致する) を対象にしている。
+StructureMatcher の既定の許容誤差 (ltol=0.2) では一致とみなされる、体積が1割程度違う構造は重複にしない。
+"""
+from collections import defaultdict
+
+import numpy as np
+from pymatgen.analysis.structure_matcher import StructureMatcher
+
+ENERGY_TOLERANCE = 0.01     # エンタルピーの差 [eV/atom]
+VOLUME_TOLERANCE = 0.05     # 1原子あたりの体積の相対差
+HISTOGRAM_TOLERANCE = 0.15  # ペア距離ヒストグラムの相対L1距離
+R_MAX = 6.0                 # ペア距離の最大値 [A]
+N_BINS = 60
+SIGMA = 0.1                 # ヒストグラムのガウス幅 [A]
+
+
+def composition_key(struc) -> tuple:
+    """組成 (元素ごとの原子数の比) のキー"""
+    composition = struc.composition.fractional_composition
+    return tuple(sorted((el.symbol, round(amount, 4)) for el, amount in composition.items()))
+
+
+def pair_distance_histogram(struc, r_max=R_MAX, n_bins=N_BINS, sigma=SIGMA) -> np.ndarray:
+    """
+    r_max 以内の全ペア距離 (周期境界を含む) をガウス関数でならしたヒストグラム (1原子あたり)。
+    原子の順番・セルの取り方・原点によらない。
+    """
+    lattice = struc.lattice.matrix
+    cart = np.asarray(struc.cart_coords)
+    # r_max を覆うのに必要なイメージの数 (各方向の面間隔から決める)
+    volume = abs(np.linalg.det(lattice))
+    spacing = volume / np.linalg.norm(np.cross(lattice[[1, 2, 0]], lattice[[2, 0, 1]]), axis=1)
+    n_images = np.ceil(r_max / spacing).astype(int)
+    shifts = np.array(np.meshgrid(*[np.arange(-n, n + 1) for n in n_images], indexing="ij")).reshape(3, -1).T
+    images = shifts @ lattice
+
+    diff = cart[None, :, None, :] - cart[:, None, None, :] + images[None, None, :, :]
+    distances = np.linalg.norm(diff, axis=-1).ravel()
+    distances = distances[(distances > 1e-8) & (distances < r_max + 3 * sigma)]
+
+    centers = (np.arange(n_bins) + 0.5) * (r_max / n_bins)
+    histogram = np.exp(-0.5 * ((distances[:, None] - centers[None, :]) / sigma) ** 2).sum(axis=0)
+    return histogram / len(cart)
+
+
+class DuplicateIndex:
+    """
+    index = DuplicateIndex()
+    for cid, struc in opt_struc_data.items():
+        dup = index.find_duplicate(struc, energies[cid])
+        if dup is None:
+            index.add(cid, struc, energies[cid])
+    """
+
+    def __init__(self, energy_tolerance=ENERGY_TOLERANCE, volume_tolerance=VOLUME_TOLERANCE,
+                 histogram_tolerance=HISTOGRAM_TOLERANCE, matcher=None):
+        self.energy_tolerance = energy_tolerance
+        self.volume_tolerance = volume_tolerance
+        self.histogram_tolerance = histogram_tolerance
+        self.matcher = matcher or StructureMatcher()
+        self._buckets = defaultdict(list) # (組成, エネルギーのバケット) -> [cid]
+        self._structures = {}
+        self._energies = {}
+        self._volumes = {}
+        self._histograms = {}
+        self.n_candidates = 0  # 記述子による絞り込みを通った候補の数 (StructureMatcher の呼び出し回数)
+
+    def __len__(self):
+        return len(self._structures)
+
+    def _bucket(self, energy):
+        return int(np.floor(energy / self.energy_tolerance))
+
+    def _histogram(self, cid):
+        if cid not in self._histograms:
+            self._histograms[cid] = pair_distance_histogram(self._structures[cid])
+        return self._histograms[cid]
+
+    def add(self, cid, struc, energy) -> None:
+        if struc is None or energy is None or np.isnan(energy):
+            return
+        self._structures[cid] = struc
+        self._energies[cid] = energy
+        self._volumes[cid] = struc.volume / len(struc)
+        self._buckets[(composition_key(struc), self._bucket(energy))].append(cid)
+
+    def candidates(self, struc, energy) -> list:
+        """記述子で絞り込んだ重複の候補 (ヒストグラムの距離が近い順)"""
+        if struc is None or energy is None or np.isnan(energy):
+            return []
+        key = composition_key(struc)
+        bucket = self._bucket(energy)
+        cids = [cid for b in (bucket - 1, bucket, bucket + 1) for cid in self._buckets.get((key, b), [])]
+        cids = [cid for cid in cids if abs(self._energies[cid] - energy) <= self.energy_tolerance]
+        volume = struc.volume / len(struc)
+        cids = [cid for cid in cids if abs(self._volumes[cid] - volume) <= self.volume_tolerance * volume]
+        if not cids:
+            return []
+
+        histogram = pair_distance_histogram(struc)
+        others = np.array([self._histogram(cid) for cid in cids])
+        distances = np.abs(others - histogram).sum(axis=1) / (others.sum(axis=1) + histogram.sum())
+        order = np.argsort(distances)
+        return [cids[i] for i in order if distances[i] <= self.histogram_tolerance]
+
+    def find_duplicate(self, struc, energy):
+        """インデックス内で struc と重複する構造の cid (無ければ None)"""
+        for cid in self.candidates(struc, energy):
+            self.n_candidates += 1
+            if self.matcher.fit(struc, self._structures[cid]):
+                return cid
+        return None
+
+
+def find_duplicates(opt_struc_data: dict, energies: dict, targets=None, index=None) -> dict:
+    """
+    targets (cid のリスト, 省略時は全構造) のうち、エネルギーがより低い構造と重複するものを探す。
+
+    Returns:
+        {重複した cid: 残す構造の cid}
+    """
+    targets = set(opt_struc_data) if targets is None else set(targets)
+    if index is None:
+        index = DuplicateIndex()
+    valid = [cid for cid in opt_struc_data
+             if opt_struc_data[cid] is not None and energies.get(cid) is not None and not np.isnan(energies[cid])]
+    duplicates = {}
+    # エネルギーの低い順にインデックスに追加し、既にある構造と重複するものを記録する
+    for cid in sorted(valid, key=lambda c: energies[c]):
+        struc, energy = opt_struc_data[cid], energies[cid]
+        if cid in targets:
+            kept = index.find_duplicate(struc, energy)
+            if kept is not None:
+                duplicates[cid] = kept
+                continue
+        index.add(cid, struc, energy)
+    return duplicates
@@ -0,0 +1,174 @@
+"""
+optimization_WorkChain の executor ごとに、構造緩和を行う子プロセスの builder を作るユーティリティ。
+
+  calcjob: code (aiida-ase) の CalcJob、structures があれば RelaxPackCalculation
+  local: RelaxPackCalculation (engine='pool') をこのマシンで実行し、プロセスプールで緩和する
+  batched: RelaxPackCalculation (engine='batched') をこのマシンで実行し、まとめて FIRE で緩和する
+
+local / batched も CalcJob として投入するので、緩和中に WorkChain (デーモンのワーカー) を止めず、
+デーモンを再起動しても続きから待てる。code を指定しなければ、このPythonを実行するコードを
+LOCAL_COMPUTER_LABEL のコンピュータ (core.local + core.direct) に作って使い回す。
+"""
+import os
+import sys
+import tempfile
+
+from aiida.common.exceptions import IntegrityError, NotExistent
+from aiida.orm import Computer, Dict, InstalledCode, QueryBuilder, Str, load_computer
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_cryspy.calculations.relax_pack import get_array_directive
+from aiida_cryspy.engines import ase_relax
+
+CompressedTrajectoryData = DataFactory("aiida_cryspy.trajectory")
+
+EXECUTORS = ("calcjob", "local", "batched")
+# local / batched executor の RelaxPackCalculation の engine
+LOCAL_ENGINES = {"local": "pool", "batched": "batched"}
+
+LOCAL_COMPUTER_LABEL = "aiida-cryspy-localhost"
+LOCAL_WORKDIR = os.path.join(tempfile.gettempdir(), "aiida_cryspy_local")
+# 1構造の緩和は数秒で終わることが多いので、既定 (10秒) より短い間隔で状態を確認する
+LOCAL_POLL_INTERVAL = 1.0
+# local / batched の1構造の場合の structures のキー
+SINGLE_KEY = "0"
+
+
+def validate_executor_inputs(inputs, _):
+    """executor と code の組み合わせ、trajectory_policy を確認する"""
+    executor = inputs["executor"].value if "executor" in inputs else "calcjob"
+    if executor not in EXECUTORS:
+        return f"unknown executor `{executor}` (use 'calcjob', 'local' or 'batched')."
+    if executor == "calcjob" and "code" not in inputs:
+        return "`code` is required for the calcjob executor."
+    if executor != "calcjob" and "array_job" in inputs and inputs["array_job"].value:
+        return "array_job requires the calcjob executor."
+    if "trajectory_policy" in inputs and inputs["trajectory_policy"].value not in ase_relax.TRAJECTORY_POLICIES:
+        return f"unknown trajectory_policy `{inputs['trajectory_policy'].value}` (use one of {', '.join(ase_relax.TRAJECTORY_POLICIES)})."
+
+
+def get_local_computer():
+    """LOCAL_COMPUTER_LABEL のコンピュータ (無ければ作る)"""
+    try:
+        return load_computer(LOCAL_COMPUTER_LABEL)
+    except NotExistent:
+        pass
+    computer = Computer(
+        label=LOCAL_COMPUTER_LABEL,
+        hostname="localhost",
+        description="relaxations of the aiida-cryspy local / batched executors",
+        transport_type="core.local",
+        scheduler_type="core.direct",
+        workdir=LOCAL_WORKDIR,
+    )
+    try:
+        computer.store()
+    except IntegrityError:
+        # 同時に作られた場合は先に保存された方を使う
+        return load_computer(LOCAL_COMPUTER_LABEL)
+    computer.set_minimum_job_poll_interval(LOCAL_POLL_INTERVAL)
+    computer.set_default_mpiprocs_per_machine(1)
+    computer.configure()
+    return computer
+
+
+def get_local_code():
+    """このPython (sys.executable) を LOCAL_COMPUTER_LABEL のコンピュータで実行するコード (無ければ作る)"""
+    computer = get_local_computer()
+    qb = QueryBuilder()
+    qb.append(Computer, filters={"id": computer.pk}, tag="computer")
+    qb.append(InstalledCode, with_computer="computer", filters={"attributes.filepath_executable": sys.executable})
+    qb.order_by({InstalledCode: {"id": "asc"}})
+    code = qb.first(flat=True)
+    if code is None:
+        code = InstalledCode(computer=computer, filepath_executable=sys.executable, label="python")
+        code.description = "Python running aiida_cryspy.engines.local_job"
+        code.store()
+    return code
+
+
+def get_trajectory_settings(inputs):
+    """エンジンに渡す軌跡の設定 (trajectory_policy が none の場合は None)"""
+    if inputs.trajectory_policy.value == "none":
+        return None
+    return Dict({"policy": inputs.trajectory_policy.value, "interval": inputs.trajectory_interval.value})
+
+
+def get_relax_builder(inputs):
+    """
+    optimization_WorkChain の inputs から緩和の子プロセスの builder を作る。
+    local / batched で structure (1構造) の場合は、SINGLE_KEY をキーにした structures として緩和する。
+    """
+    executor = inputs.executor.value
+    structures = dict(inputs.structures) if inputs.get("structures") else None
+
+    if executor in LOCAL_ENGINES:
+        builder = _get_pack_builder(inputs, inputs.code if "code" in inputs else get_local_code(),
+                                    structures or {SINGLE_KEY: inputs.structure})
+        builder.engine = Str(LOCAL_ENGINES[executor])
+        if executor == "local":
+            builder.max_workers = inputs.max_workers
+        return builder
+
+    code = inputs.code
+    if structures:
+        builder = _get_pack_builder(inputs, code, structures)
+        if inputs.array_job.value:
+            # 1構造を1タスクとするアレイジョブ
+            directive = get_array_directive(code.computer, len(structures))
+            custom_commands = builder.metadata.options.get("custom_scheduler_commands")
+            builder.metadata.options.custom_scheduler_commands = f"{custom_commands}\n{directive}" if custom_commands else directive
+            builder.array_job = inputs.array_job
+        return builder
+
+    builder = code.get_builder()
+    builder.structure = inputs.structure
+    builder.parameters = inputs.parameters
+    builder.metadata.options = inputs.options.get_dict()
+    builder.metadata.options.parser_name = "ase.ase"
+    # 軌跡は trajectory_policy が none 以外の場合だけ回収する (read_ase_trajectory で CompressedTrajectoryData にする)
+    retrieve_list = ["opt_struc.vasp"]
+    if inputs.trajectory_policy.value != "none":
+        retrieve_list.insert(0, "opt.traj")
+    builder.metadata.options.additional_retrieve_list = retrieve_list
+    return builder
+
+
+def _get_pack_builder(inputs, code, structures):
+    RelaxPackCalculation = CalculationFactory("aiida_cryspy.relax_pack")
+    builder = RelaxPackCalculation.get_builder()
+    builder.code = code
+    builder.structures = structures
+    builder.parameters = inputs.parameters
+    builder.metadata.options = inputs.options.get_dict()
+    trajectory = get_trajectory_settings(inputs)
+    if trajectory is not None:
+        builder.trajectory = trajectory
+    return builder
+
+
+def read_ase_trajectory(retrieved, policy: str, interval: int):
+    """
+    aiida-ase が回収した opt.traj から policy のフレームを CompressedTrajectoryData にする。
+    opt.traj が無い、またはフレームが無い場合は None を返す。
+    """
+    from ase.io import Trajectory
+
+    if "opt.traj" not in retrieved.base.repository.list_object_names():
+        return None
+    with retrieved.base.repository.as_path("opt.traj") as path:
+        images = Trajectory(str(path))
+        last = len(images) - 1
+        steps = [step for step in range(last + 1) if step == last or ase_relax.keep_frame(step, policy, interval)]
+        frames = [images[step] for step in steps]
+        images.close()
+    if not frames:
+        return None
+    # aiida-ase の軌跡は1フレームずつ atoms を持つので、recorder の atoms を差し替えて記録する
+    recorder = ase_relax.TrajectoryRecorder(frames[0], policy, interval)
+    for step, atoms in zip(steps, frames):
+        recorder.atoms = atoms
+        recorder.record(step, force=True)
+    trajectory = CompressedTrajectoryData(recorder.as_arrays())
+    trajectory.store()
+    return trajectory
@@ -0,0 +1,273 @@
+"""
+Groupに保存された構造を cryspy_id をキーにして読み込むためのユーティリティ。
+
+group.nodes を1つずつ辿ると (N+1回のORMアクセス) 世代が進むにつれて遅くなるため、
+QueryBuilderの1回のクエリで extras と必要な attributes をまとめて取得する。
+"""
+import numpy as np
+from aiida.manage import get_manager
+from aiida.orm import Group, QueryBuilder, load_node
+from aiida.orm.nodes.data.structure import Kind, create_automatic_kind_name
+from aiida.plugins import DataFactory
+from pymatgen.core import Element, Lattice, Structure
+
+StructureData = DataFactory("core.structure")
+
+_STRUCTURE_ATTRIBUTES = ("cell", "pbc1", "pbc2", "pbc3", "kinds", "sites")
+
+
+def _structure_query(group_pk, cryspy_ids=None, project=None):
+    """
+    group_pk のGroupに含まれ、extras に cryspy_id を持つ StructureData のクエリ。
+    cryspy_ids を与えた場合はDB側で絞り込む。
+    """
+    filters = {"extras": {"has_key": "cryspy_id"}}
+    if cryspy_ids is not None:
+        filters["extras.cryspy_id"] = {"in": [int(cid) for cid in cryspy_ids]}
+
+    qb = QueryBuilder()
+    qb.append(Group, filters={"id": group_pk}, tag="group")
+    qb.append(StructureData, with_group="group", filters=filters, tag="structure", project=project)
+    # 同じcryspy_idが複数ある場合は後から作られたノードを優先する (ループの最後で上書き)
+    qb.order_by({"structure": {"id": "asc"}})
+    return qb
+
+
+def structure_from_attributes(cell, pbc, kinds, sites) -> Structure:
+    """
+    StructureData の attributes から pymatgen.core.Structure を作る。
+    StructureData.get_pymatgen() と同じ結果になる (spinは扱わない)。
+    """
+    kinds = {kind["name"]: kind for kind in kinds}
+    species = []
+    kind_names = []
+    for site in sites:
+        kind = kinds[site["kind_name"]]
+        species.append(dict(zip(kind["symbols"], kind["weights"])))
+        kind_names.append(site["kind_name"])
+
+    additional_kwargs = {}
+    if any(create_automatic_kind_name(kind["symbols"], kind["weights"]) != name for name, kind in kinds.items()
+           if name in kind_names):
+        additional_kwargs["site_properties"] = {"kind_name": kind_names}
+
+    positions = [site["position"] for site in sites]
+    return Structure(Lattice(cell, pbc=pbc), species, positions, coords_are_cartesian=True, **additional_kwargs)
+
+
+def get_cryspy_id_map(group_pk, cryspy_ids=None) -> dict:
+    """
+    Returns:
+        {cryspy_id: node pk}
+    """
+    if cryspy_ids is not None and len(cryspy_ids) == 0:
+        return {}
+    qb = _structure_query(group_pk, cryspy_ids, project=["extras.cryspy_id", "id"])
+    return {cid: pk for cid, pk in qb.iterall()}
+
+
+def load_structures(group_pk, cryspy_ids=None) -> dict:
+    """
+    ノードを読み込まずに、1回のクエリで構造を取得する。
+
+    Args:
+        group_pk (int): PK of the group
+        cryspy_ids (Iterable[int]): これらのIDだけを取得する (default: 全て)
+
+    Returns:
+        {cryspy_id: pymatgen.core.Structure} (cryspy_id順)
+    """
+    if cryspy_ids is not None and len(cryspy_ids) == 0:
+        return {}
+    project = ["extras.cryspy_id"] + [f"attributes.{key}" for key in _STRUCTURE_ATTRIBUTES]
+    qb = _structure_query(group_pk, cryspy_ids, project=project)
+
+    structures = {}
+    for cid, cell, pbc1, pbc2, pbc3, kinds, sites in qb.iterall():
+        structures[cid] = structure_from_attributes(cell, (pbc1, pbc2, pbc3), kinds, sites)
+    return {cid: structures[cid] for cid in sorted(structures)}
+
+
+def load_structure_nodes(group_pk, cryspy_ids=None) -> dict:
+    """
+    Returns:
+        {cryspy_id: StructureData}
+    """
+    if cryspy_ids is not None and len(cryspy_ids) == 0:
+        return {}
+    qb = _structure_query(group_pk, cryspy_ids, project=["extras.cryspy_id", "*"])
+    return {cid: node for cid, node in qb.iterall()}
+
+
+def update_structures(group_pk, structures: dict, id_map: dict) -> tuple:
+    """
+    読み込み済みの構造辞書に、Groupに追加された (または別のノードに置き換わった)
+    cryspy_id の構造だけを追加で読み込む。
+    Groupに対しては cryspy_id と pk だけを取得する軽いクエリを1回行う。
+    結果は load_structures(group_pk) と同じになる。
+
+    Args:
+        group_pk (int): PK of the group
+        structures (dict): {cryspy_id: pymatgen.core.Structure} (読み込み済み)
+        id_map (dict): {cryspy_id: node pk} (structures の各構造を読み込んだノード)
+
+    Returns:
+        ({cryspy_id: pymatgen.core.Structure}, {cryspy_id: node pk})
+    """
+    new_id_map = get_cryspy_id_map(group_pk)
+    unchanged = {cid: struc for cid, struc in structures.items()
+                 if cid in new_id_map and id_map.get(cid) == new_id_map[cid]}
+
+    delta_ids = [cid for cid in new_id_map if cid not in unchanged]
+    unchanged.update(load_structures(group_pk, delta_ids))
+
+    # load_structures と同じ順番 (cryspy_id順) に揃える
+    updated = {cid: unchanged[cid] for cid in sorted(new_id_map)}
+    return updated, new_id_map
+
+
+def load_structures_incremental(group_pk, snapshot=None) -> tuple:
+    """
+    前回のスナップショット (StructureCollectionData) + 差分だけを読み込む。
+    結果は load_structures(group_pk) と同じになる。
+
+    Args:
+        group_pk (int): PK of the group
+        snapshot (StructureCollectionData): make_snapshot() で作ったスナップショット
+
+    Returns:
+        ({cryspy_id: pymatgen.core.Structure}, {cryspy_id: node pk})
+    """
+    structures = {}
+    id_map = {}
+    if snapshot is not None and snapshot.base.attributes.get("group_pk", None) == group_pk:
+        structures, id_map = load_snapshot(snapshot)
+    return update_structures(group_pk, structures, id_map)
+
+
+def make_snapshot(group_pk, structures: dict, id_map: dict, previous=None):
+    """
+    load_structures_incremental() / update_structures() の結果からスナップショットを作る (未保存)。
+
+    previous (同じGroupの保存済みのスナップショット) を与えた場合は、previous から変わった構造
+    (追加された、または別のノードに置き換わった cryspy_id) だけを保存し、previous のUUIDを属性 'previous' に持つ。
+    Groupから無くなった cryspy_id は属性 'removed' に記録する。
+    世代ごとに全ての履歴を保存しないので、DBの大きさは世代数に比例する。
+    site_properties は kind_name だけが保存される (StructureCollectionData を参照)。
+
+    Returns:
+        StructureCollectionData
+    """
+    StructureCollectionData = DataFactory("aiida_cryspy.structurecollection")
+    previous_map = {}
+    if previous is not None and previous.base.attributes.get("group_pk", None) == group_pk:
+        previous_map = snapshot_id_map(previous)
+    else:
+        previous = None
+
+    delta = {cid: struc for cid, struc in structures.items() if previous_map.get(cid) != id_map[cid]}
+    snapshot = StructureCollectionData(delta)
+    snapshot.set_array("node_pks", np.array([id_map[cid] for cid in delta], dtype=np.int64))
+    snapshot.base.attributes.set("group_pk", group_pk)
+    snapshot.base.attributes.set("n_structures", len(structures))
+    if previous is not None:
+        snapshot.base.attributes.set("previous", previous.uuid)
+        snapshot.base.attributes.set("removed", sorted(int(cid) for cid in previous_map if cid not in id_map))
+    return snapshot
+
+
+def _snapshot_chain(snapshot) -> list:
+    """snapshot から previous をたどったスナップショットのリスト (新しい順)"""
+    chain = [snapshot]
+    while chain[-1].base.attributes.get("previous", None) is not None:
+        chain.append(load_node(chain[-1].base.attributes.get("previous")))
+    return chain
+
+
+def snapshot_id_map(snapshot) -> dict:
+    """
+    スナップショットの時点の {cryspy_id: node pk} (構造は読み込まない)。
+    """
+    id_map = {}
+    for node in reversed(_snapshot_chain(snapshot)):
+        for cid in node.base.attributes.get("removed", []):
+            id_map.pop(cid, None)
+        id_map.update(zip(node.ids, node.get_array("node_pks").tolist()))
+    return dict(sorted(id_map.items()))
+
+
+def load_snapshot(snapshot, cryspy_ids=None) -> tuple:
+    """
+    スナップショットの時点の構造 (previous をたどって差分を重ねる)。
+    新しいスナップショットから順に、まだ決まっていない cryspy_id の構造だけを読み込む。
+
+    Args:
+        snapshot (StructureCollectionData): make_snapshot() で作ったスナップショット
+        cryspy_ids (Iterable[int]): これらのIDだけを取得する (default: 全て)
+
+    Returns:
+        ({cryspy_id: pymatgen.core.Structure} (cryspy_id順), {cryspy_id: node pk})
+    """
+    wanted = None if cryspy_ids is None else {int(cid) for cid in cryspy_ids}
+    structures = {}
+    id_map = {}
+    resolved = set()
+    for node in _snapshot_chain(snapshot):
+        ids = [cid for cid in node.ids if cid not in resolved and (wanted is None or cid in wanted)]
+        if ids:
+            structures.update(node.get_structurecollection(ids=ids))
+            node_pks = dict(zip(node.ids, node.get_array("node_pks").tolist()))
+            id_map.update((cid, node_pks[cid]) for cid in ids)
+            resolved.update(ids)
+        resolved.update(node.base.attributes.get("removed", []))
+    order = sorted(structures)
+    return {cid: structures[cid] for cid in order}, {cid: id_map[cid] for cid in order}
+
+
+def structuredata_from_pymatgen(struc: Structure):
+    """
+    pymatgen.core.Structure から StructureData を作る (未保存)。
+
+    秩序構造で site_properties が無い場合 (CrySPYが生成する構造) は、
+    append_atom() を1原子ずつ呼ばずに kinds と sites の attributes を直接作る。
+    結果は StructureData(pymatgen=struc) と同じになる。それ以外は StructureData(pymatgen=struc) を使う。
+    """
+    species = struc.species if struc.is_ordered else None
+    if species is None or struc.site_properties or not all(isinstance(sp, Element) for sp in species):
+        return StructureData(pymatgen=struc)
+
+    s_node = StructureData(cell=struc.lattice.matrix.tolist(), pbc=[True, True, True])
+    symbols = [sp.symbol for sp in species]
+    kinds = [Kind(symbols=symbol, weights=1.0).get_raw() for symbol in dict.fromkeys(symbols)]
+    sites = [{"kind_name": symbol, "position": position} for symbol, position in zip(symbols, struc.cart_coords.tolist())]
+    s_node.base.attributes.set("kinds", kinds)
+    s_node.base.attributes.set("sites", sites)
+    return s_node
+
+
+def store_structures(structures: dict, group) -> dict:
+    """
+    {cryspy_id: pymatgen.core.Structure} をまとめて StructureData に変換して保存し、Groupに追加する。
+
+    cryspy_id は保存前に extras に設定し、全ノードの保存とGroupへの追加を
+    1つのトランザクションで行う (途中で失敗した場合は何も保存されない)。
+
+    Args:
+        structures (dict): {cryspy_id: pymatgen.core.Structure}
+        group (Group): stored group
+
+    Returns:
+        {cryspy_id: StructureData}
+    """
+    nodes = {}
+    for cid, pmg_struct in structures.items():
+        s_node = structuredata_from_pymatgen(pmg_struct)
+        s_node.base.extras.set("cryspy_id", cid) # IDを付与
+        nodes[cid] = s_node
+
+    storage = get_manager().get_profile_storage()
+    with storage.transaction():
+        for s_node in nodes.values():
+            s_node.store()
+        group.add_nodes(list(nodes.values()))
+    return nodes
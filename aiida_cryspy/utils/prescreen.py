@@ -0,0 +1,52 @@
+"""
+multi_structure_optimize_WorkChain の事前スクリーニング (安価な計算で構造を順位付けし、上位だけを本緩和する)。
+
+事前スクリーニングで外した構造、緩和に失敗した構造は、CrySPY の失敗した構造と同じく
+opt_struc_data を None、エネルギーを NaN として rslt_data に登録する (親・エリートにはならない)。
+"""
+import copy
+import math
+
+from ase.units import GPa  # 圧力の単位（GPa）をASEの内部単位(eV/Å^3)に変換
+
+# 事前スクリーニングで本緩和から外した構造の rslt_data の Opt 列の値
+PRESCREEN_REJECTED = "prescreened"
+# 緩和 (事前スクリーニングを含む) に失敗した構造の rslt_data の Opt 列の値
+RELAX_FAILED = "failed"
+
+
+def prescreen_parameters(parameters: dict, steps: int) -> dict:
+    """事前スクリーニングの parameters (optimizer.run_args.steps を steps にしたコピー)"""
+    parameters = copy.deepcopy(parameters)
+    optimizer = parameters.setdefault("optimizer", {})
+    optimizer.setdefault("run_args", {})["steps"] = steps
+    return parameters
+
+
+def enthalpy_per_atom(energy: float, struc, target_pressure_gpa: float) -> float:
+    """1原子あたりのエンタルピー H = (E + PV) / N [eV/atom] (P=0 なら E/N)"""
+    return (energy + (target_pressure_gpa * GPa) * struc.volume) / struc.num_sites
+
+
+def select(enthalpies: dict, keep_fraction=None, window=None):
+    """
+    エンタルピーの低い順に並べ、本緩和する構造と外す構造に分ける。
+
+    Args:
+        enthalpies (dict): {cid: 1原子あたりのエンタルピー [eV/atom]}
+        keep_fraction (float): 上位のこの割合 (切り上げ) を残す
+        window (float): 最良の構造からこのエンタルピー差 [eV/atom] 以内を残す
+
+    Returns:
+        (kept, rejected): どちらもエンタルピーの低い順の cid のリスト
+    """
+    ranked = sorted(enthalpies, key=enthalpies.get)
+    keep = set()
+    if keep_fraction is not None:
+        keep.update(ranked[:math.ceil(keep_fraction * len(ranked))])
+    if window is not None and ranked:
+        best = enthalpies[ranked[0]]
+        keep.update(cid for cid in ranked if enthalpies[cid] - best <= window)
+    kept = [cid for cid in ranked if cid in keep]
+    rejected = [cid for cid in ranked if cid not in keep]
+    return kept, rejected
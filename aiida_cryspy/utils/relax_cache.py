@@ -0,0 +1,169 @@
+"""
+構造緩和の結果を、初期構造の正規化したフィンガープリントと parameters のハッシュで再利用するためのユーティリティ。
+
+EAの交叉・置換・歪みで作られた構造は、既に緩和した構造と対称的に等価なことが多い。
+原子の順番・セルの取り方・原点が違うと AiiDA のノードのハッシュは一致しないため、
+  1. spglib で標準化した primitive cell を Niggli 簡約する
+  2. 最も少ない元素の各原子を原点にした分率座標を許容誤差で丸め、(元素, 座標) でソートする
+     (原点の選び方と、Niggli簡約で残る軸の符号・入れ替えによらないように、辞書順で最小のものを使う)
+  3. 格子定数を許容誤差で丸める
+で作った文字列のハッシュを使う。丸めの境界にある構造は一致しない (再計算される) だけで、
+異なる構造が一致することはない。
+
+緩和後の StructureData の extras に
+  cryspy_relax_key: 初期構造のフィンガープリントと parameters のハッシュ
+  cryspy_total_energy: 緩和後の全エネルギー [eV]
+を保存し、QueryBuilder で検索する (実行・世代をまたいで再利用できる)。
+"""
+import hashlib
+import itertools
+import json
+
+import numpy as np
+from aiida.orm import Dict, QueryBuilder, load_node
+from aiida.plugins import DataFactory
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+StructureData = DataFactory("core.structure")
+
+RELAX_KEY_EXTRA = "cryspy_relax_key"
+ENERGY_EXTRA = "cryspy_total_energy"
+
+SYMPREC = 0.01          # spglib の許容誤差 [A]
+FRAC_TOLERANCE = 1e-3   # 分率座標の丸め
+LENGTH_TOLERANCE = 1e-2 # 格子の長さの丸め [A]
+ANGLE_TOLERANCE = 0.1   # 格子の角度の丸め [deg]
+
+
+def _bucket(values, tolerance):
+    return np.rint(np.asarray(values) / tolerance).astype(np.int64)
+
+
+def _signed_permutations():
+    """行列式が +1 の符号付き置換行列 (24個)"""
+    matrices = []
+    for perm in itertools.permutations(range(3)):
+        for signs in itertools.product((1, -1), repeat=3):
+            matrix = np.zeros((3, 3), dtype=int)
+            matrix[range(3), perm] = signs
+            if round(np.linalg.det(matrix)) == 1:
+                matrices.append(matrix)
+    return matrices
+
+
+_SIGNED_PERMUTATIONS = _signed_permutations()
+
+
+def _equivalent_bases(matrix):
+    """格子 matrix (行ベクトル) と同じ計量を持つ基底の取り方 (符号付き置換行列)"""
+    metric = matrix @ matrix.T
+    scale = LENGTH_TOLERANCE * max(np.sqrt(np.diag(metric)))
+    return [m for m in _SIGNED_PERMUTATIONS if np.allclose(m @ metric @ m.T, metric, atol=scale)]
+
+
+def canonical_structure(struc, symprec=SYMPREC):
+    """標準化した primitive cell を Niggli 簡約した構造 (spglib が失敗した場合は Niggli 簡約のみ)"""
+    try:
+        struc = SpacegroupAnalyzer(struc, symprec=symprec).get_primitive_standard_structure()
+    except Exception:
+        pass
+    return struc.get_reduced_structure()
+
+
+def structure_fingerprint(struc, symprec=SYMPREC) -> str:
+    """pymatgen.core.Structure の正規化したフィンガープリント (sha256)"""
+    struc = canonical_structure(struc, symprec)
+    symbols = [site.specie.symbol for site in struc]
+    elements = sorted(set(symbols))
+    species = np.array([elements.index(symbol) for symbol in symbols])
+    frac = np.asarray(struc.frac_coords)
+
+    n_buckets = int(round(1 / FRAC_TOLERANCE))
+    counts = np.bincount(species)
+    origin_species = int(np.argmin(np.where(counts > 0, counts, len(species) + 1)))
+    best = None
+    for basis in _equivalent_bases(struc.lattice.matrix):
+        # 新しい基底 basis @ A での分率座標は frac @ inv(basis)
+        frac_in_basis = frac @ np.linalg.inv(basis).round().astype(int)
+        for origin in np.flatnonzero(species == origin_species):
+            buckets = _bucket((frac_in_basis - frac_in_basis[origin]) % 1.0, FRAC_TOLERANCE) % n_buckets
+            rows = sorted(zip(species.tolist(), *buckets.T.tolist()))
+            if best is None or rows < best:
+                best = rows
+
+    lattice = struc.lattice
+    canonical = {
+        "elements": elements,
+        "lengths": _bucket(lattice.abc, LENGTH_TOLERANCE).tolist(),
+        "angles": _bucket(lattice.angles, ANGLE_TOLERANCE).tolist(),
+        "sites": best,
+    }
+    return hashlib.sha256(json.dumps(canonical).encode()).hexdigest()
+
+
+def parameters_hash(parameters: dict) -> str:
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+
+def relax_key(struc, parameters: dict) -> str:
+    """初期構造 struc (pymatgen) を parameters で緩和した結果のキー"""
+    return f"{structure_fingerprint(struc)}:{parameters_hash(parameters)}"
+
+
+def lookup(keys) -> dict:
+    """
+    keys に一致する緩和済みの構造を1回のクエリで探す。
+
+    Returns:
+        {key: (緩和後の StructureData の pk, 全エネルギー [eV])} (見つかったキーのみ)
+    """
+    keys = list(set(keys))
+    if not keys:
+        return {}
+    qb = QueryBuilder()
+    qb.append(
+        StructureData,
+        filters={f"extras.{RELAX_KEY_EXTRA}": {"in": keys}},
+        project=[f"extras.{RELAX_KEY_EXTRA}", "id", f"extras.{ENERGY_EXTRA}"],
+        tag="structure",
+    )
+    qb.order_by({"structure": {"id": "asc"}})
+    found = {}
+    for key, pk, energy in qb.iterall():
+        found.setdefault(key, (pk, energy)) # 最初に緩和したものを使う
+    return found
+
+
+def tag_relaxed(structure_node, key: str, energy: float) -> None:
+    """緩和後の構造にキーとエネルギーを記録する"""
+    structure_node.base.extras.set_many({RELAX_KEY_EXTRA: key, ENERGY_EXTRA: energy})
+
+
+def split_cached(structure_map: dict, parameters: dict):
+    """
+    structure_map ({cid: 初期構造の StructureData}) を、緩和キャッシュにあるものと無いものに分ける。
+
+    Returns:
+        keys: {cid: キー}
+        hits: {cid: (緩和後の StructureData の pk, 全エネルギー [eV])}
+        misses: {cid: StructureData} (緩和が必要な構造)
+    """
+    keys = {cid: relax_key(node.get_pymatgen(), parameters) for cid, node in structure_map.items()}
+    found = lookup(keys.values())
+    hits = {cid: found[key] for cid, key in keys.items() if key in found}
+    misses = {cid: node for cid, node in structure_map.items() if cid not in hits}
+    return keys, hits, misses
+
+
+def clone_cached(cached_pk: int, energy: float):
+    """
+    緩和キャッシュにあった構造を複製する (同じノードを複数のGroup・cryspy_idで使わないため)。
+
+    Returns:
+        (parameters の Dict {'total_energy', 'cached_from'}, 緩和後の StructureData) (どちらも保存済み)
+    """
+    structure_node = load_node(cached_pk).clone()
+    structure_node.store()
+    parameters_node = Dict({"total_energy": energy, "cached_from": cached_pk})
+    parameters_node.store()
+    return parameters_node, structure_node
@@ -0,0 +1,315 @@
+"""
+CrySPY のファイル入出力を探索 (run) ごとのディレクトリで行うためのユーティリティ。
+
+CrySPY は cryspy.in, data/pkl_data/*.pkl, log_cryspy, lock_cryspy などを全てカレントディレクトリに読み書きする。
+デーモンのカレントディレクトリをそのまま使うと1つのディレクトリで1つの探索しか実行できないため、
+  - ファイルは run_uuid (探索を初期化した initialize_workchain の UUID) ごとのディレクトリ (サンドボックス) に置き、
+    CrySPY を呼び出す間だけそのディレクトリに移動する
+  - CrySPY の呼び出しは、AiiDA の DB 上のロック (ラベル LOCK_GROUP_PREFIX + run_uuid の Group) を取ってから行う
+    (Group のラベルは DB で一意なので、同じ探索の子プロセスが別のデーモンワーカーにあっても同時には入らない)
+  - ロックが取れないステップは待たずに抜け (SandboxBusy)、SandboxLockMixin が LOCK_POLL_INTERVAL 後に同じステップをやり直す
+    (ワーカーのイベントループを止めないので、同じデーモンワーカーの他のプロセスは待っている間も進む)
+サンドボックスの場所は環境変数 SANDBOX_ROOT_VARIABLE (無ければ AiiDA の設定ディレクトリの下の cryspy_runs)。
+"""
+import asyncio
+import contextlib
+import functools
+import os
+import pathlib
+import pickle
+import time
+
+import plumpy
+from aiida.common.exceptions import IntegrityError, NotExistent
+from aiida.engine import WorkChain
+from aiida.manage.configuration import get_config
+from aiida.orm import Group, load_group, load_node
+
+SANDBOX_ROOT_VARIABLE = "AIIDA_CRYSPY_SANDBOX_ROOT"
+SANDBOX_DIRNAME = "cryspy_runs"
+LOCK_GROUP_PREFIX = "cryspy_lock_"
+LOCK_TIMEOUT = 300.0     # ロックを待つ最大の時間 [s]
+LOCK_POLL_INTERVAL = 0.2 # [s]
+CRYSPY_INPUT_FILENAME = "cryspy.in"
+CRYSPY_STAT_FILENAME = "cryspy.stat"
+PKL_DIRNAME = os.path.join("data", "pkl_data") # CrySPY の pickle のディレクトリ (サンドボックスからの相対パス)
+
+
+class RunLockedError(Exception):
+    """探索のロックを LOCK_TIMEOUT 以内に取れなかった"""
+
+
+class SandboxBusy(Exception):
+    """探索のロックを他のプロセスが持っている (SandboxLockMixin がステップをやり直す)"""
+
+    def __init__(self, run_uuid: str):
+        super().__init__(f"the CrySPY run {run_uuid} is locked by another process")
+        self.run_uuid = run_uuid
+
+
+# このプロセス (デーモンワーカー) で持っているロック {(run_uuid, holder の UUID)}
+_held_locks = set()
+
+
+def get_sandbox_root() -> pathlib.Path:
+    root = os.environ.get(SANDBOX_ROOT_VARIABLE)
+    if root:
+        return pathlib.Path(root).expanduser()
+    return pathlib.Path(get_config().dirpath) / SANDBOX_DIRNAME
+
+
+def get_sandbox(run_uuid: str) -> pathlib.Path:
+    """run_uuid のサンドボックスのパス (作成はしない)"""
+    return get_sandbox_root() / run_uuid
+
+
+def prepare_sandbox(run_uuid: str, cryspy_in: bytes) -> pathlib.Path:
+    """サンドボックスを作り、cryspy.in を書き込む"""
+    sandbox = get_sandbox(run_uuid)
+    sandbox.mkdir(parents=True, exist_ok=True)
+    (sandbox / CRYSPY_INPUT_FILENAME).write_bytes(cryspy_in)
+    return sandbox
+
+
+def seed_sandbox(run_uuid: str, pickles: dict, status: dict, cryspy_in: bytes = None) -> pathlib.Path:
+    """
+    保存済みのデータから新しいサンドボックスを作る (EA_WorkChain の restart_from)。
+    pickles {name: object} を PKL_DIRNAME/<name>.pkl に、status {key: value} を cryspy.stat の [status] に書く。
+    cryspy_in (元の探索の cryspy.in) は無くてもよい (CrySPY は pickle の input_data を使う)。
+    """
+    sandbox = get_sandbox(run_uuid)
+    (sandbox / PKL_DIRNAME).mkdir(parents=True, exist_ok=True)
+    if cryspy_in is not None:
+        (sandbox / CRYSPY_INPUT_FILENAME).write_bytes(cryspy_in)
+    for name, value in pickles.items():
+        with (sandbox / PKL_DIRNAME / f"{name}.pkl").open("wb") as handle:
+            pickle.dump(value, handle)
+    lines = ["[status]"] + [f"{key} = {value}" for key, value in status.items()]
+    (sandbox / CRYSPY_STAT_FILENAME).write_text("\n".join(lines) + "\n")
+    return sandbox
+
+
+def is_initialized(run_uuid: str) -> bool:
+    """サンドボックスで CrySPY の初期化が済んでいるか (cryspy.stat があるか)"""
+    return (get_sandbox(run_uuid) / CRYSPY_STAT_FILENAME).is_file()
+
+
+def _lock_label(run_uuid: str) -> str:
+    return f"{LOCK_GROUP_PREFIX}{run_uuid}"
+
+
+def _is_stale(lock_group) -> bool:
+    """
+    ロックを保持しているプロセスが終わっている (または無い)。
+    保持している時間では判断しない (長い CrySPY の呼び出しの途中でロックを奪わないため)。
+    """
+    try:
+        holder = load_node(lock_group.base.extras.get("holder"))
+    except (NotExistent, TypeError, ValueError):
+        return True
+    return holder.is_terminated
+
+
+def try_acquire_lock(run_uuid: str, holder) -> bool:
+    """
+    探索のロックを取る (取れなければ False)。holder はロックを取るプロセスのノード。
+    異常終了したプロセスが残したロックは外してから取り直す。
+    holder 自身が持っているロック (ワーカーが落ちてチェックポイントから再開した場合) はそのまま取れる。
+    """
+    label = _lock_label(run_uuid)
+    lock_group = Group(label=label, description=f"CrySPY file lock held by {holder.process_label}<{holder.pk}>")
+    lock_group.base.extras.set("holder", holder.uuid) # pk は削除後に再利用されることがあるので UUID
+    try:
+        lock_group.store()
+    except IntegrityError:
+        try:
+            existing = load_group(label=label)
+        except NotExistent:
+            return False # 他のプロセスが外した直後 (次の試行で取る)
+        if existing.base.extras.get("holder", None) == holder.uuid:
+            return True
+        if _is_stale(existing):
+            Group.collection.delete(existing.pk)
+        return False
+    return True
+
+
+def release_lock(run_uuid: str) -> None:
+    try:
+        Group.collection.delete(load_group(label=_lock_label(run_uuid)).pk)
+    except NotExistent:
+        pass
+
+
+def is_locked(run_uuid: str) -> bool:
+    try:
+        existing = load_group(label=_lock_label(run_uuid))
+    except NotExistent:
+        return False
+    return not _is_stale(existing)
+
+
+def load_pickle(name: str, default=None):
+    """
+    cryspy_sandbox の中で、サンドボックスの CrySPY の pickle (PKL_DIRNAME/<name>.pkl) を読み込む。
+    無ければ default を返す。
+    """
+    try:
+        with open(os.path.join(PKL_DIRNAME, f"{name}.pkl"), "rb") as handle:
+            return pickle.load(handle)
+    except FileNotFoundError:
+        return default
+
+
+def dump_pickle(name: str, value) -> None:
+    """cryspy_sandbox の中で、サンドボックスの CrySPY の pickle (PKL_DIRNAME/<name>.pkl) を書き込む"""
+    with open(os.path.join(PKL_DIRNAME, f"{name}.pkl"), "wb") as handle:
+        pickle.dump(value, handle)
+
+
+def load_registered(opt_struc_data, rslt_data):
+    """
+    cryspy_sandbox の中で、サンドボックスの最新の opt_struc_data / rslt_data を読み込む (無ければ引数を返す)。
+    同じ探索の他のプロセスが登録した行を消さないよう、regist_opt にはこれを渡す。
+    """
+    return load_pickle("opt_struc_data", opt_struc_data), load_pickle("rslt_data", rslt_data)
+
+
+def _acquire_locks(run_uuids, holder) -> list:
+    """
+    run_uuids のロックを全て取り、新しく取った run_uuid のリストを返す (holder が既に持っているものは数えない)。
+    1つでも取れなければ、取ったものを外して SandboxBusy を送出する (持ったまま待たないのでデッドロックしない)。
+    """
+    acquired = []
+    try:
+        for run_uuid in sorted({run_uuid for run_uuid in run_uuids if run_uuid is not None}):
+            if (run_uuid, holder.uuid) in _held_locks:
+                continue
+            if not try_acquire_lock(run_uuid, holder):
+                raise SandboxBusy(run_uuid)
+            _held_locks.add((run_uuid, holder.uuid))
+            acquired.append(run_uuid)
+    except BaseException:
+        _release_locks(acquired, holder)
+        raise
+    return acquired
+
+
+def _release_locks(run_uuids, holder) -> None:
+    for run_uuid in reversed(run_uuids):
+        _held_locks.discard((run_uuid, holder.uuid))
+        release_lock(run_uuid)
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def locked_step(get_run_uuids):
+    """
+    @sandbox.locked_step(lambda self: [self.ctx.run_uuid])
+    @timing.timed_step
+    def step(self):
+        ...
+
+    get_run_uuids(self) の探索のロックを全て取ってからステップを実行し、終わったら外す。
+    ステップの中の cryspy_sandbox はロックを取り直さない。
+    取れなければステップの最初で SandboxBusy を送出する (SandboxLockMixin が後でやり直す)。
+    ステップが子プロセスの投入などをしてからサンドボックスに入る場合や、複数の探索のサンドボックスに入る場合に使う。
+    """
+    def decorator(step):
+        @functools.wraps(step)
+        def wrapper(self, *args, **kwargs):
+            acquired = _acquire_locks(get_run_uuids(self), self.node)
+            try:
+                return step(self, *args, **kwargs)
+            finally:
+                _release_locks(acquired, self.node)
+        return wrapper
+    return decorator
+
+
+class SandboxLockMixin:
+    """
+    class MyWorkChain(SandboxLockMixin, WorkChain):
+
+    ステップが SandboxBusy を送出したら、WAITING 状態で LOCK_POLL_INTERVAL 待ってから同じステップをやり直す
+    (ステップが例外を送出すると outline は進まない)。
+    待ち始めた時刻は ctx に残り、LOCK_TIMEOUT を過ぎたら RunLockedError で終わる。
+    イベントループのタイマーだけで待つので、plumpy のバージョンによらずループを止めない。
+    """
+    _LOCK_WAIT_KEY = "_sandbox_lock_wait"
+
+    def _do_step(self):
+        try:
+            result = super()._do_step()
+        except SandboxBusy as exception:
+            started = self.ctx.setdefault(self._LOCK_WAIT_KEY, time.time())
+            if time.time() - started > LOCK_TIMEOUT:
+                raise RunLockedError(f"could not lock the CrySPY run {exception.run_uuid} within {LOCK_TIMEOUT} s") from exception
+            return plumpy.Wait(self._do_step, f"Waiting for the lock of the CrySPY run {exception.run_uuid}")
+        self.ctx.pop(self._LOCK_WAIT_KEY, None)
+        return result
+
+    def on_wait(self, awaitables):
+        if self._LOCK_WAIT_KEY in self.ctx and not self._awaitables:
+            # WorkChain.on_wait はすぐに resume するので飛ばす
+            super(WorkChain, self).on_wait(awaitables)
+            self._schedule_lock_retry()
+        else:
+            super().on_wait(awaitables)
+
+    def load_instance_state(self, saved_state, load_context):
+        super().load_instance_state(saved_state, load_context)
+        if self._LOCK_WAIT_KEY in self.ctx:
+            self._schedule_lock_retry()
+
+    def _schedule_lock_retry(self):
+        self.loop.call_later(LOCK_POLL_INTERVAL, self._retry_locked_step)
+
+    def _retry_locked_step(self):
+        if self.state == plumpy.ProcessState.WAITING:
+            self.resume()
+
+
+@contextlib.contextmanager
+def cryspy_sandbox(run_uuid: str, holder, timeout: float = LOCK_TIMEOUT):
+    """
+    with cryspy_sandbox(rin_node.run_uuid, self.node):
+        ctrl_job.regist_opt(...)
+
+    ロックを取ってサンドボックスに移動し、抜けるときに元のディレクトリに戻ってロックを外す。
+    run_uuid が None (サンドボックスを使わない RinData) の場合はカレントディレクトリのまま何もしない。
+    holder が locked_step で既にロックを持っていれば、そのまま入る。
+    ロックが取れない場合、イベントループの上 (WorkChain のステップ) では待たずに SandboxBusy を送出し
+    (SandboxLockMixin がステップをやり直す)、それ以外 (スクリプトなど) では timeout まで待つ。
+    中では AiiDA のプロセスを待たないこと (ディレクトリの移動はプロセス全体に効くため)。
+    """
+    if run_uuid is None:
+        yield None
+        return
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            acquired = _acquire_locks([run_uuid], holder)
+            break
+        except SandboxBusy:
+            if _in_event_loop():
+                raise
+            if time.monotonic() > deadline:
+                raise RunLockedError(f"could not lock the CrySPY run {run_uuid} within {timeout} s")
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    cwd = os.getcwd()
+    sandbox = get_sandbox(run_uuid)
+    try:
+        os.chdir(sandbox)
+        yield sandbox
+    finally:
+        os.chdir(cwd)
+        _release_locks(acquired, holder)
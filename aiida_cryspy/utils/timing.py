@@ -0,0 +1,162 @@
+"""
+WorkChain のステップの時間を、プロセスのノードの extras に記録するユーティリティ。
+
+verdi process report の文字列ではなく、QueryBuilder で検索できる形で残す:
+  - プロセスのノード: STEP_TIMING_EXTRA = {ステップ名: {'calls', 'seconds', 'first_start', 'last_end', 'items', 'nbytes'}}
+    (ステップを @timed_step で修飾する。items, nbytes はステップの中で count() を呼んで加える)
+  - 最適化済みの構造のノード: STRUCTURE_TIMING_EXTRA = {'process', 'submit', 'start', 'finish', 'registered'}
+    (緩和した子プロセスの投入・計算開始・計算終了と、CrySPY に登録した時刻)
+時刻は全て UNIX 時間 [s]。
+generation_timeline() で EA_WorkChain 全体の世代ごとの時間の内訳にまとめる。
+
+    qb = QueryBuilder().append(WorkChainNode, filters={'extras.cryspy_timing.collect_results.seconds': {'>': 10.0}})
+"""
+import functools
+import json
+import time
+
+from aiida.orm import CalcJobNode, CalculationNode
+
+STEP_TIMING_EXTRA = "cryspy_timing"
+STRUCTURE_TIMING_EXTRA = "cryspy_structure_timing"
+
+
+def timed_step(func):
+    """
+    WorkChain のステップの開始・終了時刻を self.node の extras に記録するデコレータ。
+
+        @timed_step
+        def submit_window(self):
+            ...
+            timing.count(self, items=len(structure_map))
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self._timing_counts = {"items": 0, "nbytes": 0}
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            record_step(self.node, func.__name__, start, time.time(), **self._timing_counts)
+            self._timing_counts = None
+    return wrapper
+
+
+def count(process, items=0, nbytes=0) -> None:
+    """実行中のステップ (timed_step) の処理した数と書き込んだバイト数に加える"""
+    counts = getattr(process, "_timing_counts", None)
+    if counts is not None:
+        counts["items"] += items
+        counts["nbytes"] += nbytes
+
+
+def node_nbytes(*nodes) -> int:
+    """ノードの属性 (JSON) とリポジトリのファイルの合計のバイト数"""
+    nbytes = 0
+    for node in nodes:
+        nbytes += len(json.dumps(node.base.attributes.all, default=str))
+        for dirpath, _, filenames in node.base.repository.walk():
+            for filename in filenames:
+                nbytes += len(node.base.repository.get_object_content(str(dirpath / filename), mode="rb"))
+    return nbytes
+
+
+def record_step(node, step, start, end, items=0, nbytes=0) -> None:
+    timings = node.base.extras.get(STEP_TIMING_EXTRA, {})
+    entry = timings.setdefault(step, {"calls": 0, "seconds": 0.0, "first_start": start, "last_end": end, "items": 0, "nbytes": 0})
+    entry["calls"] += 1
+    entry["seconds"] += end - start
+    entry["last_end"] = end
+    entry["items"] += items
+    entry["nbytes"] += nbytes
+    node.base.extras.set(STEP_TIMING_EXTRA, timings)
+
+
+def process_interval(node) -> dict:
+    """
+    プロセスの投入 (ノードの作成)・開始・終了の時刻。
+    開始・終了は timed_step で記録したステップの時刻 (記録が無ければノードの作成・更新時刻)。
+    """
+    submit = node.ctime.timestamp()
+    timings = node.base.extras.get(STEP_TIMING_EXTRA, {})
+    return {
+        "process": node.pk,
+        "submit": submit,
+        "start": min((entry["first_start"] for entry in timings.values()), default=submit),
+        "finish": max((entry["last_end"] for entry in timings.values()), default=node.mtime.timestamp()),
+    }
+
+
+def relaxation_interval(node) -> dict:
+    """
+    緩和の子プロセス (optimization_WorkChain) の投入・計算開始・計算終了の時刻。
+    CalcJob はスケジューラのジョブ情報 (あれば) を、calcfunction (local / batched) はノードの作成・更新時刻を
+    計算の時間とする。どちらも無ければ process_interval() と同じ。
+    """
+    interval = process_interval(node)
+    for child in node.called:
+        if isinstance(child, CalcJobNode):
+            job_info = child.get_last_job_info()
+            if job_info is not None and job_info.dispatch_time is not None:
+                interval["start"] = job_info.dispatch_time.timestamp()
+            if job_info is not None and job_info.finish_time is not None:
+                interval["finish"] = job_info.finish_time.timestamp()
+        elif isinstance(child, CalculationNode):
+            interval["start"], interval["finish"] = child.ctime.timestamp(), child.mtime.timestamp()
+    return interval
+
+
+def generation_timeline(ea_node) -> list:
+    """
+    EA_WorkChain (または island_EA_WorkChain) の子プロセスの記録を世代ごとにまとめる。
+
+    Returns:
+        [{'gen', 'start', 'end', 'steps': {プロセス名.ステップ名: 秒},
+          'structures': 構造の数, 'queue_wait': 投入から計算開始までの秒 (平均), 'compute': 計算の秒 (平均),
+          'processes': [{'pk', 'process_label', 'label', 'submit', 'start', 'finish'}]}]
+        gen 0 は初期化。世代の区切りは子プロセスの入力の detail_data の世代 (next_sg はその世代の後の次世代生成)。
+        island_EA_WorkChain では全ての島をまとめる。
+    """
+    generations = {}
+    for child in ea_node.called:
+        gen = _process_generation(child)
+        if gen is None:
+            continue
+        entry = generations.setdefault(gen, {"gen": gen, "steps": {}, "processes": [], "intervals": []})
+        interval = process_interval(child)
+        entry["processes"].append(dict(interval, process_label=child.process_label, label=child.label))
+        for step, timing in child.base.extras.get(STEP_TIMING_EXTRA, {}).items():
+            key = f"{child.process_label}.{step}"
+            entry["steps"][key] = entry["steps"].get(key, 0.0) + timing["seconds"]
+        for grandchild in child.called:
+            if grandchild.process_label == "optimization_WorkChain":
+                # packed mode の子プロセスは、中の構造の数だけ数える
+                n_structures = len(grandchild.inputs.structures) if "structures" in grandchild.inputs else 1
+                entry["intervals"].extend([relaxation_interval(grandchild)] * n_structures)
+
+    timeline = []
+    for gen in sorted(generations):
+        entry = generations.pop(gen)
+        intervals = entry.pop("intervals")
+        entry["start"] = min(process["submit"] for process in entry["processes"])
+        entry["end"] = max(process["finish"] for process in entry["processes"])
+        entry["structures"] = len(intervals)
+        entry["queue_wait"] = _mean([interval["start"] - interval["submit"] for interval in intervals])
+        entry["compute"] = _mean([interval["finish"] - interval["start"] for interval in intervals])
+        timeline.append(entry)
+    return timeline
+
+
+def _process_generation(node):
+    if node.process_label == "initialize_workchain":
+        return 0
+    if "detail_data" not in node.inputs:
+        return None
+    detail_data = node.inputs.detail_data
+    if hasattr(detail_data, "gen"):
+        return detail_data.gen
+    return detail_data.get_dict().get("ea_data", [None])[0]
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
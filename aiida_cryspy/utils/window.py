@@ -0,0 +1,95 @@
+"""
+WorkChainで「実行中の子プロセスを max_concurrent 個に保つ」スライディングウィンドウのためのMixin。
+
+WorkChainの ToContext / to_context は登録した子プロセスが全て終わるまで待つため、
+固定サイズのバッチでは一番遅い子プロセスが終わるまで次の投入ができない。
+SlidingWindowMixin は while_ ループの1回ごとに、実行中の子プロセスのどれか1つが終わるまで待つ (wait-any):
+
+- 既に終わった子プロセスがあれば何も待たずに次のステップへ進む
+  (同時に終わった子プロセスは次のステップでまとめて処理される)
+- なければ WAITING 状態になり、最初に終わった子プロセスの通知で次のステップへ進む
+
+子プロセスの終了の通知 (runner.call_on_process_finish) は子プロセスごとに1回だけ登録する
+(ループの1回ごとに登録し直すと、実行中の子プロセスの数だけ購読とポーリングが増えていくため)。
+待っている子プロセスのPKは ctx に残るので、チェックポイントから再開しても通知を登録し直して待ち続ける。
+"""
+import functools
+
+import plumpy
+from aiida.engine import WorkChain
+
+
+class SlidingWindowMixin:
+    """
+    WorkChainと一緒に継承する:
+
+        class MyWorkChain(SlidingWindowMixin, WorkChain):
+            @classmethod
+            def define(cls, spec):
+                ...
+                spec.outline(while_(cls.has_work)(cls.submit_step, cls.process_step))
+
+            def submit_step(self):
+                ...  # 実行中が max_concurrent 個になるまで投入する
+                self.wait_for_next(running_nodes)
+
+            def process_step(self):
+                self.clear_wait()
+                ...  # is_terminated の子プロセスを全て処理する
+    """
+
+    _WAIT_KEY = "window_wait" # ctx: 待っている子プロセスのPKのリスト
+
+    def wait_for_next(self, nodes) -> None:
+        """
+        nodes (ProcessNodeのリスト) のうち、次のステップで処理するものが出るまで待つ。
+        既に終わっているノードが含まれていれば (または nodes が空なら) 待たない。
+        """
+        nodes = list(nodes)
+        if not nodes or any(node.is_terminated for node in nodes):
+            return
+        self.ctx[self._WAIT_KEY] = [node.pk for node in nodes]
+        for node in nodes:
+            self._subscribe_window_child(node.pk)
+        self._window_wait_requested = True
+
+    def clear_wait(self) -> None:
+        """wait_for_next() で context に入った値を削除する (次のステップの最初に呼ぶ)"""
+        if self._WAIT_KEY in self.ctx:
+            del self.ctx[self._WAIT_KEY]
+
+    def _do_step(self):
+        self._window_wait_requested = False
+        result = super()._do_step()
+        if self._window_wait_requested and isinstance(result, plumpy.Continue):
+            return plumpy.Wait(self._do_step, "Waiting for one of the running child processes")
+        return result
+
+    def on_wait(self, awaitables):
+        if self._window_wait_requested and not self._awaitables:
+            # WorkChain.on_wait はすぐに resume するので飛ばす (子プロセスの通知で resume する)
+            super(WorkChain, self).on_wait(awaitables)
+        else:
+            super().on_wait(awaitables)
+
+    def load_instance_state(self, saved_state, load_context):
+        super().load_instance_state(saved_state, load_context)
+        self._window_wait_requested = False
+        for pk in self.ctx.get(self._WAIT_KEY, None) or []:
+            self._subscribe_window_child(pk)
+
+    def _subscribe_window_child(self, pk) -> None:
+        """子プロセス pk が終わったら _on_window_child_finished が呼ばれるようにする (pk ごとに1回)"""
+        subscribed = getattr(self, "_window_subscribed", None)
+        if subscribed is None:
+            subscribed = self._window_subscribed = set()
+        if pk in subscribed:
+            return
+        subscribed.add(pk)
+        self.runner.call_on_process_finish(pk, functools.partial(self.call_soon, self._on_window_child_finished, pk))
+
+    def _on_window_child_finished(self, pk) -> None:
+        self._window_subscribed.discard(pk)
+        waiting_for = self.ctx.get(self._WAIT_KEY, None) or []
+        if pk in waiting_for and self.state == plumpy.ProcessState.WAITING:
+            self.resume()
@@ -1,16 +1,41 @@
-from aiida.engine import WorkChain, ToContext, while_
+import time
+
+import pandas as pd
+from aiida.engine import WorkChain, ToContext, if_, while_
 from aiida.plugins import WorkflowFactory, DataFactory
-from aiida.orm import Int, Str, Code, Dict, load_group
+from aiida.orm import Bool, Float, Int, List, Str, Code, Dict, Group, load_group, load_node
+
+from aiida_cryspy.utils import sandbox, timing
+from aiida_cryspy.utils.groups import load_structure_nodes, load_structures
+from aiida_cryspy.utils.window import SlidingWindowMixin
 
 # 各WorkChainをインポート
 InitializeWorkChain = WorkflowFactory("aiida_cryspy.initial_structures")
 MultiStructureOptimizeWorkChain = WorkflowFactory("aiida_cryspy.optimize_structures")
 NextSgWorkChain = WorkflowFactory("aiida_cryspy.next_sg")
 PandasFrameData = DataFactory("aiida_cryspy.dataframe")
+RinData = DataFactory("aiida_cryspy.rin_data")
+SinglefileData = DataFactory("core.singlefile")
 
-class EA_WorkChain(WorkChain):
+class EA_WorkChain(SlidingWindowMixin, WorkChain):
     """
     AiiDA-CrySPYの進化的アルゴリズム(EA)全体を統括するWorkChain。
+
+    steady_state=True の場合は世代ごとに全構造の最適化を待たない:
+    最適化は steady_state_batch 構造ずつの子プロセスとして投入し、空きができるたびに次を投入する。
+    待ち行列が空になった時点で、それまでに終わった結果 (前回の次世代生成以降の分) から
+    次世代を生成して投入する。世代は rslt_data の Gen 列の記録としてだけ使う
+    (最適化が終わった構造の Gen は、その時点の世代に付け替える)。
+    同時に実行される最適化の子プロセスは、探索のサンドボックスの pickle (opt_struc_data, rslt_data) に
+    ロックの中で「最新の pickle を読み込み、1行を加えて書き戻す」ことで登録する
+    (multi_structure_optimize_WorkChain.regist_opt)。そのため終わる順番によらず全ての行が残る。
+    次世代の生成 (next_sg_WorkChain) には pickle ではなく、process_offspring でまとめた rslt_data を渡す。
+
+    restart_from (前回の EA_WorkChain の PK) を与えた場合は initialize_workchain を実行せず、
+    保存済みの出力から restart_generation 世代 (省略時は開始できる最新の世代) の最適化の直前の状態を作って再開する。
+    CrySPY のファイルは、この WorkChain の UUID の新しいサンドボックスにその世代のノードから作り直す
+    (元の探索のサンドボックスは先の世代まで進んでいることがあるため使わない)。
+    その世代の最適化が途中で止まっていれば、終わっている緩和はやり直さない。
     """
     @classmethod
     def define(cls, spec):
@@ -19,35 +44,174 @@ class EA_WorkChain(WorkChain):
         # --- Inputs ---
         spec.input("max_generations", valid_type=Int, default=lambda: Int(50))
         spec.input("cryspy_in_filename", valid_type=Str, default=lambda: Str("cryspy_in"))
-        spec.input("code", valid_type=Code)
+        spec.input("cryspy_in_file", valid_type=SinglefileData, required=False, help="cryspy.in の内容 (デーモンのカレントディレクトリに依存しない)")
+        spec.input("code", valid_type=Code, required=False, help="構造最適化のコード (executor='local' では不要)")
         spec.input("parameters", valid_type=Dict)
         spec.input("options", valid_type=Dict)
+        spec.input("max_concurrent", valid_type=Int, required=False, help="同時に実行する構造最適化の最大数")
+        spec.input("pack_size", valid_type=Int, required=False, help="1つのジョブで緩和する構造の数")
+        spec.input("pack_walltime", valid_type=Int, required=False, help="1つのジョブの目標実行時間 [s] (pack_size の代わりに指定)")
+        spec.input("seconds_per_structure", valid_type=Int, required=False, help="1構造の緩和にかかる時間の目安 [s]")
+        spec.input("array_job", valid_type=Bool, required=False, help="構造最適化をアレイジョブとして投入する")
+        spec.input("executor", valid_type=Str, required=False, help="'calcjob', 'local' (ローカルのプロセスプールで緩和) または 'batched' (まとめて FIRE で緩和)")
+        spec.input("max_workers", valid_type=Int, required=False, help="executor='local' のワーカープロセス数")
+        spec.input("use_relax_cache", valid_type=Bool, required=False, help="対称的に等価な構造の緩和結果を再利用する")
+        spec.input("prescreen", valid_type=Bool, required=False, help="1点計算 (または短い緩和) で順位付けし、上位の構造だけを本緩和する")
+        spec.input("prescreen_steps", valid_type=Int, required=False, help="事前スクリーニングの optimizer のステップ数 (0: 1点計算)")
+        spec.input("prescreen_keep_fraction", valid_type=Float, required=False, help="本緩和する構造の割合 (エンタルピーの低い順)")
+        spec.input("prescreen_window", valid_type=Float, required=False, help="最良の構造からこのエンタルピー [eV/atom] 以内の構造を本緩和する")
+        spec.input("trajectory_policy", valid_type=Str, required=False, help="残す緩和の軌跡: 'none', 'last', 'every' (trajectory_interval ステップごと) または 'full'")
+        spec.input("trajectory_interval", valid_type=Int, required=False, help="trajectory_policy='every' で残すフレームの間隔")
+        spec.input("prune_duplicates", valid_type=Bool, required=False, help="エネルギーがより低い構造と重複する親を次世代の生成に使わない")
+        spec.input("steady_state", valid_type=Bool, default=lambda: Bool(False), help="世代の区切りで最適化の終了を待たずに次世代を生成する")
+        spec.input("steady_state_batch", valid_type=Int, default=lambda: Int(1), help="steady_state で1つの最適化の子プロセスに入れる構造の数")
+        spec.input("steady_state_fraction", valid_type=Float, default=lambda: Float(0.5), help="steady_state で次世代を生成するのに必要な、新しく終わった構造の数 (n_pop に対する割合)")
+        spec.input("restart_from", valid_type=Int, required=False, help="再開する EA_WorkChain のPK (initialize_workchain は実行しない)")
+        spec.input("restart_generation", valid_type=Int, required=False, help="再開する世代 (省略時は開始できる最新の世代)")
+        spec.inputs.validator = validate_restart_inputs
 
         # --- Outputs ---
         spec.output("optimized_structures_group_pk", valid_type=Int, help="全世代の最適化済み構造が蓄積されたGroupのPK")
         spec.output("final_rslt_data", valid_type=PandasFrameData, help="最終結果データ")
+        spec.output("timeline", valid_type=Dict, required=False, help="経過時間ごとの最適化済み構造の数と最良のエンタルピー、1時間あたりの最適化数")
+
+        spec.exit_code(400, "ERROR_RESTART_NOT_POSSIBLE", message="The generation {gen} of EA_WorkChain<{pk}> cannot be restarted: {reason}")
+        spec.exit_code(401, "ERROR_NO_OPTIMIZATION_FINISHED", message="No optimization finished, so there is no timeline.")
 
         # --- Outline ---
         spec.outline(
-            cls.run_initialize,         # 1. 初期化実行
-            cls.setup_initial_context,  # 2. 初期化結果をコンテキストにセット
-            while_(cls.should_continue_ea)(
-                cls.run_optimization,   # 3. 最適化実行
-                cls.update_opt_data,    # 4. 最適化結果をコンテキストに反映
-                cls.run_next_generation,# 5. 次世代生成実行
-                cls.update_next_data,   # 6. 次世代生成結果をコンテキストに反映
+            cls.setup,
+            if_(cls.is_restart)(
+                cls.setup_restart_context,  # 保存済みの出力からコンテキストを作る
+            ).else_(
+                cls.run_initialize,         # 1. 初期化実行
+                cls.setup_initial_context,  # 2. 初期化結果をコンテキストにセット
+            ),
+            if_(cls.is_steady_state)(
+                while_(cls.should_continue_steady_state)(
+                    cls.submit_offspring,   # 空いている分だけ最適化を投入し、1つが終わるまで待つ
+                    cls.process_offspring,  # 終わった最適化の結果を rslt_data に反映
+                    if_(cls.should_generate)(
+                        cls.run_next_generation,
+                        cls.update_next_data,
+                    ),
+                ),
+            ).else_(
+                while_(cls.should_continue_ea)(
+                    cls.run_optimization,   # 3. 最適化実行
+                    cls.update_opt_data,    # 4. 最適化結果をコンテキストに反映
+                    cls.run_next_generation,# 5. 次世代生成実行
+                    cls.update_next_data,   # 6. 次世代生成結果をコンテキストに反映
+                ),
+                cls.run_final_optimization, # 7. 最終世代の最適化
             ),
-            cls.run_final_optimization, # 7. 最終世代の最適化
             cls.finalize,               # 8. 完了処理
         )
 
+    @timing.timed_step
+    def setup(self):
+        self.ctx.start_time = time.time()
+        self.ctx.timeline = [] # [経過時間 [s], 最適化済み構造の数, 最良のエンタルピー [eV/atom]]
+        self.ctx.resume_from = None # 再開した世代の中断した最適化 (最初の最適化で一度だけ使う)
+
+    def is_restart(self):
+        return "restart_from" in self.inputs
+
+    @timing.timed_step
+    def setup_restart_context(self):
+        """
+        restart_from の EA_WorkChain (再開したものなら、その再開元もたどる) の出力から、
+        restart_generation 世代の最適化の直前のコンテキストを作る。
+
+        最適化済み構造のGroupは、その時点の rslt_data にある構造だけを新しいGroupに入れる
+        (前回それより先の世代まで進んでいた場合に、同じ cryspy_id の構造が混ざらないようにする)。
+        """
+        pk = self.inputs.restart_from.value
+        gen = self.inputs.restart_generation.value if "restart_generation" in self.inputs else None
+        start = find_generation_start(load_node(pk), gen)
+        if isinstance(start, str):
+            return self.exit_codes.ERROR_RESTART_NOT_POSSIBLE.format(gen=gen or "(latest)", pk=pk, reason=start)
+
+        self.ctx.current_structures_group_pk = start["current_structures_group_pk"]
+        self.ctx.rslt_data = start["rslt_data"]
+        self.ctx.detail_data = start["detail_data"]
+        self.ctx.id_queueing = start["id_queueing"]
+        self.ctx.resume_from = start["resume_from"]
+
+        previous_group_pk = start["optimized_structures_group_pk"].value
+        optimized_group = Group(label=f"cryspy_optimized_{self.uuid}")
+        optimized_group.store()
+        nodes = load_structure_nodes(previous_group_pk, self.ctx.rslt_data.df.index.tolist())
+        optimized_group.add_nodes(list(nodes.values()))
+        optimized_group_pk = Int(optimized_group.pk)
+        optimized_group_pk.store()
+        self.ctx.optimized_structures_group_pk = optimized_group_pk
+
+        self.ctx.cryspy_in = self.seed_restart_sandbox(start)
+
+        message = f"Restarting generation {self.ctx.detail_data.gen} of EA_WorkChain<{pk}> ({len(nodes)} optimized structures"
+        if self.ctx.resume_from is not None:
+            message += f", resuming the optimization <{self.ctx.resume_from}>"
+        self.report(message + ").")
+
+    def seed_restart_sandbox(self, start):
+        """
+        find_generation_start() の世代の開始時点の CrySPY の pickle (init_struc_data, opt_struc_data, rslt_data,
+        id_queueing, gen と EAData の elite_struc, elite_fitness, ea_info, ea_origin) を
+        新しいサンドボックス (run_uuid はこの WorkChain の UUID) に書き、その run_uuid の RinData を返す。
+        """
+        rin = start["cryspy_in"].rin
+        gen, elite_struc, elite_fitness, ea_info, ea_origin = start["detail_data"].ea_data
+        rslt_data = start["rslt_data"].df
+        id_queueing = list(start["id_queueing"])
+
+        init_struc_data = {}
+        for group_pk in start["init_structures_group_pks"]:
+            init_struc_data.update(load_structures(group_pk))
+        # 緩和しなかった構造 (Groupに無い) は None
+        opt_struc_data = dict.fromkeys(rslt_data.index.tolist())
+        opt_struc_data.update(load_structures(self.ctx.optimized_structures_group_pk.value))
+
+        cryspy_in = None
+        previous_run_uuid = start["cryspy_in"].run_uuid
+        if previous_run_uuid is not None:
+            path = sandbox.get_sandbox(previous_run_uuid) / sandbox.CRYSPY_INPUT_FILENAME
+            if path.is_file():
+                cryspy_in = path.read_bytes()
+
+        path = sandbox.seed_sandbox(
+            self.uuid,
+            {
+                "input_data": rin,
+                "gen": gen,
+                "init_struc_data": init_struc_data,
+                "opt_struc_data": opt_struc_data,
+                "rslt_data": rslt_data,
+                "id_queueing": id_queueing,
+                "elite_struc": elite_struc,
+                "elite_fitness": elite_fitness,
+                "ea_info": ea_info,
+                "ea_origin": ea_origin,
+            },
+            {"generation": gen, "id_queueing": " ".join(str(cid) for cid in id_queueing)},
+            cryspy_in=cryspy_in,
+        )
+        self.report(f"Seeded the sandbox {path} from generation {gen}.")
+        rin_node = RinData(rin, run_uuid=self.uuid)
+        rin_node.store()
+        return rin_node
+
+    @timing.timed_step
     def run_initialize(self):
         """初期構造生成 WorkChainの実行"""
         self.report("[Step 1] Running InitializeWorkChain...")
         inputs = {'cryspy_in_filename': self.inputs.cryspy_in_filename}
+        if "cryspy_in_file" in self.inputs:
+            inputs["cryspy_in_file"] = self.inputs.cryspy_in_file
         running = self.submit(InitializeWorkChain, **inputs)
         return ToContext(init_wc=running)
 
+    @timing.timed_step
     def setup_initial_context(self):
         """InitializeWorkChainが作成したGroupのPKやデータをコンテキストに保存"""
         outputs = self.ctx.init_wc.outputs
@@ -62,15 +226,30 @@ class EA_WorkChain(WorkChain):
         self.ctx.optimized_structures_group_pk = outputs.optimized_structures_group_pk
         self.ctx.cryspy_in = outputs.cryspy_in
 
+        if self.inputs.steady_state.value:
+            n_pop = self.ctx.cryspy_in.rin.n_pop
+            self.ctx.slots = self.inputs.max_concurrent.value if "max_concurrent" in self.inputs else n_pop
+            self.ctx.queue = list(self.ctx.id_queueing) # 最適化を待っている構造 (current_structures_group_pk の構造)
+            self.ctx.in_flight = {} # 実行中の最適化 {pk: [cryspy_id]}
+            self.ctx.new_results = 0 # 前回の次世代生成以降に最適化が終わった構造の数
+
     def should_continue_ea(self):
         """世代数の判定"""
-        current_gen = self.ctx.detail_data.ea_data[0]
+        current_gen = self.ctx.detail_data.gen
         max_gen = self.inputs.max_generations.value
         self.report(f"--- Generation {current_gen} / {max_gen} ---")
         return current_gen < max_gen
 
-    def run_optimization(self):
-        """構造最適化 WorkChainの実行"""
+    # MultiStructureOptimizeWorkChain にそのまま渡す入力
+    _OPTIMIZATION_OPTIONS = (
+        "code", "max_concurrent", "pack_size", "pack_walltime", "seconds_per_structure",
+        "array_job", "executor", "max_workers", "use_relax_cache",
+        "prescreen", "prescreen_steps", "prescreen_keep_fraction", "prescreen_window",
+        "trajectory_policy", "trajectory_interval",
+    )
+
+    def get_optimization_inputs(self):
+        """MultiStructureOptimizeWorkChain の入力"""
         inputs = {
             "initial_structures_group_pk": self.ctx.current_structures_group_pk,
             "optimized_structures_group_pk": self.ctx.optimized_structures_group_pk, # 蓄積用Groupを渡す
@@ -78,17 +257,35 @@ class EA_WorkChain(WorkChain):
             "cryspy_in": self.ctx.cryspy_in,
             "detail_data": self.ctx.detail_data,
             "id_queueing": self.ctx.id_queueing,
-            "code": self.inputs.code,
             "parameters": self.inputs.parameters,
             "options": self.inputs.options,
         }
-        running = self.submit(MultiStructureOptimizeWorkChain, **inputs)
+        if "opt_struc_snapshot" in self.ctx:
+            inputs["opt_struc_snapshot"] = self.ctx.opt_struc_snapshot
+        if self.ctx.resume_from is not None:
+            inputs["resume_from"] = Int(self.ctx.resume_from)
+            self.ctx.resume_from = None
+        for name in self._OPTIMIZATION_OPTIONS:
+            if name in self.inputs:
+                inputs[name] = self.inputs[name]
+        return inputs
+
+    @timing.timed_step
+    def run_optimization(self):
+        """構造最適化 WorkChainの実行"""
+        running = self.submit(MultiStructureOptimizeWorkChain, **self.get_optimization_inputs())
         return ToContext(opt_wc=running)
 
+    @timing.timed_step
     def update_opt_data(self):
-        """最適化後の結果でコンテキストの rslt_data を更新"""
-        self.ctx.rslt_data = self.ctx.opt_wc.outputs.rslt_data
+        """最適化後の結果でコンテキストの rslt_data とスナップショットを更新"""
+        outputs = self.ctx.opt_wc.outputs
+        self.ctx.rslt_data = outputs.rslt_data
+        self.ctx.opt_struc_snapshot = outputs.opt_struc_snapshot
+        self.ctx.init_struc_snapshot = outputs.init_struc_snapshot
+        self.record_timeline()
 
+    @timing.timed_step
     def run_next_generation(self):
         """次世代構造生成 WorkChainの実行"""
         inputs = {
@@ -98,36 +295,229 @@ class EA_WorkChain(WorkChain):
             "detail_data": self.ctx.detail_data,
             "cryspy_in": self.ctx.cryspy_in,
         }
+        for name in ("init_struc_snapshot", "opt_struc_snapshot"):
+            if name in self.ctx:
+                inputs[name] = self.ctx[name]
+        if "prune_duplicates" in self.inputs:
+            inputs["prune_duplicates"] = self.inputs.prune_duplicates
         running = self.submit(NextSgWorkChain, **inputs)
         return ToContext(next_wc=running)
 
+    @timing.timed_step
     def update_next_data(self):
         """NextSgWorkChainが新しく作成したGroupのPKやデータでコンテキストを上書き（次のループの準備）"""
         outputs = self.ctx.next_wc.outputs
         self.ctx.current_structures_group_pk = outputs.next_structures_group_pk
-        self.ctx.rslt_data = outputs.rslt_data
         self.ctx.detail_data = outputs.detail_data
         self.ctx.id_queueing = outputs.id_queueing
+        if self.inputs.steady_state.value:
+            # rslt_data は process_offspring でまとめたものを使い続ける
+            # (次世代生成の間に終わった最適化の結果が入っていないため)
+            self.ctx.queue = list(outputs.id_queueing)
+            self.ctx.new_results = 0
+        else:
+            self.ctx.rslt_data = outputs.rslt_data
+
+    def is_steady_state(self):
+        return self.inputs.steady_state.value
+
+    def should_continue_steady_state(self):
+        """最適化を待っている構造・実行中の最適化があるか、まだ次世代を生成できる間は続ける"""
+        can_generate = self.ctx.detail_data.gen < self.inputs.max_generations.value and self.ctx.new_results > 0
+        return bool(self.ctx.queue or self.ctx.in_flight or can_generate)
+
+    @timing.timed_step
+    def submit_offspring(self):
+        """空いている分だけ待ち行列の構造の最適化を投入し、実行中の子プロセスの1つが終わるまで待つ"""
+        batch_size = max(self.inputs.steady_state_batch.value, 1)
+        n_running = sum(len(ids) for ids in self.ctx.in_flight.values())
+        n_free = max(self.ctx.slots - n_running, 0)
+        while self.ctx.queue and n_free > 0:
+            ids = self.ctx.queue[:min(batch_size, n_free)]
+            self.ctx.queue = self.ctx.queue[len(ids):]
+            n_free -= len(ids)
+
+            inputs = self.get_optimization_inputs()
+            inputs["id_queueing"] = List(list=ids)
+            running = self.submit(MultiStructureOptimizeWorkChain, **inputs)
+            running.label = f"gen_{self.ctx.detail_data.gen}_opt_{ids[0]}-{ids[-1]}"
+            self.ctx.in_flight[running.pk] = ids
 
+        self.wait_for_next([load_node(pk) for pk in self.ctx.in_flight])
+
+    @timing.timed_step
+    def process_offspring(self):
+        """
+        終わった最適化の結果 (その子プロセスの構造の行) を rslt_data に加える。
+        Gen 列は現在の世代にして、次の次世代生成で親の候補にする。
+        """
+        self.clear_wait()
+        rslt_data = None
+        for pk in list(self.ctx.in_flight):
+            node = load_node(pk)
+            if not node.is_terminated:
+                continue
+            ids = self.ctx.in_flight.pop(pk)
+            if not node.is_finished_ok:
+                self.report(f"Optimization {node.label} failed with exit status {node.exit_status}")
+                continue
+
+            if rslt_data is None:
+                rslt_data = self.ctx.rslt_data.df
+            child = node.outputs.rslt_data.df
+            rows = child.loc[child.index.intersection(ids)].copy()
+            rows["Gen"] = self.ctx.detail_data.gen
+            rslt_data = pd.concat([rslt_data.drop(index=rows.index, errors="ignore"), rows])
+            self.ctx.new_results += len(rows)
+            # 共有の最適化済みGroupのスナップショット (次の読み込みは差分だけになる)
+            self.ctx.opt_struc_snapshot = node.outputs.opt_struc_snapshot
+
+        if rslt_data is not None:
+            rslt_node = PandasFrameData(rslt_data)
+            rslt_node.store()
+            self.ctx.rslt_data = rslt_node
+            self.record_timeline()
+
+    def should_generate(self):
+        """
+        待ち行列が空で最適化の空きがあり、前回の次世代生成以降に十分な数の最適化が終わっていれば次世代を生成する。
+        実行中の最適化が無い場合は、終わった数が少なくても生成する。
+        """
+        if self.ctx.queue or self.ctx.detail_data.gen >= self.inputs.max_generations.value or self.ctx.new_results == 0:
+            return False
+        n_running = sum(len(ids) for ids in self.ctx.in_flight.values())
+        if n_running >= self.ctx.slots:
+            return False
+        n_required = self.inputs.steady_state_fraction.value * self.ctx.cryspy_in.rin.n_pop
+        return self.ctx.new_results >= n_required or not self.ctx.in_flight
+
+    def record_timeline(self):
+        """経過時間・最適化済み構造の数・最良のエンタルピーを記録する"""
+        rslt_data = self.ctx.rslt_data.df
+        # 緩和しなかった構造 (事前スクリーニングで外した構造、失敗した構造) は NaN
+        energies = pd.to_numeric(rslt_data["E_eV_atom"], errors="coerce").dropna()
+        best = float(energies.min()) if len(energies) else None
+        self.ctx.timeline.append([time.time() - self.ctx.start_time, int(len(energies)), best])
+
+    @timing.timed_step
     def run_final_optimization(self):
         """ループを抜けた後、最終世代の最適化のみを実行"""
         self.report("Running final optimization...")
-        inputs = {
-            "initial_structures_group_pk": self.ctx.current_structures_group_pk,
-            "optimized_structures_group_pk": self.ctx.optimized_structures_group_pk,
-            "rslt_data": self.ctx.rslt_data,
-            "cryspy_in": self.ctx.cryspy_in,
-            "detail_data": self.ctx.detail_data,
-            "id_queueing": self.ctx.id_queueing,
-            "code": self.inputs.code,
-            "parameters": self.inputs.parameters,
-            "options": self.inputs.options,
-        }
-        running = self.submit(MultiStructureOptimizeWorkChain, **inputs)
+        running = self.submit(MultiStructureOptimizeWorkChain, **self.get_optimization_inputs())
         return ToContext(final_opt_wc=running)
 
+    @timing.timed_step
     def finalize(self):
         """最終結果の出力"""
         self.report("Evolutionary algorithm finished completely.")
         self.out('optimized_structures_group_pk', self.ctx.optimized_structures_group_pk)
-        self.out('final_rslt_data', self.ctx.final_opt_wc.outputs.rslt_data)
\ No newline at end of file
+        if self.inputs.steady_state.value:
+            self.out('final_rslt_data', self.ctx.rslt_data)
+        else:
+            self.ctx.rslt_data = self.ctx.final_opt_wc.outputs.rslt_data
+            self.record_timeline()
+            self.out('final_rslt_data', self.ctx.rslt_data)
+
+        timeline = summarize_timeline(self.ctx.timeline, "steady_state" if self.inputs.steady_state.value else "generational")
+        if timeline is None:
+            # steady_state で全ての最適化が失敗した場合など
+            self.report("No optimization finished successfully.")
+            return self.exit_codes.ERROR_NO_OPTIMIZATION_FINISHED
+        timeline_node = Dict(timeline)
+        timeline_node.store()
+        self.out('timeline', timeline_node)
+
+
+def summarize_timeline(timeline, mode):
+    """
+    ctx.timeline ([経過時間 [s], 最適化済み構造の数, 最良のエンタルピー] のリスト) を timeline 出力の辞書にまとめる。
+    記録が無ければ None を返す。
+    """
+    if not timeline:
+        return None
+    elapsed, relaxed, best = (list(column) for column in zip(*timeline))
+    hours = elapsed[-1] / 3600
+    return {
+        "mode": mode,
+        "elapsed": elapsed,
+        "relaxed": relaxed,
+        "best_enthalpy": best,
+        "relaxations_per_hour": relaxed[-1] / hours if hours > 0 else None,
+    }
+
+
+def validate_restart_inputs(inputs, _):
+    """restart_generation は restart_from と一緒に使う (steady_state の再開は未対応)"""
+    if "restart_generation" in inputs and "restart_from" not in inputs:
+        return "`restart_generation` requires `restart_from`."
+    if "restart_from" in inputs and "steady_state" in inputs and inputs["steady_state"].value:
+        return "restarting a steady_state search is not supported (it has no generation boundaries)."
+
+
+def find_generation_start(ea_node, gen=None):
+    """
+    EA_WorkChain の子プロセス (initialize_workchain, next_sg_WorkChain) の出力から、
+    gen 世代の最適化を始める時点のデータを探す。再開した EA_WorkChain の場合は再開元もたどり、新しい方を優先する。
+
+    Args:
+        ea_node: EA_WorkChain のノード
+        gen (int): 世代 (None の場合は開始できる最新の世代)
+
+    Returns:
+        {'current_structures_group_pk', 'optimized_structures_group_pk', 'rslt_data', 'detail_data',
+         'id_queueing', 'cryspy_in', 'resume_from': その世代の最後の最適化のPK (無ければ None),
+         'init_structures_group_pks': 1世代目からその世代までの初期構造のGroupのPK}
+        見つからない場合は理由の文字列
+    """
+    chain = []
+    node = ea_node
+    while node is not None:
+        if node.process_label != EA_WorkChain.__name__:
+            return f"<{node.pk}> is not an EA_WorkChain"
+        if node.inputs.steady_state.value:
+            return "restarting a steady_state search is not supported"
+        chain.append(node)
+        node = load_node(node.inputs.restart_from.value) if "restart_from" in node.inputs else None
+
+    starts = {} # gen -> 出力
+    for node in chain:
+        for child in node.called:
+            if not child.is_finished_ok:
+                continue
+            if child.process_label == InitializeWorkChain.__name__:
+                outputs = child.outputs
+                start = {
+                    "current_structures_group_pk": outputs.initial_structures_group_pk,
+                    "optimized_structures_group_pk": outputs.optimized_structures_group_pk,
+                    "cryspy_in": outputs.cryspy_in,
+                }
+            elif child.process_label == NextSgWorkChain.__name__:
+                outputs = child.outputs
+                start = {
+                    "current_structures_group_pk": outputs.next_structures_group_pk,
+                    "optimized_structures_group_pk": child.inputs.optimized_structures_group_pk,
+                    "cryspy_in": child.inputs.cryspy_in,
+                }
+            else:
+                continue
+            start.update(rslt_data=outputs.rslt_data, detail_data=outputs.detail_data, id_queueing=outputs.id_queueing)
+            starts.setdefault(outputs.detail_data.gen, start)
+
+    if not starts:
+        return "no generation was stored"
+    if gen is None:
+        gen = max(starts)
+    if gen not in starts:
+        return f"stored generations are {sorted(starts)}"
+    start = dict(starts[gen])
+    start["init_structures_group_pks"] = [starts[g]["current_structures_group_pk"].value for g in sorted(starts) if g <= gen]
+
+    # その世代の構造の最適化 (途中で止まったものを含む) のうち最後のもの
+    group_pk = start["current_structures_group_pk"].value
+    optimizations = [
+        child for node in chain for child in node.called
+        if child.process_label == MultiStructureOptimizeWorkChain.__name__
+        and child.inputs.initial_structures_group_pk.value == group_pk
+    ]
+    start["resume_from"] = max((child.pk for child in optimizations), default=None)
+    return start
@@ -0,0 +1,286 @@
+import os
+
+import pandas as pd
+from aiida.engine import WorkChain, while_
+from aiida.orm import Dict, Group, Int, List, load_group, load_node
+from aiida.plugins import DataFactory, WorkflowFactory
+from cryspy.IO import pkl_data, write_input
+from cryspy.IO.read_input import ReadInput
+from cryspy.RS.rs_gen import gen_random
+
+from aiida_cryspy.utils import sandbox, timing
+from aiida_cryspy.utils.groups import load_structure_nodes, store_structures
+from aiida_cryspy.utils.window import SlidingWindowMixin
+
+InitializeWorkChain = WorkflowFactory("aiida_cryspy.initial_structures")
+MultiStructureOptimizeWorkChain = WorkflowFactory("aiida_cryspy.optimize_structures")
+EA_WorkChain = WorkflowFactory("aiida_cryspy.ea")
+PandasFrameData = DataFactory("aiida_cryspy.dataframe")
+RinData = DataFactory("aiida_cryspy.rin_data")
+StructureCollectionData = DataFactory("aiida_cryspy.structurecollection")
+
+# CrySPY の RS の rslt_data の列 (cryspy_init と同じ)
+RS_RSLT_COLUMNS = ["Spg_num", "Spg_sym", "Spg_num_opt", "Spg_sym_opt", "E_eV_atom", "Magmom", "Opt"]
+
+
+class RS_WorkChain(sandbox.SandboxLockMixin, SlidingWindowMixin, WorkChain):
+    """
+    ランダムサーチ (RS) を、構造の生成と最適化を重ねて実行するWorkChain。
+
+    initialize_workchain のように tot_struc 個の構造を最初にまとめて生成せず、
+    chunk_size 個ずつ生成して保存し、すぐにそのチャンクの最適化 (multi_structure_optimize_WorkChain) を投入する。
+    チャンク n の緩和中に、チャンク n+1 を生成する。
+    実行中のチャンクは max_chunks_in_flight 個までで、それ以上は生成せずに1つが終わるのを待つ。
+
+    メモリ使用量はチャンクの大きさで決まる (tot_struc に比例しない):
+      - 生成した構造 (pymatgen) は保存したらすぐに捨てる。ctx にはノードのPKだけを持つ
+      - チャンクごとに初期構造と最適化後の構造のGroupを分けるので、最適化で読み込む構造はそのチャンクの分だけ
+    全ての構造は initial_structures_group_pk, optimized_structures_group_pk のGroupにもまとめる。
+    rslt_data は最後に全てのチャンクの rslt_data をまとめたもの。
+    最適化後の構造はまとめない (チャンクごとの opt_struc_snapshot を chunk_opt_struc_snapshot に出力する)。
+
+    CrySPY のファイルはこの WorkChain の UUID のサンドボックスに置く (構造の生成はここで行う)。
+    各チャンクは空の rslt_data から始めるので、チャンクの最適化はそれぞれ別のサンドボックス
+    (run_uuid は chunk_run_uuid()) に登録し、同時に実行中のチャンクが同じ pickle を書き換えないようにする。
+    最後に全てのチャンクの rslt_data をまとめて、この WorkChain のサンドボックスの rslt_data.pkl に書く。
+    opt_struc_data.pkl はチャンクのサンドボックス (chunk_run_uuids) に残す
+    (全ての構造を1つの pickle にまとめると、メモリ使用量が tot_struc に比例するため)。
+    """
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+
+        # --- Inputs ---
+        spec.expose_inputs(InitializeWorkChain, include=("cryspy_in_filename", "cryspy_in_file"))
+        spec.expose_inputs(MultiStructureOptimizeWorkChain, include=("parameters", "options") + EA_WorkChain._OPTIMIZATION_OPTIONS)
+        spec.input("chunk_size", valid_type=Int, default=lambda: Int(10), help="1回に生成して最適化に投入する構造の数")
+        spec.input("max_chunks_in_flight", valid_type=Int, default=lambda: Int(2), help="同時に最適化するチャンクの最大数")
+
+        # --- Outputs ---
+        spec.output("initial_structures_group_pk", valid_type=Int, help="全ての初期構造のGroupのPK")
+        spec.output("optimized_structures_group_pk", valid_type=Int, help="全ての最適化後の構造のGroupのPK")
+        spec.output("cryspy_in", valid_type=RinData)
+        spec.output("rslt_data", valid_type=PandasFrameData, help="全てのチャンクの結果データ")
+        spec.output("chunk_run_uuids", valid_type=List, help="チャンクのサンドボックスの run_uuid (opt_struc_data.pkl はそれぞれのサンドボックスにある)")
+        spec.output_namespace("chunk_opt_struc_snapshot", valid_type=StructureCollectionData, dynamic=True,
+                              help="チャンクごとの最適化後の構造 (chunk_<n>)")
+
+        spec.exit_code(101, "ERROR_INPUT_FILE_NOT_FOUND", message="cryspy.in was not found.")
+        spec.exit_code(102, "ERROR_NOT_RANDOM_SEARCH", message="algo in cryspy.in is {algo}, not RS.")
+        spec.exit_code(310, "ERROR_CHUNK_FAILED", message="The optimization of chunk(s) {chunks} failed.")
+
+        # --- Outline ---
+        spec.outline(
+            cls.setup,
+            while_(cls.should_continue)(
+                cls.submit_chunk,    # 次のチャンクを生成して投入する (投入できなければ1つが終わるまで待つ)
+                cls.process_chunks,  # 終わったチャンクの最適化後の構造をまとめのGroupに入れる
+            ),
+            cls.finalize,
+        )
+
+    @timing.timed_step
+    def setup(self):
+        """
+        サンドボックスに cryspy.in を置いて読み込み、全てのチャンクに共通の入力を保存する。
+        チャンクの記録 (ctx.chunks) はノードのPKだけを持つ:
+            running: 実行中の multi_structure_optimize_WorkChain のPK (終われば None)
+            rslt_data: 終わったチャンクの rslt_data のPK
+            snapshot: 終わったチャンクの opt_struc_snapshot のPK
+            run_uuid: チャンクの最適化のサンドボックス
+        """
+        if "cryspy_in_file" in self.inputs:
+            content = self.inputs.cryspy_in_file.get_content(mode="rb")
+        else:
+            filename = self.inputs.cryspy_in_filename.value
+            if not os.path.isfile(filename):
+                filename = sandbox.CRYSPY_INPUT_FILENAME
+            if not os.path.isfile(filename):
+                self.report(f"{filename} was not found in {os.getcwd()}.")
+                return self.exit_codes.ERROR_INPUT_FILE_NOT_FOUND
+            with open(filename, "rb") as handle:
+                content = handle.read()
+        self.ctx.run_uuid = self.uuid
+        sandbox.prepare_sandbox(self.ctx.run_uuid, content)
+
+        with sandbox.cryspy_sandbox(self.ctx.run_uuid, self.node):
+            rin = ReadInput()
+            os.makedirs("data/pkl_data", exist_ok=True)
+            write_input.out_input(rin)
+            pkl_data.save_input(rin)
+        if rin.algo != "RS":
+            return self.exit_codes.ERROR_NOT_RANDOM_SEARCH.format(algo=rin.algo)
+
+        rin_node = RinData(rin, run_uuid=self.ctx.run_uuid)
+        rin_node.store()
+        self.out("cryspy_in", rin_node)
+
+        # 各チャンクの最適化は空の rslt_data から始める (最後にまとめる)
+        rslt_data = pd.DataFrame(columns=RS_RSLT_COLUMNS)
+        rslt_data[["Spg_num", "Spg_num_opt"]] = rslt_data[["Spg_num", "Spg_num_opt"]].astype(int)
+        rslt_node = PandasFrameData(rslt_data)
+        rslt_node.store()
+        detail_node = Dict({})
+        detail_node.store()
+
+        init_group = Group(label=f"cryspy_rs_init_{self.uuid}")
+        init_group.store()
+        optimized_group = Group(label=f"cryspy_optimized_{self.uuid}")
+        optimized_group.store()
+
+        self.ctx.cryspy_in = rin_node.pk
+        self.ctx.empty_rslt_data = rslt_node.pk
+        self.ctx.detail_data = detail_node.pk
+        self.ctx.init_group_pk = init_group.pk
+        self.ctx.optimized_group_pk = optimized_group.pk
+        self.ctx.tot_struc = rin.tot_struc
+        self.ctx.n_generated = 0
+        self.ctx.chunks = []
+        self.report(f"Random search of {rin.tot_struc} structures in chunks of {self.inputs.chunk_size.value}.")
+
+    def should_continue(self):
+        return self.ctx.n_generated < self.ctx.tot_struc or bool(self.get_running())
+
+    def get_running(self):
+        return [chunk["running"] for chunk in self.ctx.chunks if chunk["running"] is not None]
+
+    def can_generate(self):
+        return (self.ctx.n_generated < self.ctx.tot_struc
+                and len(self.get_running()) < max(self.inputs.max_chunks_in_flight.value, 1))
+
+    @timing.timed_step
+    def submit_chunk(self):
+        """
+        空きがあれば次のチャンクを生成・保存して最適化を投入する。
+        まだ生成できる場合は待たずに次のステップへ進む (次のループで続けて生成する)。
+        """
+        if self.can_generate():
+            self.submit_next_chunk()
+        if not self.can_generate():
+            self.wait_for_next([load_node(pk) for pk in self.get_running()])
+
+    def submit_next_chunk(self):
+        """ID n_generated から chunk_size 個の構造を生成し、チャンクのGroupに保存して最適化を投入する"""
+        n = len(self.ctx.chunks)
+        id_offset = self.ctx.n_generated
+        nstruc = min(max(self.inputs.chunk_size.value, 1), self.ctx.tot_struc - id_offset)
+        rin = load_node(self.ctx.cryspy_in).rin
+
+        with sandbox.cryspy_sandbox(self.ctx.run_uuid, self.node):
+            init_struc_data, _ = gen_random(rin=rin, nstruc=nstruc, id_offset=id_offset, comm=None, mpi_rank=0, mpi_size=1)
+
+        chunk_group = Group(label=f"cryspy_rs_chunk_{n}_init_{self.uuid}")
+        chunk_group.store()
+        optimized_group = Group(label=f"cryspy_rs_chunk_{n}_optimized_{self.uuid}")
+        optimized_group.store()
+        nodes = store_structures(init_struc_data, chunk_group)
+        load_group(pk=self.ctx.init_group_pk).add_nodes(list(nodes.values()))
+        timing.count(self, items=len(nodes))
+
+        chunk_group_pk = Int(chunk_group.pk)
+        chunk_group_pk.store()
+        optimized_group_pk = Int(optimized_group.pk)
+        optimized_group_pk.store()
+        id_queueing = List(list=sorted(init_struc_data))
+        id_queueing.store()
+
+        # チャンクの最適化は自分のサンドボックスの pickle に登録する
+        run_uuid = chunk_run_uuid(self.uuid, n)
+        content = (sandbox.get_sandbox(self.ctx.run_uuid) / sandbox.CRYSPY_INPUT_FILENAME).read_bytes()
+        sandbox.prepare_sandbox(run_uuid, content)
+        (sandbox.get_sandbox(run_uuid) / sandbox.PKL_DIRNAME).mkdir(parents=True, exist_ok=True)
+        cryspy_in = RinData(rin, run_uuid=run_uuid)
+        cryspy_in.store()
+
+        inputs = self.exposed_inputs(MultiStructureOptimizeWorkChain)
+        inputs.update(
+            initial_structures_group_pk=chunk_group_pk,
+            optimized_structures_group_pk=optimized_group_pk,
+            rslt_data=load_node(self.ctx.empty_rslt_data),
+            cryspy_in=cryspy_in,
+            detail_data=load_node(self.ctx.detail_data),
+            id_queueing=id_queueing,
+        )
+        running = self.submit(MultiStructureOptimizeWorkChain, **inputs)
+        running.label = f"rs_chunk_{n}_{id_offset}-{id_offset + nstruc - 1}"
+
+        self.ctx.n_generated = id_offset + nstruc
+        self.ctx.chunks.append({
+            "running": running.pk,
+            "optimized_structures_group_pk": optimized_group.pk,
+            "rslt_data": None,
+            "snapshot": None,
+            "run_uuid": run_uuid,
+            "failed": False,
+        })
+        self.report(f"Chunk {n}: generated IDs {id_offset}-{id_offset + nstruc - 1} and submitted "
+                    f"{running.process_label}<{running.pk}> ({len(self.get_running())} chunks running, "
+                    f"{self.ctx.tot_struc - self.ctx.n_generated} structures left).")
+
+    @timing.timed_step
+    def process_chunks(self):
+        """終わったチャンクの rslt_data を記録し、最適化後の構造をまとめのGroupに入れる"""
+        self.clear_wait()
+        optimized_group = None
+        for n, chunk in enumerate(self.ctx.chunks):
+            if chunk["running"] is None:
+                continue
+            node = load_node(chunk["running"])
+            if not node.is_terminated:
+                continue
+            chunk["running"] = None
+            if not node.is_finished_ok:
+                self.report(f"Chunk {n}: {node.process_label}<{node.pk}> failed with exit status {node.exit_status}")
+                chunk["failed"] = True
+                continue
+            chunk["rslt_data"] = node.outputs.rslt_data.pk
+            chunk["snapshot"] = node.outputs.opt_struc_snapshot.pk
+
+            if optimized_group is None:
+                optimized_group = load_group(pk=self.ctx.optimized_group_pk)
+            structures = list(load_structure_nodes(chunk["optimized_structures_group_pk"]).values())
+            optimized_group.add_nodes(structures)
+            timing.count(self, items=len(structures))
+            self.report(f"Chunk {n}: {len(structures)} structures optimized.")
+
+    @sandbox.locked_step(lambda self: [self.ctx.run_uuid])
+    @timing.timed_step
+    def finalize(self):
+        """
+        全てのチャンクの rslt_data をまとめて出力し、この WorkChain のサンドボックスの rslt_data.pkl に書く。
+        最適化後の構造はチャンクごとに出力する (opt_struc_data はまとめない)。
+        """
+        for name, pk in (("initial_structures_group_pk", self.ctx.init_group_pk),
+                         ("optimized_structures_group_pk", self.ctx.optimized_group_pk)):
+            pk_node = Int(pk)
+            pk_node.store()
+            self.out(name, pk_node)
+
+        frames = [load_node(chunk["rslt_data"]).df for chunk in self.ctx.chunks if chunk["rslt_data"] is not None]
+        if frames:
+            rslt_data = pd.concat(frames).sort_index()
+        else:
+            rslt_data = load_node(self.ctx.empty_rslt_data).df
+        rslt_node = PandasFrameData(rslt_data)
+        rslt_node.store()
+        self.out("rslt_data", rslt_node)
+        with sandbox.cryspy_sandbox(self.ctx.run_uuid, self.node):
+            pkl_data.save_rslt(rslt_data)
+
+        run_uuids = List(list=[chunk["run_uuid"] for chunk in self.ctx.chunks])
+        run_uuids.store()
+        self.out("chunk_run_uuids", run_uuids)
+        for n, chunk in enumerate(self.ctx.chunks):
+            if chunk["snapshot"] is not None:
+                self.out(f"chunk_opt_struc_snapshot.chunk_{n}", load_node(chunk["snapshot"]))
+        timing.count(self, items=len(rslt_data), nbytes=timing.node_nbytes(rslt_node))
+
+        failed = [n for n, chunk in enumerate(self.ctx.chunks) if chunk["failed"]]
+        if failed:
+            return self.exit_codes.ERROR_CHUNK_FAILED.format(chunks=failed)
+        self.report(f"Random search of {len(rslt_data)} structures in {len(self.ctx.chunks)} chunks finished.")
+
+
+def chunk_run_uuid(run_uuid, n):
+    """RS_WorkChain (run_uuid) のチャンク n の最適化のサンドボックスの run_uuid"""
+    return f"{run_uuid}_chunk_{n}"
@@ -4,19 +4,24 @@ from aiida.plugins import DataFactory
 from cryspy.start import cryspy_init
 import os
 
+from aiida_cryspy.utils import sandbox, timing
+from aiida_cryspy.utils.groups import store_structures
+
 StructureCollectionData = DataFactory("aiida_cryspy.structurecollection")
 PandasFrameData = DataFactory("aiida_cryspy.dataframe")
 RinData = DataFactory("aiida_cryspy.rin_data")
 EAData = DataFactory("aiida_cryspy.ea_data")
 StructureData = DataFactory("core.structure")
+SinglefileData = DataFactory("core.singlefile")
 
 
-class initialize_workchain(WorkChain):
+class initialize_workchain(sandbox.SandboxLockMixin, WorkChain):
 
     @classmethod
     def define(cls,spec):
         super().define(spec)
-        spec.input("cryspy_in_filename", valid_type=Str)
+        spec.input("cryspy_in_filename", valid_type=Str, help="cryspy.in のパス (cryspy_in_file が無い場合。存在しなければカレントディレクトリの cryspy.in)")
+        spec.input("cryspy_in_file", valid_type=SinglefileData, required=False, help="cryspy.in の内容 (カレントディレクトリに依存しない)")
 
         spec.output("initial_structures_group_pk", valid_type=Int)
         spec.output("optimized_structures_group_pk", valid_type=Int)
@@ -25,8 +30,9 @@ class initialize_workchain(WorkChain):
         spec.output("detail_data", valid_type=(Dict, EAData))
         spec.output("id_queueing", valid_type=List)
 
-        spec.exit_code(101, "ERROR_LOCK_FILE_EXISTS", message="lock_cryspy file already exists.")
-        spec.exit_code(102, "ERROR_STAT_FILE_EXISTS", message="cryspy.stat file already exists.")
+        spec.exit_code(101, "ERROR_LOCK_FILE_EXISTS", message="The CrySPY run is locked by another process.")
+        spec.exit_code(102, "ERROR_STAT_FILE_EXISTS", message="cryspy.stat file already exists in the sandbox.")
+        spec.exit_code(103, "ERROR_INPUT_FILE_NOT_FOUND", message="cryspy.in was not found.")
 
         spec.outline(
             cls.prepare_and_check,
@@ -34,23 +40,40 @@ class initialize_workchain(WorkChain):
             cls.set_outputs_and_cleanup
         )
 
+    @timing.timed_step
     def prepare_and_check(self):
         """
-        ファイル操作と状態チェックを行う。
+        探索 (run) のサンドボックスを用意し、状態をチェックする。
+        run_uuid はこの WorkChain の UUID (1つの呼び出し元が複数の探索を初期化しても別のサンドボックスになる)。
+        CrySPY のファイルは全てサンドボックスに置くので、同じディレクトリから複数の探索を実行できる。
         """
-        # lock_cryspyのチェックと作成 (action.initialize()の冒頭部分を再現)
-        if os.path.isfile("lock_cryspy"):
-            self.report("lock_cryspy file exists, aborting.")
+        self.ctx.run_uuid = self.uuid
+
+        # ロックのチェック (lock_cryspy の代わりに DB 上のロックを使う)
+        if sandbox.is_locked(self.ctx.run_uuid):
+            self.report(f"CrySPY run {self.ctx.run_uuid} is locked, aborting.")
             return self.exit_codes.ERROR_LOCK_FILE_EXISTS
-        with open("lock_cryspy", "w"):
-            pass
-        self.report("Created lock_cryspy file.")
 
         # cryspy.statのチェック
-        if os.path.isfile("cryspy.stat"):
+        if sandbox.is_initialized(self.ctx.run_uuid):
             self.report("cryspy.stat file exists. Clean files to start from the beginning.")
             return self.exit_codes.ERROR_STAT_FILE_EXISTS
 
+        if "cryspy_in_file" in self.inputs:
+            content = self.inputs.cryspy_in_file.get_content(mode="rb")
+        else:
+            filename = self.inputs.cryspy_in_filename.value
+            if not os.path.isfile(filename):
+                filename = sandbox.CRYSPY_INPUT_FILENAME
+            if not os.path.isfile(filename):
+                self.report(f"{filename} was not found in {os.getcwd()}.")
+                return self.exit_codes.ERROR_INPUT_FILE_NOT_FOUND
+            with open(filename, "rb") as handle:
+                content = handle.read()
+        path = sandbox.prepare_sandbox(self.ctx.run_uuid, content)
+        self.report(f"Prepared the sandbox {path}.")
+
+    @timing.timed_step
     def run_initialize(self):
         """
         純粋なデータ生成処理をcalcfunctionとして実行する。
@@ -62,19 +85,17 @@ class initialize_workchain(WorkChain):
 
         # print(f"Current working directory init: {os.getcwd()}") # 現在のディレクトリを確認
  
-        init_struc_data, _, rin, rslt_data, detail_data, id_queueing = cryspy_init.initialize()
+        with sandbox.cryspy_sandbox(self.ctx.run_uuid, self.node):
+            init_struc_data, _, rin, rslt_data, detail_data, id_queueing = cryspy_init.initialize()
 
         # グループの作成
         group_label = f"cryspy_gen_1_init_{self.uuid}"
         group = Group(label=group_label)
         group.store()
 
-        # 構造を1つずつ保存してGroupに入れる
-        for cid, pmg_struct in init_struc_data.items():
-            s_node = StructureData(pymatgen=pmg_struct)
-            s_node.base.extras.set('cryspy_id', cid) # IDを付与
-            s_node.store()
-            group.add_nodes(s_node)
+        # 構造をまとめて保存してGroupに入れる (1トランザクション)
+        store_structures(init_struc_data, group)
+        timing.count(self, items=len(init_struc_data))
 
         self.report(f"Stored {len(init_struc_data)} structures to Group<{group.pk}>.")
         
@@ -90,9 +111,10 @@ class initialize_workchain(WorkChain):
         self.ctx.detail_data = detail_data
         self.ctx.id_queueing = id_queueing
 
+    @timing.timed_step
     def set_outputs_and_cleanup(self):
         """
-        出力を設定
+        出力を設定 (ロックは cryspy_sandbox を抜けた時点で外れている)
         """
 
         group_pk_node = Int(self.ctx._init_group_pk)
@@ -104,7 +126,7 @@ class initialize_workchain(WorkChain):
         self.out("optimized_structures_group_pk", optimized_group_pk_node)
 
         # RinData
-        rin_data_node = RinData(self.ctx.rin)
+        rin_data_node = RinData(self.ctx.rin, run_uuid=self.ctx.run_uuid)
         rin_data_node.store()
         self.out("cryspy_in", rin_data_node)
 
@@ -125,9 +147,5 @@ class initialize_workchain(WorkChain):
         id_queueing_node = List(list=self.ctx.id_queueing)
         id_queueing_node.store()
         self.out("id_queueing", id_queueing_node)
-
-        # lock_cryspyの削除 (action.initialize()の末尾部分を再現)
-        if os.path.isfile("lock_cryspy"):
-            os.remove("lock_cryspy")
-            self.report("Removed lock_cryspy file.")
-
+        timing.count(self, items=len(self.ctx.id_queueing),
+                     nbytes=timing.node_nbytes(rin_data_node, rslt_data_node, detail_data_node, id_queueing_node))
@@ -0,0 +1,370 @@
+import numpy as np
+import pandas as pd
+from aiida.engine import WorkChain, if_, while_
+from aiida.orm import Int, List, load_group, load_node
+from aiida.plugins import DataFactory, WorkflowFactory
+
+from aiida_cryspy.utils import relax_cache, sandbox, timing
+from aiida_cryspy.utils.groups import load_structure_nodes
+from aiida_cryspy.utils.window import SlidingWindowMixin
+
+InitializeWorkChain = WorkflowFactory("aiida_cryspy.initial_structures")
+MultiStructureOptimizeWorkChain = WorkflowFactory("aiida_cryspy.optimize_structures")
+NextSgWorkChain = WorkflowFactory("aiida_cryspy.next_sg")
+EA_WorkChain = WorkflowFactory("aiida_cryspy.ea")
+PandasFrameData = DataFactory("aiida_cryspy.dataframe")
+
+ISLAND_RSLT_EXTRA = "cryspy_island_rslt_data" # {島の番号: 島の最新の rslt_data のPK}
+
+# EA_WorkChain の入力のうち、全ての島で共通に使うもの
+_EXPOSED_INPUTS = (
+    "max_generations", "cryspy_in_filename", "cryspy_in_file", "parameters", "options", "prune_duplicates",
+) + EA_WorkChain._OPTIMIZATION_OPTIONS
+
+
+class island_EA_WorkChain(sandbox.SandboxLockMixin, SlidingWindowMixin, WorkChain):
+    """
+    島モデルの進化的アルゴリズム。
+
+    n_islands 個の集団 (島) をそれぞれ独立に初期化し (CrySPY のサンドボックスも島ごと)、
+    最適化 (multi_structure_optimize_WorkChain) と次世代生成 (next_sg_WorkChain) を島ごとに進める。
+    島は他の島を待たずに進み、migration_interval 世代ごとにだけ全ての島がそろうのを待って移住する:
+    各島の現世代の上位 n_migrants 構造を、環状に隣の島の現世代の最も悪い構造と置き換える
+    (最適化済み構造を複製して置き換える cryspy_id で送り先のGroupに入れ、rslt_data の行と
+    送り先の島のサンドボックスの CrySPY の pickle (opt_struc_data, rslt_data, elite_struc, elite_fitness) も置き換える)。
+
+    緩和キャッシュ (use_relax_cache) は DB 上で全ての島に共通。
+    global_rslt_data は全ての島の rslt_data に Island, ID 列を付けてまとめたもの。
+    実行中は島ごとの最新の rslt_data のPKをノードの extras (ISLAND_RSLT_EXTRA) に記録するので、
+    global_rslt_data(node) でその時点の全ての島の結果を見られる。
+    """
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+
+        # --- Inputs ---
+        spec.expose_inputs(EA_WorkChain, include=_EXPOSED_INPUTS)
+        spec.input("n_islands", valid_type=Int, default=lambda: Int(4), help="島 (独立な集団) の数")
+        spec.input("migration_interval", valid_type=Int, default=lambda: Int(5), help="移住する世代の間隔")
+        spec.input("n_migrants", valid_type=Int, default=lambda: Int(1), help="1回の移住で隣の島に送る構造の数")
+
+        # --- Outputs ---
+        spec.output("global_rslt_data", valid_type=PandasFrameData, help="全ての島の最終結果データ (Island, ID 列付き)")
+        spec.output_namespace("island_rslt_data", valid_type=PandasFrameData, dynamic=True, help="島ごとの最終結果データ")
+        spec.output("migrations", valid_type=List, required=False, help="移住の記録 [世代, 送り元の島, 送り元のID, 送り先の島, 置き換えたID, E_eV_atom]")
+
+        spec.exit_code(310, "ERROR_ISLAND_FAILED", message="Island(s) {islands} failed.")
+
+        # --- Outline ---
+        spec.outline(
+            cls.setup,
+            while_(cls.should_continue)(
+                cls.submit_islands,   # 待っていない島の次の子プロセスを投入し、1つが終わるまで待つ
+                cls.process_islands,  # 終わった子プロセスの出力で島の状態を進める
+                if_(cls.should_migrate)(
+                    cls.migrate,
+                ),
+            ),
+            cls.finalize,
+        )
+
+    @timing.timed_step
+    def setup(self):
+        """
+        島の状態 (ctx.islands) はノードのPKだけを持つ:
+            stage: 'init' | 'opt' | 'next' | 'barrier' (移住待ち) | 'done' | 'failed'
+            running: 実行中の子プロセスのPK (無ければ None)
+        """
+        self.ctx.islands = [{"stage": "init", "running": None} for _ in range(self.inputs.n_islands.value)]
+        self.ctx.migrations = []
+
+    def should_continue(self):
+        return any(island["stage"] not in ("done", "failed") for island in self.ctx.islands)
+
+    @timing.timed_step
+    def submit_islands(self):
+        """移住を待っていない島の次の段階 (初期化・最適化・次世代生成) を投入する"""
+        for i, island in enumerate(self.ctx.islands):
+            if island["running"] is not None or island["stage"] not in ("init", "opt", "next"):
+                continue
+            process_class, inputs = self.get_island_inputs(island)
+            running = self.submit(process_class, **inputs)
+            gen = load_node(island["detail_data"]).gen if "detail_data" in island else 0
+            running.label = f"island_{i}_gen_{gen}_{island['stage']}"
+            island["running"] = running.pk
+
+        self.wait_for_next([load_node(island["running"]) for island in self.ctx.islands if island["running"] is not None])
+
+    def get_island_inputs(self, island):
+        """島の現在の段階の子プロセスと入力"""
+        options = self.exposed_inputs(EA_WorkChain)
+        if island["stage"] == "init":
+            inputs = {"cryspy_in_filename": options["cryspy_in_filename"]}
+            if "cryspy_in_file" in options:
+                inputs["cryspy_in_file"] = options["cryspy_in_file"]
+            return InitializeWorkChain, inputs
+
+        inputs = {
+            "initial_structures_group_pk": load_node(island["current_structures_group_pk"]),
+            "optimized_structures_group_pk": load_node(island["optimized_structures_group_pk"]),
+            "rslt_data": load_node(island["rslt_data"]),
+            "detail_data": load_node(island["detail_data"]),
+            "cryspy_in": load_node(island["cryspy_in"]),
+        }
+        if island["stage"] == "opt":
+            inputs.update(
+                id_queueing=load_node(island["id_queueing"]),
+                parameters=options["parameters"],
+                options=options["options"],
+            )
+            if island.get("opt_struc_snapshot") is not None:
+                inputs["opt_struc_snapshot"] = load_node(island["opt_struc_snapshot"])
+            for name in EA_WorkChain._OPTIMIZATION_OPTIONS:
+                if name in options:
+                    inputs[name] = options[name]
+            return MultiStructureOptimizeWorkChain, inputs
+
+        for name in ("init_struc_snapshot", "opt_struc_snapshot"):
+            if island.get(name) is not None:
+                inputs[name] = load_node(island[name])
+        if "prune_duplicates" in options:
+            inputs["prune_duplicates"] = options["prune_duplicates"]
+        return NextSgWorkChain, inputs
+
+    @timing.timed_step
+    def process_islands(self):
+        """終わった子プロセスの出力を島の状態に反映し、次の段階に進める"""
+        self.clear_wait()
+        max_generations = self.inputs.max_generations.value
+        interval = max(self.inputs.migration_interval.value, 1)
+        for i, island in enumerate(self.ctx.islands):
+            if island["running"] is None:
+                continue
+            node = load_node(island["running"])
+            if not node.is_terminated:
+                continue
+            island["running"] = None
+            if not node.is_finished_ok:
+                self.report(f"Island {i}: {node.process_label}<{node.pk}> failed with exit status {node.exit_status}")
+                island["stage"] = "failed"
+                continue
+
+            outputs = node.outputs
+            if island["stage"] == "init":
+                island.update(
+                    current_structures_group_pk=outputs.initial_structures_group_pk.pk,
+                    optimized_structures_group_pk=outputs.optimized_structures_group_pk.pk,
+                    rslt_data=outputs.rslt_data.pk,
+                    detail_data=outputs.detail_data.pk,
+                    id_queueing=outputs.id_queueing.pk,
+                    cryspy_in=outputs.cryspy_in.pk,
+                )
+                island["stage"] = "opt"
+            elif island["stage"] == "opt":
+                island.update(
+                    rslt_data=outputs.rslt_data.pk,
+                    opt_struc_snapshot=outputs.opt_struc_snapshot.pk,
+                    init_struc_snapshot=outputs.init_struc_snapshot.pk,
+                )
+                gen = load_node(island["detail_data"]).gen
+                self.report(f"Island {i}: generation {gen} optimized (best {get_best_energy(outputs.rslt_data.df)} eV/atom).")
+                if gen >= max_generations:
+                    island["stage"] = "done"
+                elif len(self.ctx.islands) > 1 and gen % interval == 0:
+                    island["stage"] = "barrier"
+                else:
+                    island["stage"] = "next"
+            else:
+                island.update(
+                    current_structures_group_pk=outputs.next_structures_group_pk.pk,
+                    rslt_data=outputs.rslt_data.pk,
+                    detail_data=outputs.detail_data.pk,
+                    id_queueing=outputs.id_queueing.pk,
+                )
+                island["stage"] = "opt"
+        self.update_global_view()
+
+    def update_global_view(self):
+        """島ごとの最新の rslt_data のPKを extras に記録する (global_rslt_data(self.node) で読む)"""
+        self.node.base.extras.set(ISLAND_RSLT_EXTRA, {
+            str(i): island["rslt_data"] for i, island in enumerate(self.ctx.islands) if "rslt_data" in island
+        })
+
+    def should_migrate(self):
+        """失敗していない島が全て移住待ち (または終了) になったら移住する"""
+        stages = [island["stage"] for island in self.ctx.islands if island["stage"] != "failed"]
+        return "barrier" in stages and all(stage in ("barrier", "done") for stage in stages)
+
+    @sandbox.locked_step(lambda self: [load_node(self.ctx.islands[i]["cryspy_in"]).run_uuid for i in self.get_barrier_islands()])
+    @timing.timed_step
+    def migrate(self):
+        """各島の現世代の上位 n_migrants 構造を、環状に次の島へ送る"""
+        active = self.get_barrier_islands()
+        n_migrants = self.inputs.n_migrants.value
+        if len(active) > 1 and n_migrants > 0:
+            # 置き換えの前に、全ての島の送る構造を選んでおく
+            migrants = {i: self.select_migrants(self.ctx.islands[i], n_migrants) for i in active}
+            for j, i in enumerate(active):
+                source = active[j - 1]
+                self.receive_migrants(i, source, migrants[source])
+            gen = load_node(self.ctx.islands[active[0]]["detail_data"]).gen
+            best = min((get_best_energy(load_node(self.ctx.islands[i]["rslt_data"]).df) for i in active),
+                       key=lambda value: np.inf if value is None else value)
+            self.report(f"Generation {gen}: migrated {n_migrants} structure(s) between {len(active)} islands "
+                        f"(global best {best} eV/atom).")
+        for i in active:
+            self.ctx.islands[i]["stage"] = "next"
+        self.update_global_view()
+
+    def get_barrier_islands(self):
+        return [i for i, island in enumerate(self.ctx.islands) if island["stage"] == "barrier"]
+
+    def select_migrants(self, island, n_migrants):
+        """
+        島の現世代でエネルギーの低い n_migrants 構造。
+
+        Returns:
+            [{'id': cryspy_id, 'structure': 最適化済み構造のPK, 'row': rslt_data の行}]
+        """
+        rslt_data = load_node(island["rslt_data"]).df
+        gen = load_node(island["detail_data"]).gen
+        energies = get_current_energies(rslt_data, gen).dropna().sort_values()
+        ids = [int(cid) for cid in energies.index[:n_migrants]]
+        group_pk = load_node(island["optimized_structures_group_pk"]).value
+        structures = load_structure_nodes(group_pk, ids)
+        return [
+            {
+                "id": cid,
+                "structure": structures[cid].pk,
+                "row": [value.item() if hasattr(value, "item") else value for value in rslt_data.loc[cid]],
+            }
+            for cid in ids if cid in structures
+        ]
+
+    def receive_migrants(self, i, source, migrants):
+        """
+        島 i の現世代の最も悪い構造 (エネルギーが無いものを先に) を migrants で置き換える。
+        移住した構造は最適化済み構造の複製で、置き換えた cryspy_id でGroupに入れる
+        (同じ cryspy_id では後から作られたノードが使われる)。
+        next_gen_EA は島のサンドボックスの pickle も読むので、そちらも同じく置き換える。
+        """
+        island = self.ctx.islands[i]
+        rslt_data = load_node(island["rslt_data"]).df
+        gen = load_node(island["detail_data"]).gen
+        energies = get_current_energies(rslt_data, gen).fillna(np.inf).sort_values(ascending=False, kind="stable")
+        group = load_group(pk=load_node(island["optimized_structures_group_pk"]).value)
+
+        replacements = {}
+        for cid, migrant in zip(energies.index, migrants):
+            cid = int(cid)
+            structure_node = load_node(migrant["structure"]).clone()
+            for key in (relax_cache.RELAX_KEY_EXTRA, relax_cache.ENERGY_EXTRA):
+                if key in structure_node.base.extras.keys():
+                    structure_node.base.extras.delete(key) # 複製は緩和キャッシュに入れない
+            structure_node.base.extras.set_many({
+                "cryspy_id": cid,
+                "migrated_from": {"island": source, "cryspy_id": migrant["id"]},
+            })
+            structure_node.store()
+            group.add_nodes(structure_node)
+
+            row = dict(zip(rslt_data.columns, migrant["row"]))
+            row["Gen"] = gen
+            rslt_data.loc[cid] = [row[column] for column in rslt_data.columns]
+            replacements[cid] = (structure_node.get_pymatgen(), row)
+            self.ctx.migrations.append([gen, source, migrant["id"], i, cid, row.get("E_eV_atom")])
+
+        with sandbox.cryspy_sandbox(load_node(island["cryspy_in"]).run_uuid, self.node):
+            replace_registered(replacements)
+
+        rslt_node = PandasFrameData(rslt_data)
+        rslt_node.store()
+        island["rslt_data"] = rslt_node.pk
+
+    @timing.timed_step
+    def finalize(self):
+        """島ごとの結果と、全ての島をまとめた global_rslt_data を出力する"""
+        frames = {}
+        for i, island in enumerate(self.ctx.islands):
+            if "rslt_data" not in island:
+                continue
+            rslt_node = load_node(island["rslt_data"])
+            self.out(f"island_rslt_data.island_{i}", rslt_node)
+            frames[i] = rslt_node.df
+
+        if frames:
+            global_rslt_data_node = PandasFrameData(concat_islands(frames))
+            global_rslt_data_node.store()
+            self.out("global_rslt_data", global_rslt_data_node)
+        if self.ctx.migrations:
+            migrations = List(list=self.ctx.migrations)
+            migrations.store()
+            self.out("migrations", migrations)
+
+        failed = [i for i, island in enumerate(self.ctx.islands) if island["stage"] == "failed"]
+        if failed:
+            return self.exit_codes.ERROR_ISLAND_FAILED.format(islands=failed)
+        self.report(f"Island model EA with {len(self.ctx.islands)} islands finished.")
+
+
+def replace_registered(replacements):
+    """
+    cryspy_sandbox の中で、CrySPY の pickle の構造と結果を移住した構造で置き換える。
+    置き換える cryspy_id が前の世代のエリートにもあれば、エリートの構造と適応度も置き換える。
+
+    Args:
+        replacements (dict): {cryspy_id: (pymatgen.core.Structure, rslt_data の行 {列: 値})}
+    """
+    opt_struc_data = sandbox.load_pickle("opt_struc_data", {})
+    rslt_data = sandbox.load_pickle("rslt_data")
+    elite_struc = sandbox.load_pickle("elite_struc")
+    elite_fitness = sandbox.load_pickle("elite_fitness")
+    for cid, (struc, row) in replacements.items():
+        opt_struc_data[cid] = struc
+        if rslt_data is not None:
+            rslt_data.loc[cid] = [row.get(column) for column in rslt_data.columns]
+        if elite_struc is not None and cid in elite_struc:
+            elite_struc[cid] = struc
+        if elite_fitness is not None and cid in elite_fitness:
+            elite_fitness[cid] = row.get("E_eV_atom")
+
+    sandbox.dump_pickle("opt_struc_data", opt_struc_data)
+    for name, value in (("rslt_data", rslt_data), ("elite_struc", elite_struc), ("elite_fitness", elite_fitness)):
+        if value is not None:
+            sandbox.dump_pickle(name, value)
+
+
+def concat_islands(frames: dict) -> pd.DataFrame:
+    """{島の番号: rslt_data} に Island, ID 列を付けて1つにまとめる"""
+    global_frames = []
+    for i, rslt_data in sorted(frames.items()):
+        rslt_data = rslt_data.copy()
+        rslt_data.insert(0, "Island", i)
+        rslt_data.insert(1, "ID", rslt_data.index)
+        global_frames.append(rslt_data)
+    return pd.concat(global_frames, ignore_index=True)
+
+
+def global_rslt_data(node):
+    """
+    island_EA_WorkChain のノード (実行中でもよい) から、全ての島のその時点の rslt_data をまとめる。
+    まだどの島も初期化されていなければ None。
+
+        from aiida_cryspy.workflows.island_EA_WorkChain import global_rslt_data
+        global_rslt_data(load_node(pk)).sort_values('E_eV_atom').head()
+    """
+    rslt_data_pks = node.base.extras.get(ISLAND_RSLT_EXTRA, {})
+    if not rslt_data_pks:
+        return None
+    return concat_islands({int(i): load_node(pk).df for i, pk in rslt_data_pks.items()})
+
+
+def get_current_energies(rslt_data, gen):
+    """rslt_data の世代 gen の E_eV_atom (緩和しなかった構造は NaN)"""
+    current = rslt_data[rslt_data["Gen"] == gen]
+    return pd.to_numeric(current["E_eV_atom"], errors="coerce")
+
+
+def get_best_energy(rslt_data):
+    energies = pd.to_numeric(rslt_data["E_eV_atom"], errors="coerce").dropna()
+    return round(float(energies.min()), 6) if len(energies) else None
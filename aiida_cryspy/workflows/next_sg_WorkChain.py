@@ -1,8 +1,12 @@
-from aiida.orm import List,Int,load_group,Group
+from aiida.orm import Bool,Dict,List,Int,Group
 from aiida.engine import WorkChain,calcfunction
 from aiida.plugins import DataFactory
 from cryspy.job import ctrl_job
 
+from aiida_cryspy.utils import sandbox, timing
+from aiida_cryspy.utils.duplicates import DuplicateIndex, find_duplicates
+from aiida_cryspy.utils.groups import load_structures_incremental, store_structures
+
 StructureCollectionData = DataFactory("aiida_cryspy.structurecollection")
 PandasFrameData = DataFactory("aiida_cryspy.dataframe")
 RinData = DataFactory("aiida_cryspy.rin_data")
@@ -10,7 +14,7 @@ EAData = DataFactory("aiida_cryspy.ea_data")
 StructureData = DataFactory("core.structure")
 
 
-class next_sg_WorkChain(WorkChain):
+class next_sg_WorkChain(sandbox.SandboxLockMixin, WorkChain):
     @classmethod
     def define(cls, spec):
         super().define(spec)
@@ -21,6 +25,9 @@ class next_sg_WorkChain(WorkChain):
         spec.input("rslt_data", valid_type=PandasFrameData)
         spec.input("detail_data", valid_type=EAData)
         spec.input("cryspy_in", valid_type=RinData, help='cryspy input data')
+        spec.input("init_struc_snapshot", valid_type=StructureCollectionData, required=False, help='snapshot of the initial group made by multi_structure_optimize_WorkChain')
+        spec.input("opt_struc_snapshot", valid_type=StructureCollectionData, required=False, help='snapshot of the optimized group made by multi_structure_optimize_WorkChain')
+        spec.input("prune_duplicates", valid_type=Bool, default=lambda: Bool(False), help='exclude parents that duplicate a lower-energy optimized structure')
         # spec.input("structures_group_pk", valid_type=Int, help='PK of the group with optimized structures.')
 
         # spec.output("next_structures", valid_type=StructureCollectionData, help='next generation structures')
@@ -28,6 +35,7 @@ class next_sg_WorkChain(WorkChain):
         spec.output("rslt_data",valid_type=PandasFrameData, help='result data in Pandas DataFrame format')
         spec.output("detail_data", valid_type=EAData, help='evolutionary algorithm data for next generation')
         spec.output("id_queueing", valid_type=List, help='queueing ids for next generation')
+        spec.output("duplicates", valid_type=Dict, required=False, help='pruned parents {cryspy_id: cryspy_id of the kept structure}')
 
 
         spec.outline(
@@ -35,6 +43,8 @@ class next_sg_WorkChain(WorkChain):
             cls.set_outputs
         )
 
+    @sandbox.locked_step(lambda self: [self.inputs.cryspy_in.run_uuid])
+    @timing.timed_step
     def call_next_sg(self):
 
 
@@ -44,48 +54,50 @@ class next_sg_WorkChain(WorkChain):
 
         # 1. 最適化前の構造データを復元 (init_struc_data)
         init_group_pk = self.inputs.initial_structures_group_pk.value
-        init_group = load_group(pk=init_group_pk)
-
-        init_struc_data = {}
-        for node in init_group.nodes:
-            cid = node.base.extras.get("cryspy_id")
-            if cid is not None:
-                init_struc_data[cid] = node.get_pymatgen()
+        init_struc_data, _ = load_structures_incremental(init_group_pk, self.inputs.get("init_struc_snapshot"))
 
         # 2. 最適化後の構造データを復元 (opt_struc_data)
+        # スナップショットがあれば、その後に追加された構造だけをGroupから読み込む
         opt_group_pk = self.inputs.optimized_structures_group_pk.value
-        opt_group = load_group(pk=opt_group_pk)
-
-        opt_struc_data = {}
-        for node in opt_group.nodes:
-            cid = node.base.extras.get("cryspy_id")
-            if cid is not None:
-                opt_struc_data[cid] = node.get_pymatgen()
+        opt_struc_data, _ = load_structures_incremental(opt_group_pk, self.inputs.get("opt_struc_snapshot"))
 
 
 
         rin = self.inputs.cryspy_in.rin
-        gen = self.inputs.detail_data.ea_data[0]
+        gen = self.inputs.detail_data.gen
         rslt_data = self.inputs.rslt_data.df
+        # 緩和しなかった構造 (失敗した構造、事前スクリーニングで外した構造) は Group に無いので None にする
+        # (next_gen_EA は今世代の rslt_data の全ての ID を opt_struc_data から引く)
+        for cid in rslt_data.index:
+            opt_struc_data.setdefault(int(cid), None)
         go_next_sg = True
         nat_data = None #組成可変のもの
         structure_mol_id = None
 
-        self.report(f"Generating generation {gen + 1} from {len(opt_struc_data)} parent structures.")
+        n_parents = sum(struc is not None for struc in opt_struc_data.values())
+        self.report(f"Generating generation {gen + 1} from {n_parents} parent structures.")
+
+        # 重複した親を除く (next_gen_EA は opt_struc_data が None の構造を選択に使わない)
+        parent_struc_data = opt_struc_data
+        self.ctx.duplicates = None
+        if self.inputs.prune_duplicates.value:
+            parent_struc_data, self.ctx.duplicates = self.prune_duplicate_parents(gen, opt_struc_data, rslt_data)
 
         # 2. 次世代生成ロジックの実行
         # ctrl_job.next_gen_EA を直接呼び出す
         # (calcfunctionにすると戻り値の構造辞書が巨大になりDBエラーになるため)
-        next_struc_dict, id_queueing, ea_data, rslt_data_new = ctrl_job.next_gen_EA(
-            rin,
-            gen,
-            go_next_sg,
-            init_struc_data,
-            opt_struc_data,
-            rslt_data,
-            nat_data,
-            structure_mol_id
-        )
+        # CrySPY の pickle などは探索のサンドボックスに読み書きする
+        with sandbox.cryspy_sandbox(self.inputs.cryspy_in.run_uuid, self.node):
+            next_struc_dict, id_queueing, ea_data, rslt_data_new = ctrl_job.next_gen_EA(
+                rin,
+                gen,
+                go_next_sg,
+                init_struc_data,
+                parent_struc_data,
+                rslt_data,
+                nat_data,
+                structure_mol_id
+            )
 
         # 3. 新しいGroupの作成と保存
         # 次世代の番号
@@ -96,16 +108,9 @@ class next_sg_WorkChain(WorkChain):
 
         self.report(f"Storing {len(next_struc_dict)} next generation structures to Group<{output_group.pk}>")
 
-        # 構造を保存してGroupに追加
-        for cid, pmg_struct in next_struc_dict.items():
-            # AiiDAのStructureDataに変換
-            s_node = StructureData(pymatgen=pmg_struct)
-            # CrySPY ID を extra に付与
-            s_node.base.extras.set('cryspy_id', cid)
-            # 保存
-            s_node.store()
-            # グループに追加
-            output_group.add_nodes(s_node)
+        # 構造をまとめて保存してGroupに追加 (CrySPY ID は extra に付与)
+        store_structures(next_struc_dict, output_group)
+        timing.count(self, items=len(next_struc_dict))
 
         # 6. コンテキストに保存
         self.ctx.next_group_pk = output_group.pk
@@ -115,6 +120,26 @@ class next_sg_WorkChain(WorkChain):
 
         self.report(f"Next generation (Gen {next_gen}) creation finished.")
 
+    def prune_duplicate_parents(self, gen, opt_struc_data, rslt_data):
+        """
+        世代 gen の構造のうち、エネルギーがより低い最適化済みの構造 (過去の世代を含む) と重複するものを
+        None にした opt_struc_data のコピーを返す。
+        """
+        energies = rslt_data["E_eV_atom"].astype(float).to_dict()
+        targets = rslt_data.index[rslt_data["Gen"] == gen]
+        index = DuplicateIndex()
+        duplicates = find_duplicates(opt_struc_data, energies, targets=targets, index=index)
+
+        parent_struc_data = dict(opt_struc_data)
+        for cid in duplicates:
+            parent_struc_data[cid] = None
+        self.report(
+            f"Pruned {len(duplicates)} duplicate parent(s) of generation {gen} "
+            f"({index.n_candidates} StructureMatcher call(s) for {len(targets)} parent(s) and {len(index)} indexed structure(s))."
+        )
+        return parent_struc_data, duplicates
+
+    @timing.timed_step
     def set_outputs(self):
         # 出力設定
         next_group_pk_node = Int(self.ctx.next_group_pk)
@@ -132,3 +157,10 @@ class next_sg_WorkChain(WorkChain):
         id_queueing_node = List(list=self.ctx.id_queueing)
         id_queueing_node.store()
         self.out("id_queueing", id_queueing_node)
+        timing.count(self, items=len(self.ctx.id_queueing),
+                     nbytes=timing.node_nbytes(rslt_data_node, detail_data_node, id_queueing_node))
+
+        if self.ctx.duplicates is not None:
+            duplicates_node = Dict({str(cid): int(kept) for cid, kept in self.ctx.duplicates.items()})
+            duplicates_node.store()
+            self.out("duplicates", duplicates_node)
@@ -1,34 +1,56 @@
-from aiida.orm import Int,Dict,List,Code,ArrayData,RemoteData,FolderData,load_group,Group
-from aiida.engine import WorkChain,calcfunction,ToContext,while_,append_
+from aiida.orm import Bool,Int,Float,Str,Dict,List,Code,ArrayData,RemoteData,FolderData,load_group,load_node,Group
+from aiida.engine import WorkChain,calcfunction,ToContext,if_,while_
 from aiida.plugins import DataFactory
 from ase.units import GPa  # 圧力の単位（GPa）をASEの内部単位(eV/Å^3)に変換
 import os
+import time
 import uuid
 
+import numpy as np
 from cryspy.job import ctrl_job
 from aiida_mlip.data.model import ModelData
 
+from aiida_cryspy.utils import executors, prescreen, relax_cache, sandbox, timing
+from aiida_cryspy.utils.groups import load_snapshot, load_structure_nodes, load_structures_incremental, make_snapshot, update_structures
+from aiida_cryspy.utils.window import SlidingWindowMixin
+
 StructureCollectionData = DataFactory("aiida_cryspy.structurecollection")
 PandasFrameData = DataFactory("aiida_cryspy.dataframe")
 RinData = DataFactory("aiida_cryspy.rin_data")
 EAData = DataFactory("aiida_cryspy.ea_data")
 StructureData = DataFactory("core.structure")
+StructureEnergyData = DataFactory("aiida_cryspy.structure_energy")
+CompressedTrajectoryData = DataFactory("aiida_cryspy.trajectory")
 
 
 class optimization_WorkChain(WorkChain):
     @classmethod
     def define(cls, spec):
         super().define(spec)
-        spec.input("code", valid_type=Code, help="label of your code")
-        spec.input("structure", valid_type=StructureData, help="selected structure for optimization")
+        spec.input("code", valid_type=Code, required=False, help="label of your code (optional for the local / batched executors: a Python on a core.direct computer, by default this Python on localhost)")
+        spec.input("structure", valid_type=StructureData, required=False, help="selected structure for optimization")
+        spec.input_namespace("structures", valid_type=StructureData, dynamic=True, required=False, help="structures relaxed together in one job (packed mode), keyed by cryspy_id")
         spec.input("parameters", valid_type=Dict)
         spec.input("options", valid_type=Dict, default=Dict, help="metadata.options")
-
-        spec.output("remote_folder", valid_type=RemoteData, help="remote folder of the workchain")
-        spec.output("retrieved", valid_type=FolderData, help="retrieved data from the workchain")
-        spec.output("structure", valid_type=StructureData, help="optimized structure from the workchain")
-        spec.output("array", valid_type=ArrayData, help="array data from the workchain")
-        spec.output("parameters", valid_type=Dict, help="output parameters from the workchain")
+        spec.input("array_job", valid_type=Bool, default=lambda: Bool(False), help="submit structures as one array job (packed mode)")
+        spec.input("executor", valid_type=Str, default=lambda: Str("calcjob"), help="'calcjob' (submit a CalcJob), 'local' (relax in a local process pool) or 'batched' (relax all structures together with a batched FIRE)")
+        spec.input("max_workers", valid_type=Int, default=lambda: Int(0), help="number of worker processes of the local executor (0: number of CPUs)")
+        spec.input("trajectory_policy", valid_type=Str, default=lambda: Str("none"), help="frames of the relaxation to keep: 'none', 'last', 'every' (every trajectory_interval steps and the last) or 'full'")
+        spec.input("trajectory_interval", valid_type=Int, default=lambda: Int(10), help="interval of the frames kept by trajectory_policy='every'")
+        spec.inputs.validator = validate_structure_inputs
+
+        spec.output("remote_folder", valid_type=RemoteData, required=False, help="remote folder of the workchain")
+        spec.output("retrieved", valid_type=FolderData, required=False, help="retrieved data from the workchain")
+        spec.output("structure", valid_type=StructureData, required=False, help="optimized structure from the workchain")
+        spec.output("array", valid_type=ArrayData, required=False, help="array data from the workchain")
+        spec.output("parameters", valid_type=Dict, required=False, help="output parameters from the workchain")
+        spec.output_namespace("structures", valid_type=StructureData, dynamic=True, required=False, help="optimized structures (packed mode)")
+        spec.output_namespace("results", valid_type=Dict, dynamic=True, required=False, help="total_energy of each structure (packed mode)")
+        spec.output("failures", valid_type=Dict, required=False, help="structures failed in the pack (packed mode)")
+        spec.output("trajectory", valid_type=CompressedTrajectoryData, required=False, help="retained frames of the relaxation")
+        spec.output_namespace("trajectories", valid_type=CompressedTrajectoryData, dynamic=True, required=False, help="retained frames of each relaxation (packed mode)")
+
+        spec.exit_code(310, "ERROR_CALCULATION_FAILED", message="The optimization calculation failed.")
 
         spec.outline(
             cls.submit_workchains,
@@ -37,80 +59,135 @@ class optimization_WorkChain(WorkChain):
 
 
 
+    @timing.timed_step
     def submit_workchains(self):
         """
         AiiDAを使って、MattersimによるBaTiO3のセル最適化を実行するための
         最終修正版スクリプト。
+        structures が与えられた場合は、1つのジョブで全ての構造を緩和する (RelaxPackCalculation)。
+        array_job の場合は、1構造を1タスクとするアレイジョブとして投入する。
+        local / batched executor では、このマシンで実行する RelaxPackCalculation として投入する
+        (utils/executors.py)。
         """
-
-        code = self.inputs.code
-        builder = code.get_builder()
-        builder.structure = self.inputs.structure
-        builder.parameters = self.inputs.parameters
-        builder.metadata.options = self.inputs.options.get_dict()
-        # builder.metadata.options.max_wallclock_seconds = 1 * 30 * 60
-        builder.metadata.options.parser_name = "ase.ase"
-        builder.metadata.options.additional_retrieve_list = ["opt.traj", "opt_struc.vasp"]
-        # submit workchain
-        future = self.submit(builder)
+        future = self.submit(executors.get_relax_builder(self.inputs))
         return ToContext(my_future=future)
 
 
+    @timing.timed_step
     def inspect_workchains(self):
         #sleepを入れて並列を確認
         calculations = self.ctx.my_future
 
         if "remote_folder" in calculations.outputs:
             self.out("remote_folder", calculations.outputs.remote_folder)
-        if "array" in calculations.outputs:
-            self.out("array", calculations.outputs.array)
         if "retrieved" in calculations.outputs:
             self.out("retrieved", calculations.outputs.retrieved)
+
+        if not calculations.is_finished_ok:
+            self.report(f"{calculations.process_label}<{calculations.pk}> failed with exit status {calculations.exit_status}")
+            return self.exit_codes.ERROR_CALCULATION_FAILED
+
+        if "array" in calculations.outputs:
+            self.out("array", calculations.outputs.array)
         if "parameters" in calculations.outputs:
             self.out("parameters", calculations.outputs.parameters)
         if "structure" in calculations.outputs:
             self.out("structure", calculations.outputs.structure)
-
-
-@calcfunction
-def pack_results(**kwargs):
+        if "structures" in calculations.outputs and not self.inputs.get("structures"):
+            # local / batched executor の1構造
+            self.inspect_single(calculations)
+            return
+        # packed mode
+        if "structures" in calculations.outputs:
+            self.out("structures", dict(calculations.outputs.structures))
+            self.out("results", dict(calculations.outputs.results))
+        if "failures" in calculations.outputs:
+            self.out("failures", calculations.outputs.failures)
+        if "trajectories" in calculations.outputs:
+            self.out("trajectories", dict(calculations.outputs.trajectories))
+        if "structure" in calculations.outputs and self.inputs.trajectory_policy.value != "none":
+            trajectory = executors.read_ase_trajectory(
+                calculations.outputs.retrieved, self.inputs.trajectory_policy.value, self.inputs.trajectory_interval.value
+            )
+            if trajectory is not None:
+                self.out("trajectory", trajectory)
+
+
+    def inspect_single(self, calculation):
+        """RelaxPackCalculation で緩和した1構造 (キー executors.SINGLE_KEY) を1構造の出力にする"""
+        key = executors.SINGLE_KEY
+        outputs = calculation.outputs
+        self.out("structure", outputs.structures[key])
+        self.out("parameters", outputs.results[key])
+        if "trajectories" in outputs and key in outputs.trajectories:
+            self.out("trajectory", outputs.trajectories[key])
+
+
+def validate_structure_inputs(inputs, _):
+    """structure と structures のどちらか一方だけを受け付ける"""
+    has_structure = "structure" in inputs
+    has_structures = bool(inputs.get("structures"))
+    if has_structure == has_structures:
+        return "specify either `structure` or `structures`."
+    if "array_job" in inputs and inputs["array_job"].value and not has_structures:
+        return "array_job requires `structures`."
+    return executors.validate_executor_inputs(inputs, _)
+
+
+def validate_optimize_inputs(inputs, _):
+    """multi_structure_optimize_WorkChain の入力を確認する"""
+    message = executors.validate_executor_inputs(inputs, _)
+    if message:
+        return message
+    if "prescreen" in inputs and inputs["prescreen"].value:
+        if "prescreen_keep_fraction" not in inputs and "prescreen_window" not in inputs:
+            return "prescreen requires `prescreen_keep_fraction` and/or `prescreen_window`."
+
+
+def iter_relaxed_results(label, node):
     """
-    複数の計算結果ノードを受け取り、エネルギーと構造の辞書（pymatgen.as_dict()）
-    をまとめた一つのDictノードを返す。
+    optimization_WorkChain の出力から (cryspy_id の文字列, parameters, structure) を順に返す。
+    1構造の場合は label ("opt_10") から、packed mode の場合は出力のキーから cryspy_id を得る。
     """
-    final_results = {}
-
-    # 'id_0'のようなキーでデータをグループ化するための辞書
-    grouped_data = {}
-    for key, node in kwargs.items():
-        # キーの名前からID部分 ("id_0"など) を取り出す
-        id_ = '_'.join(key.split('_')[1:])
-
-        # 辞書がなければ作成
-        if id_ not in grouped_data:
-            grouped_data[id_] = {}
+    if "structures" in node.outputs:
+        for cid_str, structure_node in node.outputs.structures.items():
+            yield cid_str, node.outputs.results[cid_str], structure_node
+    elif "structure" in node.outputs:
+        yield label.split('_')[-1], node.outputs.parameters, node.outputs.structure
 
-        # キーのプレフィックスでresultかstructureかを判断
-        if key.startswith("parameters_"):
-            grouped_data[id_]["parameters"] = node
-        elif key.startswith("structure_"):
-            grouped_data[id_]["structure"] = node
 
-    # グループ化されたデータを処理
-    for id_, data in grouped_data.items():
-        # parametersノードからエネルギーを取得
-        energy = data["parameters"].get_dict().get("total_energy")
+def iter_failed_ids(label, node):
+    """
+    optimization_WorkChain で緩和に失敗した構造の cryspy_id の文字列を順に返す。
+    子プロセスが失敗した場合は入力の全ての構造、packed mode で一部が失敗した場合は failures の構造。
+    """
+    if not node.is_finished_ok:
+        if "structures" in node.inputs:
+            yield from node.inputs.structures.keys()
+        else:
+            yield label.split('_')[-1]
+    elif "failures" in node.outputs:
+        yield from node.outputs.failures.keys()
 
-        # structureノードからpymatgenオブジェクトを取得し、JSON互換の辞書に変換
-        struc_dict = data["structure"].get_pymatgen().as_dict()
 
-        final_results[id_] = {"energy": energy, "structure": struc_dict}
+@calcfunction
+def pack_results(opt_struc_snapshot, energies):
+    """
+    今世代に緩和した構造とエネルギーを1つの StructureEnergyData にまとめる。
+    構造は最適化済みGroupのスナップショットから今世代の cryspy_id の分だけ取り出す
+    (子プロセスの出力ごとのリンクは作らない)。
 
-    # Python辞書をAiiDAのDictノードとして返す
-    return Dict(dict=final_results)
+    Args:
+        opt_struc_snapshot (StructureCollectionData): 最適化済みGroupのスナップショット
+        energies (Dict): {'energy': {cid: 全エネルギー [eV]}, 'enthalpy': {cid: 1原子あたりのエンタルピー [eV/atom]}}
+    """
+    energies = energies.get_dict()
+    ids = [int(cid) for cid in energies["energy"]]
+    structures, _ = load_snapshot(opt_struc_snapshot, ids)
+    return StructureEnergyData(structures, energies["energy"], energies["enthalpy"])
 
 
-class multi_structure_optimize_WorkChain(WorkChain):
+class multi_structure_optimize_WorkChain(sandbox.SandboxLockMixin, SlidingWindowMixin, WorkChain):
     @classmethod
     def define(cls, spec):
         super().define(spec)
@@ -120,234 +197,563 @@ class multi_structure_optimize_WorkChain(WorkChain):
         spec.input("cryspy_in", valid_type=RinData, help="RinData for cryspy input")
         spec.input("detail_data", valid_type=(Dict, EAData), help="EA data for optimization")
         spec.input("id_queueing", valid_type=List, help="list of IDs for queuing structures for optimization")
-        spec.input("code", valid_type=Code, help="label of your code")
+        spec.input("code", valid_type=Code, required=False, help="label of your code (optional for the local / batched executors: a Python on a core.direct computer, by default this Python on localhost)")
         spec.input("potential", valid_type=ModelData, required=False, help="MLIP model data")
         spec.input("parameters", valid_type=Dict, help="calculation parameters")
         spec.input("options", valid_type=Dict, default=Dict, help="metadata.options")
-
-        spec.output("structure_energy_data", valid_type=Dict, help="sorted energy results with structure data")
+        spec.input("opt_struc_snapshot", valid_type=StructureCollectionData, required=False, help="snapshot of the optimized group from the previous generation")
+        spec.input("max_concurrent", valid_type=Int, default=lambda: Int(100), help="maximum number of optimization processes running at the same time")
+        spec.input("pack_size", valid_type=Int, required=False, help="number of structures relaxed in one job (K)")
+        spec.input("pack_walltime", valid_type=Int, required=False, help="target wall-time [s] of one packed job; K = pack_walltime // seconds_per_structure")
+        spec.input("seconds_per_structure", valid_type=Int, default=lambda: Int(60), help="estimated time [s] to relax one structure (used with pack_walltime)")
+        spec.input("array_job", valid_type=Bool, default=lambda: Bool(False), help="submit each pack as one array job (one task per structure)")
+        spec.input("executor", valid_type=Str, default=lambda: Str("calcjob"), help="'calcjob', 'local' or 'batched' (see optimization_WorkChain)")
+        spec.input("max_workers", valid_type=Int, default=lambda: Int(0), help="number of worker processes of the local executor (0: number of CPUs)")
+        spec.input("use_relax_cache", valid_type=Bool, default=lambda: Bool(False), help="reuse relaxations of symmetry-equivalent structures with the same parameters")
+        spec.input("trajectory_policy", valid_type=Str, default=lambda: Str("none"), help="frames of each relaxation to keep (see optimization_WorkChain)")
+        spec.input("trajectory_interval", valid_type=Int, default=lambda: Int(10), help="interval of the frames kept by trajectory_policy='every'")
+        spec.input("prescreen", valid_type=Bool, default=lambda: Bool(False), help="evaluate all structures cheaply first and fully relax only the best ones")
+        spec.input("prescreen_steps", valid_type=Int, default=lambda: Int(0), help="optimizer steps of the prescreen (0: single-point evaluation)")
+        spec.input("prescreen_keep_fraction", valid_type=Float, required=False, help="fraction of the structures (lowest enthalpy first) fully relaxed after the prescreen")
+        spec.input("prescreen_window", valid_type=Float, required=False, help="structures within this enthalpy [eV/atom] of the best prescreened one are fully relaxed")
+        spec.input("resume_from", valid_type=Int, required=False, help="PK of an interrupted multi_structure_optimize_WorkChain of the same generation; its finished relaxations are registered without relaxing again")
+        spec.inputs.validator = validate_optimize_inputs
+
+        spec.output("structure_energy_data", valid_type=StructureEnergyData, required=False, help="relaxed structures of this generation with their energies (use sorted_by() for the best ones)")
         spec.output("rslt_data", valid_type=PandasFrameData, help="result data in Pandas DataFrame format")
+        spec.output("opt_struc_snapshot", valid_type=StructureCollectionData, required=False, help="snapshot of the optimized group (opt_struc_data)")
+        spec.output("init_struc_snapshot", valid_type=StructureCollectionData, required=False, help="snapshot of the initial group (init_struc_data)")
         spec.output_namespace("structure", valid_type=StructureData, dynamic=True)
+        spec.output("relax_cache_stats", valid_type=Dict, required=False, help="hits and misses of the relaxation cache")
+        spec.output("prescreen_results", valid_type=Dict, required=False, help="enthalpy per atom of the prescreen and the kept / rejected IDs")
 
         spec.exit_code(300, "ERROR_SUB_PROCESS_FAILED", message="One or more subprocesses failed.")
 
 
         spec.outline(
             cls.setup,
-            while_(cls.should_run_batch)(
-                cls.submit_batch,
-                cls.process_batch_results,
+            cls.reuse_completed, # 中断した前回の実行で終わっている緩和を登録する
+            if_(cls.should_prescreen)(
+                while_(cls.should_run_window)(
+                    cls.submit_window,
+                    cls.process_finished,
+                ),
+                cls.select_prescreened, # 事前スクリーニングの結果から本緩和する構造を選ぶ
+            ),
+            while_(cls.should_run_window)(
+                cls.submit_window,
+                cls.process_finished,
             ),
             cls.collect_results # 最後に結果をまとめる
         )
 
 
+    @timing.timed_step
     def setup(self):
         """
-        最初に一度だけ呼ばれ、全体のタスクリストとバッチサイズを準備する。
+        最初に一度だけ呼ばれ、全体のタスクリストと同時実行数を準備する。
         """
         self.ctx.ids_to_process = list(self.inputs.id_queueing)
-        self.ctx.batch_size = 100  # <-- バッチサイズをここで設定
+        self.ctx.max_concurrent = self.inputs.max_concurrent.value
+        self.ctx.pack_size = self.get_pack_size()
+        self.ctx.in_flight = {} # 実行中の子プロセス {pk: label}
         self.ctx.all_submitted_calcs = {} # 全ての計算結果を保存する辞書
-
-
-    # ★ whileループの継続条件メソッドを追加
-    def should_run_batch(self):
+        self.ctx.relax_keys = {} # 緩和キャッシュのキー {cid: key}
+        self.ctx.cache_hits = {} # 緩和キャッシュにあった構造 {cid: [緩和後の構造のpk, 全エネルギー]}
+        self.ctx.registered = {} # 登録済みの構造 {cid: {'parameters': pk, 'structure': pk, 'energy', 'enthalpy', 'row': rslt_data の行}} (緩和しなかった構造は structure が None)
+        self.ctx.stage = "relax"
+        self.ctx.prescreen_calcs = {} # 事前スクリーニングの子プロセス {label: node}
+        self.ctx.prescreened = {} # 事前スクリーニング後の構造 {cid: 構造のpk} (本緩和の初期構造にする)
+        self.ctx.parameters = self.inputs.parameters
+        if self.inputs.prescreen.value:
+            self.ctx.stage = "prescreen"
+            self.ctx.parameters = self.get_prescreen_parameters()
+
+
+    @sandbox.locked_step(lambda self: [self.inputs.cryspy_in.run_uuid])
+    @timing.timed_step
+    def reuse_completed(self):
         """
-        処理すべきIDが残っていればTrueを返す。
+        resume_from (同じ世代の中断した multi_structure_optimize_WorkChain) の本緩和で
+        正常に終わった子プロセスの結果を登録し、待ち行列から外す。
+        事前スクリーニングは残りの構造についてやり直す。
         """
-        return len(self.ctx.ids_to_process) > 0
-
+        if "resume_from" not in self.inputs:
+            return
+        queued = {str(cid) for cid in self.ctx.ids_to_process}
+        completed = {}
+        # 前回の実行も再開だった場合は、その resume_from もたどる
+        previous = load_node(self.inputs.resume_from.value)
+        while previous is not None:
+            for node in previous.called:
+                if node.process_label != optimization_WorkChain.__name__ or not node.label.startswith("opt_"):
+                    continue
+                if not node.is_finished_ok:
+                    continue
+                for cid_str, parameters_node, structure_node in iter_relaxed_results(node.label, node):
+                    if cid_str in queued:
+                        completed.setdefault(cid_str, (parameters_node, structure_node))
+            previous = load_node(previous.inputs.resume_from.value) if "resume_from" in previous.inputs else None
+        if not completed:
+            return
+
+        structure_map = load_structure_nodes(self.inputs.initial_structures_group_pk.value, [int(cid) for cid in completed])
+        for cid, structure_node in structure_map.items():
+            self.out(f"structure.{cid}", structure_node)
+        for cid_str in sorted(completed, key=int):
+            self.register_result(cid_str, *completed[cid_str])
+        self.ctx.ids_to_process = [cid for cid in self.ctx.ids_to_process if str(cid) not in completed]
+        self.report(f"Resume: reusing {len(completed)} finished relaxations of <{self.inputs.resume_from.value}>, "
+                    f"{len(self.ctx.ids_to_process)} structures left.")
 
-    def submit_batch(self):
 
-        group_pk = self.inputs.initial_structures_group_pk.value
-        input_group = load_group(pk=group_pk)
-        current_batch_ids = self.ctx.ids_to_process[:self.ctx.batch_size]
+    def get_prescreen_parameters(self):
+        """事前スクリーニングの parameters (optimizer.run_args.steps を prescreen_steps にする)"""
+        parameters_node = Dict(prescreen.prescreen_parameters(self.inputs.parameters.get_dict(), self.inputs.prescreen_steps.value))
+        parameters_node.store()
+        return parameters_node
 
-        # Groupから必要なNodeを探すためのマップを作る
-        structure_map = {}
-        for node in input_group.nodes:
-            cid = node.base.extras.get('cryspy_id')
-            if cid in current_batch_ids:
-                structure_map[cid] = node
 
-        self.report(f"Submitting optimization for {len(structure_map)} structures.")
+    def should_prescreen(self):
+        return self.ctx.stage == "prescreen"
 
-        for cid,structure_node in structure_map.items():
-            structure_node.store()
-            self.out(f"structure.{cid}", structure_node)
 
-            future = self.submit(optimization_WorkChain,
-                code=self.inputs.code,
-                structure=structure_node,
-                parameters=self.inputs.parameters,
-                options=self.inputs.options,
-            )
+    def get_pack_size(self):
+        """
+        1つのジョブで緩和する構造の数 K。
+        pack_size が無ければ pack_walltime から決める (どちらも無ければ1構造ずつ)。
+        array_job でどちらも無い場合は、全ての構造を1つのアレイジョブにする。
+        local / batched executor でどちらも無い場合は、全ての構造を1回で緩和する。
+        """
+        if "pack_size" in self.inputs:
+            return max(self.inputs.pack_size.value, 1)
+        if "pack_walltime" in self.inputs:
+            return max(self.inputs.pack_walltime.value // self.inputs.seconds_per_structure.value, 1)
+        if self.inputs.array_job.value or self.inputs.executor.value in ("local", "batched"):
+            return max(len(self.ctx.ids_to_process), 1)
+        return 1
 
-            future.label = f"opt_{cid}"  # IDを文字列としてラベル付け
 
-            self.to_context(calculations=append_(future))
+    def should_run_window(self):
+        """
+        処理すべきID、または実行中の子プロセスが残っていればTrueを返す。
+        """
+        return len(self.ctx.ids_to_process) > 0 or len(self.ctx.in_flight) > 0
 
-        #処理した分を待ち行列から削除
-        self.ctx.ids_to_process = self.ctx.ids_to_process[self.ctx.batch_size:]
 
+    @sandbox.locked_step(lambda self: [self.inputs.cryspy_in.run_uuid] if self.inputs.use_relax_cache.value else [])
+    @timing.timed_step
+    def submit_window(self):
+        """
+        実行中の子プロセスが max_concurrent 個になるまで投入し、
+        1つが終わるまで待つ。
+        pack_size (K) > 1 の場合は K 構造ずつ1つの子プロセスにまとめる。
+        """
+        pack_size = self.ctx.pack_size
+        n_free = self.ctx.max_concurrent - len(self.ctx.in_flight)
+        current_batch_ids = self.ctx.ids_to_process[:max(n_free, 0) * pack_size]
+
+        if current_batch_ids:
+            # Groupから今回投入するNodeだけを1回のクエリで取得する
+            group_pk = self.inputs.initial_structures_group_pk.value
+            structure_map = load_structure_nodes(group_pk, current_batch_ids)
+
+            timing.count(self, items=len(structure_map))
+            self.report(f"Submitting optimization for {len(structure_map)} structures "
+                        f"({len(self.ctx.in_flight)} running, {len(self.ctx.ids_to_process) - len(current_batch_ids)} waiting).")
+
+            if self.ctx.stage == "relax" and self.inputs.prescreen.value:
+                # 事前スクリーニング後の構造から本緩和する (初期構造は出力済み)
+                structure_map = {cid: load_node(self.ctx.prescreened[str(cid)]) for cid in structure_map}
+            else:
+                for cid,structure_node in structure_map.items():
+                    structure_node.store()
+                    self.out(f"structure.{cid}", structure_node)
+
+                if self.inputs.use_relax_cache.value:
+                    structure_map = self.apply_relax_cache(structure_map)
+
+            # 全ての子プロセスに共通の入力
+            common_inputs = {
+                "parameters": self.ctx.parameters,
+                "options": self.inputs.options,
+                "executor": self.inputs.executor,
+                "max_workers": self.inputs.max_workers,
+            }
+            if "code" in self.inputs:
+                common_inputs["code"] = self.inputs.code
+            if self.ctx.stage == "relax":
+                # 事前スクリーニングの軌跡は残さない
+                common_inputs["trajectory_policy"] = self.inputs.trajectory_policy
+                common_inputs["trajectory_interval"] = self.inputs.trajectory_interval
+
+            prefix = "prescreen" if self.ctx.stage == "prescreen" else "opt"
+            cids = list(structure_map)
+            for i in range(0, len(cids), pack_size):
+                pack = cids[i:i + pack_size]
+                if pack_size == 1 and not self.inputs.array_job.value:
+                    future = self.submit(optimization_WorkChain,
+                        structure=structure_map[pack[0]],
+                        **common_inputs,
+                    )
+                    future.label = f"{prefix}_{pack[0]}"  # IDを文字列としてラベル付け
+                else:
+                    future = self.submit(optimization_WorkChain,
+                        structures={str(cid): structure_map[cid] for cid in pack},
+                        array_job=self.inputs.array_job,
+                        **common_inputs,
+                    )
+                    future.label = f"{prefix}_pack_{pack[0]}-{pack[-1]}"
+                self.ctx.in_flight[future.pk] = future.label
+
+            #処理した分を待ち行列から削除
+            self.ctx.ids_to_process = self.ctx.ids_to_process[len(current_batch_ids):]
+
+        # 終わった子プロセスがあれば (なければ最も早く投入したものが終わった時点で) process_finished へ進む
+        self.wait_for_next([load_node(pk) for pk in self.ctx.in_flight])
+
+
+    def apply_relax_cache(self, structure_map):
+        """
+        既に緩和した構造 (対称的に等価な構造と同じ parameters) は投入せずに結果を再利用する。
 
+        Returns:
+            投入が必要な構造 {cid: StructureData}
+        """
+        keys, hits, misses = relax_cache.split_cached(structure_map, self.inputs.parameters.get_dict())
+        for cid, key in keys.items():
+            self.ctx.relax_keys[str(cid)] = key
+        for cid, hit in hits.items():
+            self.ctx.cache_hits[str(cid)] = list(hit)
+            self.register_result(str(cid), *relax_cache.clone_cached(*hit))
+        if hits:
+            self.report(f"Relax cache: reusing {len(hits)} of {len(structure_map)} structures.")
+        return misses
+
+
+    @sandbox.locked_step(lambda self: [self.inputs.cryspy_in.run_uuid])
+    @timing.timed_step
+    def process_finished(self):
+        """
+        終了した子プロセスを記録し、実行中のリストから外す。
+        本緩和の結果はここで登録する (最後にまとめて登録しない)。
+        """
+        self.clear_wait()
+        for pk in list(self.ctx.in_flight):
+            calculation = load_node(pk)
+            if not calculation.is_terminated:
+                continue
+            # label ("opt_10", "opt_pack_10-19") をキーにして保存
+            if self.ctx.stage == "prescreen":
+                self.ctx.prescreen_calcs[calculation.label] = calculation
+            else:
+                self.ctx.all_submitted_calcs[calculation.label] = calculation
+                self.register_finished(calculation.label, calculation)
+            del self.ctx.in_flight[pk]
 
 
-    # ★ バッチごとの結果を処理するメソッドを追加
-    def process_batch_results(self):
+    @sandbox.locked_step(lambda self: [self.inputs.cryspy_in.run_uuid])
+    @timing.timed_step
+    def select_prescreened(self):
         """
-        完了したバッチの結果を一時的に保存する。
+        事前スクリーニングのエンタルピー (1原子あたり, scalar_pressure を含む) で構造を順位付けし、
+        上位 prescreen_keep_fraction または最良の構造から prescreen_window 以内の構造だけを本緩和の待ち行列に入れる
+        (utils/prescreen.py)。
+        外した構造は Opt=PRESCREEN_REJECTED、事前スクリーニングに失敗した構造は Opt=RELAX_FAILED として、
+        緩和に失敗した構造と同じくエネルギー NaN・opt_struc_data None で登録する (本緩和も親の選択もしない)。
         """
-        # 結果を回収
-        for calculation in self.ctx.calculations:
-            # label ("opt_10") をキーにして保存 (辞書なので上書きされても害はないが、無駄な処理になる)
-            self.ctx.all_submitted_calcs[calculation.label] = calculation
+        target_pressure_gpa = self.get_target_pressure()
+        enthalpies = {}
+        results = {}
+        for label, node in self.ctx.prescreen_calcs.items():
+            if not node.is_finished_ok:
+                self.report(f'Prescreen {label} failed with exit status {node.exit_status}')
+            for cid_str in iter_failed_ids(label, node):
+                self.register_unrelaxed(cid_str, prescreen.RELAX_FAILED)
+            if not node.is_finished_ok:
+                continue
+            for cid_str, parameters_node, structure_node in iter_relaxed_results(label, node):
+                enthalpies[cid_str] = prescreen.enthalpy_per_atom(
+                    parameters_node['total_energy'], structure_node.get_pymatgen(), target_pressure_gpa
+                )
+                results[cid_str] = structure_node
 
-        # 【修正】処理が終わったらリストを空にする (次のバッチのためにリセット)
-        self.ctx.calculations = []
+        kept, rejected = prescreen.select(
+            enthalpies,
+            keep_fraction=self.inputs.prescreen_keep_fraction.value if "prescreen_keep_fraction" in self.inputs else None,
+            window=self.inputs.prescreen_window.value if "prescreen_window" in self.inputs else None,
+        )
+        if self.inputs.prescreen_steps.value == 0:
+            # 1点計算では構造は変わらないので、初期構造から緩和する
+            initial = load_structure_nodes(self.inputs.initial_structures_group_pk.value, [int(cid) for cid in kept])
+            self.ctx.prescreened = {str(cid): node.pk for cid, node in initial.items()}
+        else:
+            self.ctx.prescreened = {cid_str: results[cid_str].pk for cid_str in kept}
+        for cid_str in rejected:
+            self.register_unrelaxed(cid_str, prescreen.PRESCREEN_REJECTED)
+
+        self.report(f"Prescreen: fully relaxing {len(kept)} of {len(enthalpies)} structures "
+                    f"({len(rejected)} rejected, {len(self.ctx.cache_hits)} from the relax cache).")
+        prescreen_node = Dict({
+            "enthalpy_per_atom": enthalpies,
+            "kept": [int(cid) for cid in kept],
+            "rejected": [int(cid) for cid in rejected],
+        })
+        prescreen_node.store()
+        self.out("prescreen_results", prescreen_node)
+
+        self.ctx.ids_to_process = [int(cid) for cid in kept]
+        self.ctx.stage = "relax"
+        self.ctx.parameters = self.inputs.parameters
+
+
+    def get_target_pressure(self):
+        """parameters の optimizer.setup.scalar_pressure [GPa] (存在しなければ 0.0 GPa とする)"""
+        target_pressure_gpa = 0.0
+        try:
+            optimizer_params = self.inputs.parameters.get_dict().get('optimizer', {})
+            setup_params = optimizer_params.get('setup', {})
+            # キーが存在しない、または None の場合は 0.0 を採用
+            target_pressure_gpa = setup_params.get('scalar_pressure', 0.0)
+            if target_pressure_gpa is None:
+                target_pressure_gpa = 0.0
+        except Exception:
+            # 読み込みに失敗した場合も0.0 とする
+            self.report("Warning: Could not read scalar_pressure. Assuming 0.0 GPa.")
+            target_pressure_gpa = 0.0
+        return target_pressure_gpa
 
 
 
+    @timing.timed_step
     def collect_results(self):
+        """
+        登録済みの結果から出力をまとめる。
+        CrySPYへの登録は子プロセスが終わるたびに register_finished で済ませている。
+        """
+        registry = self.get_registry()
+        gen = registry["gen"]
+
+        if self.inputs.use_relax_cache.value:
+            hits = len(self.ctx.cache_hits)
+            misses = len(self.ctx.relax_keys) - hits
+            self.report(f"Generation {gen} relax cache: {hits} hits, {misses} misses.")
+            stats_node = Dict({"gen": gen, "hits": hits, "misses": misses})
+            stats_node.store()
+            self.out("relax_cache_stats", stats_node)
+
+        rslt_node = PandasFrameData(registry["rslt_data"])
+        rslt_node.store()
+        self.out('rslt_data', rslt_node)
 
-        # RinDataと世代(gen)の取得（グループ名に使用するため先に取得）
-        rin_data = self.inputs.cryspy_in
-        rin = rin_data.rin
+        # 次世代用のスナップショット (今世代に追加された構造だけを読み込んで更新)
+        output_group = registry["output_group"]
+        opt_all, opt_id_map = update_structures(output_group.pk, registry["prev_opt_struc_data"], registry["opt_id_map"])
+        # 前世代のスナップショットからの差分だけを保存する
+        opt_snapshot = make_snapshot(output_group.pk, opt_all, opt_id_map, previous=self.inputs.get("opt_struc_snapshot"))
+        opt_snapshot.store()
+        self.out('opt_struc_snapshot', opt_snapshot)
+
+        relaxed = {cid_str: entry for cid_str, entry in self.ctx.registered.items() if entry["structure"] is not None}
+        if relaxed:
+            energies = Dict({
+                "energy": {cid_str: entry["energy"] for cid_str, entry in relaxed.items()},
+                "enthalpy": {cid_str: entry["enthalpy"] for cid_str, entry in relaxed.items()},
+            })
+            self.out("structure_energy_data", pack_results(opt_snapshot, energies))
+
+        init_snapshot = make_snapshot(self.inputs.initial_structures_group_pk.value, registry["init_struc_data"], registry["init_id_map"])
+        init_snapshot.store()
+        self.out('init_struc_snapshot', init_snapshot)
+
+        timing.count(self, items=len(self.ctx.registered), nbytes=timing.node_nbytes(rslt_node, opt_snapshot, init_snapshot))
+        self.report(f"Generation {gen} All structures optimization Done.")
+
+
+    def get_registry(self):
+        """
+        登録に使う CrySPY のデータ (init_struc_data, opt_struc_data, rslt_data など)。
+        プロセスのメモリに保持し、チェックポイントには入れない。
+        再起動した場合は入力から読み直し、ctx.registered に記録済みの rslt_data の行を戻す
+        (登録済みの構造の spglib の解析や Group への追加はやり直さない)。
+        """
+        registry = getattr(self, "_registry", None)
+        if registry is not None:
+            return registry
 
+        # RinDataと世代(gen)の取得
+        rin = self.inputs.cryspy_in.rin
         gen = 1 # デフォルト値 (RSの場合など)
         if rin.algo == "EA":
-            # EADataの場合はリストから世代を取得
+            # EADataの場合は属性から世代を取得 (pickleは読み込まない)
             if isinstance(self.inputs.detail_data, Dict):
                  gen = self.inputs.detail_data.get_dict().get("ea_data")[0]
             else:
-                 gen = self.inputs.detail_data.ea_data[0]
-
-
+                 gen = self.inputs.detail_data.gen
 
         # 初期構造辞書を復元
-        input_group = load_group(pk=self.inputs.initial_structures_group_pk.value)
-        init_struc_data = {}
-        for node in input_group.nodes:
-            cid = node.base.extras.get('cryspy_id')
-            if cid is not None:
-                init_struc_data[cid] = node.get_pymatgen()
-
+        init_struc_data, init_id_map = load_structures_incremental(self.inputs.initial_structures_group_pk.value)
 
         # 全世代の最適化後の構造を辞書に復元
+        # 前世代のスナップショット + 差分だけを読み込む
         output_group = load_group(pk=self.inputs.optimized_structures_group_pk.value)
-        opt_struc_data = {}
-        for node in output_group.nodes:
-            # extrasからIDを取得
-            cid = node.base.extras.get('cryspy_id')
-            if cid is not None:
-                # pymatgenオブジェクトに変換して辞書に格納
-                opt_struc_data[cid] = node.get_pymatgen()
+        opt_struc_data, opt_id_map = load_structures_incremental(output_group.pk, self.inputs.get("opt_struc_snapshot"))
+
+        rslt_data = self.inputs.rslt_data.df
+        for cid_str, entry in self.ctx.registered.items():
+            if entry["row"] is not None:
+                rslt_data.loc[int(cid_str)] = entry["row"]
+
+        self._registry = registry = {
+            "rin": rin,
+            "gen": gen,
+            "init_struc_data": init_struc_data,
+            "init_id_map": init_id_map,
+            "opt_struc_data": opt_struc_data,
+            "prev_opt_struc_data": dict(opt_struc_data), # regist_optで書き換えられるためコピーしておく
+            "opt_id_map": opt_id_map,
+            "rslt_data": rslt_data,
+            "output_group": output_group,
+            "target_pressure_gpa": self.get_target_pressure(),
+        }
+        return registry
+
+
+    def register_finished(self, label, node):
+        """
+        終了した子プロセス (optimization_WorkChain) の結果をすぐに登録する。
+        緩和に失敗した構造も Opt=RELAX_FAILED (エネルギー NaN) として登録する。
+        """
+        if not node.is_finished_ok:
+            self.report(f'Sub-process {label} failed with exit status {node.exit_status}')
+        elif "failures" in node.outputs:
+            # packed mode で失敗した構造 (他の構造は登録する)
+            failed = sorted(node.outputs.failures.keys(), key=int)
+            self.report(f'Sub-process {label}: optimization failed for IDs {failed}')
+
+        for cid_str in iter_failed_ids(label, node):
+            self.register_unrelaxed(cid_str, prescreen.RELAX_FAILED)
+        if not node.is_finished_ok:
+            return
 
-        calcfunc_inputs = {}
+        interval = timing.relaxation_interval(node)
+        for cid_str, parameters_node, structure_node in iter_relaxed_results(label, node):
+            self.register_result(cid_str, parameters_node, structure_node, interval=interval)
 
-        rslt_data_node = self.inputs.rslt_data
-        rslt_data = rslt_data_node.df
 
+    def register_unrelaxed(self, cid_str, check_opt):
+        """
+        緩和しなかった構造 (失敗した構造、事前スクリーニングで外した構造) を CrySPY の失敗した構造と同じく
+        opt_struc_data を None、エネルギーを NaN として rslt_data に登録する。
+        Group には追加しないので、次世代の親やエリートには選ばれない。
+        """
+        if cid_str in self.ctx.registered:
+            return
+        cid = int(cid_str)
+        row = self.regist_opt(cid, None, np.nan, check_opt)
+        timing.count(self, items=1)
+        self.ctx.registered[cid_str] = {
+            "parameters": None,
+            "structure": None,
+            "energy": None,
+            "enthalpy": None,
+            "row": row,
+        }
+
+
+    def register_result(self, cid_str, parameters_node, structure_node, check_opt=None, interval=None):
+        """
+        1構造の緩和結果をGroupとCrySPY (opt_struc_data, rslt_data) に登録し、ctx.registered に記録する。
+        check_opt は rslt_data の Opt 列に入る。
+        interval (timing.relaxation_interval) があれば、緩和した子プロセスの時刻を構造の extras に記録する。
+        """
+        if cid_str in self.ctx.registered:
+            return
+        registry = self.get_registry()
+        target_pressure_gpa = registry["target_pressure_gpa"]
+        cid = int(cid_str)
 
+        # Total Energy [eV]
+        energy = parameters_node['total_energy']
 
-        # 圧力設定の取得 (存在しなければ 0.0 GPa とする)
-        target_pressure_gpa = 0.0
-        try:
-            optimizer_params = self.inputs.parameters.get_dict().get('optimizer', {})
-            setup_params = optimizer_params.get('setup', {})
-            # キーが存在しない、または None の場合は 0.0 を採用
-            target_pressure_gpa = setup_params.get('scalar_pressure', 0.0)
-            if target_pressure_gpa is None:
-                target_pressure_gpa = 0.0
-        except Exception:
-            # 読み込みに失敗した場合も0.0 とする
-            self.report("Warning: Could not read scalar_pressure. Assuming 0.0 GPa.")
-            target_pressure_gpa = 0.0
+        # Structure & Volume
+        opt_struc = structure_node.get_pymatgen()
+        volume = opt_struc.volume       # [A^3]
+        num_atoms = opt_struc.num_sites # [atoms]
 
-        #self.report(f"Collecting results using Target Pressure = {target_pressure_gpa} GPa")
+        # H = E + PV
+        # P=0なら pv_term=0 となり、H=E となる
+        pv_term = (target_pressure_gpa * GPa) * volume
+        enthalpy_total = energy + pv_term
 
+        # 一原子あたりの値
+        final_val_per_atom = enthalpy_total / num_atoms
 
+        # ログ出力（デバッグ用）
+        # P=0 のときは PV=0 と表示
+        self.report(f"ID={cid}: E={energy:.2f}, P={target_pressure_gpa}GPa, PV={pv_term:.2f} -> H_total={enthalpy_total:.2f}")
 
-        # 4. 結果回収ループ
-        for label, results_node in self.ctx.all_submitted_calcs.items():
-            if not results_node.is_finished_ok:
-                self.report(f'Sub-process {label} failed with exit status {results_node.exit_status}')
-                continue
 
-            cid_str = label.split('_')[-1]
-            cid = int(cid_str)
-
-            calcfunc_inputs[f"parameters_{cid_str}"] = results_node.outputs.parameters
-            calcfunc_inputs[f"structure_{cid_str}"] = results_node.outputs.structure
-
-            # Total Energy [eV]
-            energy = results_node.outputs.parameters['total_energy']
-
-            # Structure & Volume
-            structure_node = results_node.outputs.structure
-            opt_struc = structure_node.get_pymatgen()
-            volume = opt_struc.volume       # [A^3]
-            num_atoms = opt_struc.num_sites # [atoms]
-
-            # H = E + PV
-            # P=0なら pv_term=0 となり、H=E となる
-            pv_term = (target_pressure_gpa * GPa) * volume
-            enthalpy_total = energy + pv_term
-
-            # 一原子あたりの値
-            final_val_per_atom = enthalpy_total / num_atoms
-
-            # ログ出力（デバッグ用）
-            # P=0 のときは PV=0 と表示
-            self.report(f"ID={cid}: E={energy:.2f}, P={target_pressure_gpa}GPa, PV={pv_term:.2f} -> H_total={enthalpy_total:.2f}")
-
-
-            # print(f"ID: {cid}, Energy: {energy}")
-
-            # Groupに追加
-            structure_node.base.extras.set('cryspy_id', cid)
-            output_group.add_nodes(structure_node)
-            #self.report(f"Added StructureData<{structure_node.pk}> with cryspy_id={cid} to Group<{output_group.pk}>")
-
-            gen_arg = None
-            if rin.algo == "EA":
-                gen_arg = gen
-
-            try:
-                # CrySPY登録
-                opt_struc_data, rslt_data = ctrl_job.regist_opt(
-                    rin,
-                    cid,
-                    init_struc_data,
-                    opt_struc_data,
-                    rslt_data,
-                    opt_struc,
-                    final_val_per_atom,
-                    magmom=None,
-                    check_opt=None,
-                    ef=None,
-                    nat=None,
-                    n_selection=None,
-                    gen=gen_arg
-                )
-            except Exception as e:
-                self.report(f"ERROR: Failed to register structure ID: {cid}. Skipping this structure.")
-                self.report(f"Reason: {e}")
-                continue
+        # print(f"ID: {cid}, Energy: {energy}")
 
-        if calcfunc_inputs:
-            structure_energy_data_results = pack_results(**calcfunc_inputs)
-            self.out("structure_energy_data", structure_energy_data_results)
+        # 緩和キャッシュ用に初期構造のキーとエネルギーを記録
+        key = self.ctx.relax_keys.get(cid_str)
+        if key is not None and check_opt is None:
+            relax_cache.tag_relaxed(structure_node, key, energy)
 
-        rslt_node = PandasFrameData(rslt_data)
-        rslt_node.store()
-        self.out('rslt_data', rslt_node)
+        # Groupに追加
+        extras = {'cryspy_id': cid}
+        if interval is not None:
+            extras[timing.STRUCTURE_TIMING_EXTRA] = dict(interval, registered=time.time())
+        structure_node.base.extras.set_many(extras)
+        registry["output_group"].add_nodes(structure_node)
+        #self.report(f"Added StructureData<{structure_node.pk}> with cryspy_id={cid} to Group<{output_group.pk}>")
 
-        self.report(f"Generation {gen} All structures optimization Done.")
+        row = self.regist_opt(cid, opt_struc, final_val_per_atom, check_opt)
 
+        timing.count(self, items=1)
 
+        # チェックポイントに残す記録 (再起動時に rslt_data を復元する)
+        self.ctx.registered[cid_str] = {
+            "parameters": parameters_node.pk,
+            "structure": structure_node.pk,
+            "energy": energy,
+            "enthalpy": final_val_per_atom,
+            "row": row,
+        }
 
 
+    def regist_opt(self, cid, opt_struc, energy, check_opt):
+        """
+        1構造を CrySPY の regist_opt で登録し、rslt_data の行 (チェックポイントに残せる値のリスト) を返す。
+        登録の失敗は握りつぶさずに送出する (ロックが取れない SandboxBusy ならステップごとやり直す)。
 
+        同じ探索の複数の WorkChain (steady_state の子プロセスなど) が同じサンドボックスの pickle に登録するため、
+        ロックの中でサンドボックスの最新の opt_struc_data / rslt_data を読み込み、1行を加えて書き戻す
+        (自分の registry をそのまま書き出すと、その間に他の WorkChain が登録した行が消える)。
+        registry には登録した1行だけを反映する。
+        """
+        registry = self.get_registry()
+        rin = registry["rin"]
+        with sandbox.cryspy_sandbox(self.inputs.cryspy_in.run_uuid, self.node) as path:
+            opt_struc_data, rslt_data = registry["opt_struc_data"], registry["rslt_data"]
+            if path is not None:
+                opt_struc_data, rslt_data = sandbox.load_registered(opt_struc_data, rslt_data)
+            opt_struc_data, rslt_data = ctrl_job.regist_opt(
+                rin,
+                cid,
+                registry["init_struc_data"],
+                opt_struc_data,
+                rslt_data,
+                opt_struc,
+                energy,
+                magmom=None,
+                check_opt=check_opt,
+                ef=None,
+                nat=None,
+                n_selection=None,
+                gen=registry["gen"] if rin.algo == "EA" else None,
+            )
+        registry["opt_struc_data"][cid] = opt_struc
+        registry["rslt_data"].loc[cid] = rslt_data.loc[cid]
+        return [value.item() if hasattr(value, "item") else value for value in rslt_data.loc[cid]]
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+構造緩和のベンチマーク (CPU)。
+
+同じ構造を
+  - 1構造ずつ ASE の optimizer で緩和する従来の方法 (ase_relax.relax_one)
+  - まとめて FIRE で緩和する方法 (batch_relax.relax_structures)
+で緩和し、全体の時間と1構造あたりの時間を比較する。AiiDAのプロファイルは使わない。
+
+    python batch_relax.py --n 32 --repeat 2
+    python batch_relax.py --parameters parameters.json   # MLポテンシャルなど (optimization_WorkChain と同じ形式)
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from ase.build import bulk
+
+from aiida_cryspy.engines import ase_relax, batch_relax
+
+DEFAULT_PARAMETERS = {
+    "calculator": {"name": "emt"},
+    "optimizer": {
+        "name": "FIRE",
+        "run_args": {"fmax": 0.02, "steps": 1000},
+        "setup": {"FixSymmetry": False, "FrechetCellFilter": True, "scalar_pressure": 1.0},
+    },
+}
+
+
+def make_structures(n, repeat, seed=0):
+    rng = np.random.default_rng(seed)
+    structures = {}
+    for i in range(n):
+        element = ["Cu", "Al", "Ni", "Ag"][i % 4]
+        atoms = bulk(element, "fcc", a=3.6 + 0.4 * rng.random(), cubic=True) * (repeat, repeat, repeat)
+        atoms.rattle(0.05, seed=i)
+        structures[str(i)] = ase_relax.atoms_to_dict(atoms)
+    return structures
+
+
+def relax_sequential(structures, parameters):
+    calculator = ase_relax.build_calculator(parameters)
+    return {key: ase_relax.relax_one(structure, parameters, calculator) for key, structure in structures.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=32, help="number of structures")
+    parser.add_argument("--repeat", type=int, default=1, help="supercell size of the fcc cubic cell (4 atoms)")
+    parser.add_argument("--parameters", help="json file of the optimization parameters")
+    parser.add_argument("--optimizer", default=None, help="optimizer of the sequential path (default: the one in parameters)")
+    args = parser.parse_args()
+
+    parameters = DEFAULT_PARAMETERS
+    if args.parameters:
+        with open(args.parameters) as handle:
+            parameters = json.load(handle)
+    if args.optimizer:
+        parameters = dict(parameters, optimizer=dict(parameters["optimizer"], name=args.optimizer))
+    structures = make_structures(args.n, args.repeat)
+
+    for label, func in (("sequential", relax_sequential), ("batched FIRE", batch_relax.relax_structures)):
+        t0 = time.perf_counter()
+        results = func(structures, parameters)
+        seconds = time.perf_counter() - t0
+        ok = [r for r in results.values() if "error" not in r]
+        steps = sum(r["nsteps"] for r in ok)
+        converged = sum(r["converged"] for r in ok)
+        print(f"{label:14s} total {seconds:8.2f} s  per structure {seconds / args.n * 1e3:8.1f} ms  "
+              f"steps {steps:6d}  converged {converged}/{args.n}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+生成した構造をGroupに保存する処理のベンチマーク。
+
+1構造ずつ store() / add_nodes() する従来の方法と、
+aiida_cryspy.utils.groups.store_structures (1トランザクション) の1構造あたりの時間を比較する。
+
+    python bulk_store.py --n 100
+"""
+import argparse
+import time
+import uuid
+
+from aiida import load_profile
+# AiiDAプロファイルのロード
+load_profile()
+
+import numpy as np
+from aiida.orm import Group
+from aiida.plugins import DataFactory
+from pymatgen.core import Lattice, Structure
+
+from aiida_cryspy.utils.groups import store_structures
+
+StructureData = DataFactory("core.structure")
+
+
+def make_structures(n, natoms, seed=0):
+    rng = np.random.default_rng(seed)
+    structures = {}
+    for cid in range(n):
+        lattice = Lattice(np.eye(3) * 6.0 + rng.random((3, 3)))
+        structures[cid] = Structure(lattice, ["Ba", "Fe", "O"] * (natoms // 3), rng.random((natoms // 3 * 3, 3)))
+    return structures
+
+
+def store_one_by_one(structures, group):
+    """従来の方法"""
+    for cid, pmg_struct in structures.items():
+        s_node = StructureData(pymatgen=pmg_struct)
+        s_node.base.extras.set('cryspy_id', cid)
+        s_node.store()
+        group.add_nodes(s_node)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=100, help="number of structures")
+    parser.add_argument("--natoms", type=int, default=30)
+    args = parser.parse_args()
+
+    structures = make_structures(args.n, args.natoms)
+
+    for label, func in (("one by one", store_one_by_one), ("store_structures", store_structures)):
+        group = Group(label=f"cryspy_bench_bulk_store_{uuid.uuid4()}").store()
+        t0 = time.perf_counter()
+        func(structures, group)
+        seconds = time.perf_counter() - t0
+        print(f"{label:20s} total {seconds:8.2f} s  per structure {seconds / args.n * 1e3:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+重複判定のベンチマーク (CPU)。
+
+ランダムな Cu2Al2 の構造と、その一部を並進・原子の入れ替え・セルの取り方の変更・小さな変位で作った重複を
+  - エネルギーの低い順に、残した全構造と StructureMatcher で総当たりする方法
+  - 記述子で候補を絞ってから StructureMatcher を使う方法 (duplicates.find_duplicates)
+で判定し、時間と StructureMatcher の呼び出し回数、見つけた重複の数を比較する。AiiDAのプロファイルは使わない。
+どちらも、エネルギーの差が ENERGY_TOLERANCE 以下の構造だけを重複とみなす。
+
+    python duplicates.py --n 200
+"""
+import argparse
+import time
+
+import numpy as np
+from pymatgen.analysis.structure_matcher import StructureMatcher
+from pymatgen.core import Lattice, Structure
+
+from aiida_cryspy.utils import duplicates
+
+
+def make_structures(n, fraction, seed=0):
+    rng = np.random.default_rng(seed)
+    structures, energies = {}, {}
+    cid = 0
+    for _ in range(n):
+        lattice = Lattice.from_parameters(*(4.0 + 2.0 * rng.random(3)), 90, 90, 90)
+        struc = Structure(lattice, ["Cu", "Cu", "Al", "Al"], rng.random((4, 3)))
+        energy = rng.normal(0.0, 0.3)
+        structures[cid], energies[cid] = struc, energy
+        cid += 1
+        if rng.random() < fraction:
+            order = [2, 0, 3, 1]
+            copy = Structure(struc.lattice, [struc[i].specie for i in order], [struc[i].frac_coords for i in order])
+            copy.translate_sites(list(range(len(copy))), rng.random(3))
+            copy.make_supercell([[1, 1, 0], [0, 1, 0], [0, 0, 1]])
+            copy.perturb(0.01)
+            structures[cid], energies[cid] = copy, energy + rng.normal(0.0, 1e-3)
+            cid += 1
+    return structures, energies
+
+
+def find_duplicates_pairwise(structures, energies, matcher):
+    kept, found, calls = [], {}, 0
+    for cid in sorted(structures, key=energies.get):
+        for other in kept:
+            if abs(energies[cid] - energies[other]) > duplicates.ENERGY_TOLERANCE:
+                continue
+            calls += 1
+            if matcher.fit(structures[cid], structures[other]):
+                found[cid] = other
+                break
+        else:
+            kept.append(cid)
+    return found, calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=200, help="number of distinct structures")
+    parser.add_argument("--fraction", type=float, default=0.3, help="fraction of structures that get a duplicate")
+    args = parser.parse_args()
+
+    structures, energies = make_structures(args.n, args.fraction)
+    matcher = StructureMatcher(scale=False)
+
+    t0 = time.perf_counter()
+    found, calls = find_duplicates_pairwise(structures, energies, matcher)
+    seconds = time.perf_counter() - t0
+    print(f"{'pairwise':10s} {seconds:8.2f} s  matcher calls {calls:7d}  duplicates {len(found)}")
+
+    t0 = time.perf_counter()
+    index = duplicates.DuplicateIndex(matcher=matcher)
+    found = duplicates.find_duplicates(structures, energies, index=index)
+    seconds = time.perf_counter() - t0
+    print(f"{'prefilter':10s} {seconds:8.2f} s  matcher calls {index.n_candidates:7d}  duplicates {len(found)}")
+
+
+if __name__ == "__main__":
+    main()
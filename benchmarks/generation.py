@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+1世代あたりのオーケストレーション (AiiDA と aiida-cryspy) のオーバーヘッドのベンチマーク。
+
+ローカルのプロファイルで initialize_workchain → (multi_structure_optimize_WorkChain → next_sg_WorkChain) × 世代数
+を実行し、WorkChain ごとに次の処理 (phase) の時間と、その中で増えたメモリのピーク (tracemalloc) を記録する:
+    group_loading        Groupからの構造の読み込み (aiida_cryspy.utils.groups)
+    pymatgen_conversion  StructureData と pymatgen / ASE の変換
+    regist_opt           CrySPY の regist_opt
+    cryspy_generation    CrySPY の初期化 (cryspy_init.initialize) と次世代生成 (next_gen_EA)
+    serialization        DataframeData / EAData / RinData の書き込みと読み込み
+    node_storing         ノードの保存 (Node.store, store_structures)
+    relaxation           構造緩和のジョブ (EMT。--steps 0 なら1点計算だけ)。緩和はジョブの中で実行されるため、
+                         CalcJob の作成から終了までの時間とする (同時に実行された時間は1回だけ数える)
+時間はその phase だけのもの (中で呼ばれた別の phase の時間は含まない)。
+WorkChain の実行時間のうちどの phase にも入らない時間は other (主に AiiDA のエンジン) とする。
+結果は --output の JSON に書く (回帰の追跡用)。
+
+    python generation.py --sizes 100 1000 --generations 2
+    python generation.py --sizes 10000 --generations 1 --steps 0 --no-memory --output large.json
+    python generation.py --cryspy-in cryspy.in --parameters parameters.json   # 任意の系・計算条件
+"""
+import argparse
+import configparser
+import functools
+import io
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+from aiida import load_profile
+# AiiDAプロファイルのロード
+load_profile()
+
+import aiida
+from aiida.engine import run_get_node
+from aiida.orm import CalcJobNode, Dict, Int, Str
+from aiida.orm.nodes.node import Node
+from aiida.plugins import DataFactory, WorkflowFactory
+from cryspy.job import ctrl_job
+from cryspy.start import cryspy_init
+
+from aiida_cryspy.data.dataframedata import DataframeData
+from aiida_cryspy.data.eadata import EAData
+from aiida_cryspy.data.rindata import RinData
+from aiida_cryspy.utils import groups
+
+InitializeWorkChain = WorkflowFactory("aiida_cryspy.initial_structures")
+MultiStructureOptimizeWorkChain = WorkflowFactory("aiida_cryspy.optimize_structures")
+NextSgWorkChain = WorkflowFactory("aiida_cryspy.next_sg")
+SinglefileData = DataFactory("core.singlefile")
+StructureData = DataFactory("core.structure")
+
+MiB = 1024 ** 2
+
+# n_pop 以外の [EA] の数は、この cryspy.in の n_pop との比で決める
+DEFAULT_CRYSPY_IN = """\
+[basic]
+algo = EA
+calc_code = ASE
+nstage = 1
+njob = 5
+jobcmd = zsh
+jobfile = job_cryspy
+
+[structure]
+natot = 8
+atype = Cu Al
+nat = 4 4
+mindist_1 = 1.8 1.8
+mindist_2 = 1.8 1.8
+
+[EA]
+n_pop = 100
+n_crsov = 50
+n_perm = 20
+n_strain = 20
+n_rand = 10
+n_elite = 2
+n_fittest = 50
+slct_func = TNM
+t_size = 3
+maxgen_ea = 0
+
+[ASE]
+ase_python = ase_in.py
+
+[option]
+"""
+
+EA_SCALED_KEYS = ("n_crsov", "n_perm", "n_strain", "n_rand", "n_elite", "n_fittest")
+
+
+def make_cryspy_in(template, population):
+    """template の n_pop を population にし、次世代生成の内訳なども同じ比で変える"""
+    config = configparser.ConfigParser()
+    config.read_string(template)
+    ea = config["EA"]
+    ratio = population / int(ea["n_pop"])
+    ea["n_pop"] = str(population)
+    for key in EA_SCALED_KEYS:
+        if key in ea:
+            ea[key] = str(max(1, round(int(ea[key]) * ratio)))
+    # 生成する構造の数の合計を n_pop に合わせる
+    generated = sum(int(ea[key]) for key in ("n_crsov", "n_perm", "n_strain"))
+    ea["n_rand"] = str(max(0, population - generated))
+    if "n_fittest" in ea:
+        ea["n_fittest"] = str(min(int(ea["n_fittest"]), population))
+    handle = io.StringIO()
+    config.write(handle)
+    return handle.getvalue()
+
+
+def make_parameters(steps):
+    return {
+        "calculator": {"name": "emt"},
+        "optimizer": {
+            "name": "FIRE",
+            "run_args": {"fmax": 0.05, "steps": steps},
+            "setup": {"FrechetCellFilter": True, "scalar_pressure": 0.0},
+        },
+    }
+
+
+class PhaseRecorder:
+    """
+    関数を phase ごとに計測するラッパーを作る。
+    phase の中で別の phase の関数が呼ばれた場合、その時間は内側の phase だけに入れる。
+    メモリは tracemalloc で、phase の開始時からのピークの増分の最大値 (内側の phase の分も含む)。
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self._stack = []
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+
+    def wrap(self, func, phase):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self._stack and self._stack[-1]["phase"] == phase:
+                return func(*args, **kwargs) # 同じ phase の中の呼び出しは外側に含める
+            self._enter(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit()
+        wrapper._benchmark_phase = phase
+        return wrapper
+
+    def _enter(self, phase):
+        frame = {"phase": phase, "start": time.perf_counter(), "children": 0.0, "memory": 0, "peak": 0}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["memory"] = frame["peak"] = current
+        self._stack.append(frame)
+
+    def _exit(self):
+        frame = self._stack.pop()
+        seconds = time.perf_counter() - frame["start"]
+        stats = self.stats.setdefault(frame["phase"], {"seconds": 0.0, "calls": 0, "peak_mib": 0.0})
+        stats["seconds"] += seconds - frame["children"]
+        stats["calls"] += 1
+        if self._stack:
+            self._stack[-1]["children"] += seconds
+        if self.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            frame["peak"] = max(frame["peak"], peak)
+            stats["peak_mib"] = max(stats["peak_mib"], (frame["peak"] - frame["memory"]) / MiB)
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], frame["peak"])
+            tracemalloc.reset_peak()
+
+    def summary(self):
+        return {
+            phase: {
+                "seconds": round(stats["seconds"], 6),
+                "calls": stats["calls"],
+                "peak_mib": round(stats["peak_mib"], 3) if self.trace_memory else None,
+            }
+            for phase, stats in sorted(self.stats.items())
+        }
+
+
+def patch_function(recorder, module, name, phase):
+    """
+    module.name を計測するラッパーに置き換える。
+    from ... import name で読み込んだ aiida_cryspy のモジュールの名前も置き換える。
+    """
+    original = getattr(module, name)
+    wrapper = recorder.wrap(original, phase)
+    setattr(module, name, wrapper)
+    for loaded in list(sys.modules.values()):
+        if getattr(loaded, "__name__", "").startswith("aiida_cryspy") and getattr(loaded, name, None) is original:
+            setattr(loaded, name, wrapper)
+
+
+def patch_method(recorder, cls, name, phase):
+    setattr(cls, name, recorder.wrap(getattr(cls, name), phase))
+
+
+def instrument(recorder):
+    for name in ("load_structures", "load_structure_nodes", "load_structures_incremental", "update_structures", "get_cryspy_id_map"):
+        patch_function(recorder, groups, name, "group_loading")
+    for name in ("structure_from_attributes", "structuredata_from_pymatgen"):
+        patch_function(recorder, groups, name, "pymatgen_conversion")
+    for name in ("get_pymatgen", "get_pymatgen_structure", "get_ase"):
+        patch_method(recorder, StructureData, name, "pymatgen_conversion")
+    patch_function(recorder, ctrl_job, "regist_opt", "regist_opt")
+    patch_function(recorder, ctrl_job, "next_gen_EA", "cryspy_generation")
+    patch_function(recorder, cryspy_init, "initialize", "cryspy_generation")
+    for name in ("set_df", "get_df"):
+        patch_method(recorder, DataframeData, name, "serialization")
+    for name in ("__init__", "_get_field", "get_ea_data"):
+        patch_method(recorder, EAData, name, "serialization")
+    for name in ("__init__", "get_rin"):
+        patch_method(recorder, RinData, name, "serialization")
+    patch_method(recorder, Node, "store", "node_storing")
+    patch_function(recorder, groups, "store_structures", "node_storing")
+
+
+def relaxation_phase(node):
+    """node の子孫の CalcJob が実行されていた時間 (重なった区間は1回だけ数える)"""
+    intervals = sorted(
+        (child.ctime.timestamp(), child.mtime.timestamp())
+        for child in node.called_descendants if isinstance(child, CalcJobNode)
+    )
+    seconds = 0.0
+    end = None
+    for start, stop in intervals:
+        if end is not None and start < end:
+            start = end
+        if stop > start:
+            seconds += stop - start
+        end = stop if end is None else max(end, stop)
+    return {"seconds": round(seconds, 6), "calls": len(intervals), "peak_mib": None}
+
+
+def run_step(recorder, process_class, **inputs):
+    """WorkChain を1つ実行し、phase ごとの時間とメモリを返す"""
+    recorder.reset()
+    t0 = time.perf_counter()
+    result, node = run_get_node(process_class, **inputs)
+    wall = time.perf_counter() - t0
+    if not node.is_finished_ok:
+        raise RuntimeError(f"{node.process_label}<{node.pk}> failed with exit status {node.exit_status}")
+    phases = recorder.summary()
+    relaxation = relaxation_phase(node)
+    if relaxation["calls"]:
+        phases["relaxation"] = relaxation
+    record = {
+        "workchain": node.process_label,
+        "pk": node.pk,
+        "wall_seconds": round(wall, 6),
+        "other_seconds": round(wall - sum(stats["seconds"] for stats in phases.values()), 6),
+        "phases": phases,
+        "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    return result, record
+
+
+def run_search(recorder, cryspy_in, generations, parameters, args):
+    """1つの探索を generations 世代まで実行する"""
+    records = []
+    cryspy_in_file = SinglefileData(io.BytesIO(cryspy_in.encode()), filename="cryspy.in")
+    result, record = run_step(recorder, InitializeWorkChain, cryspy_in_filename=Str("cryspy.in"), cryspy_in_file=cryspy_in_file)
+    records.append(dict(record, generation=0))
+
+    state = {
+        "initial_structures_group_pk": result["initial_structures_group_pk"],
+        "optimized_structures_group_pk": result["optimized_structures_group_pk"],
+        "rslt_data": result["rslt_data"],
+        "detail_data": result["detail_data"],
+        "cryspy_in": result["cryspy_in"],
+    }
+    id_queueing = result["id_queueing"]
+    snapshots = {}
+
+    for gen in range(1, generations + 1):
+        inputs = dict(
+            state,
+            id_queueing=id_queueing,
+            parameters=Dict(parameters),
+            options=Dict({}),
+            executor=Str(args.executor),
+            **({"opt_struc_snapshot": snapshots["opt_struc_snapshot"]} if "opt_struc_snapshot" in snapshots else {}),
+        )
+        if args.executor == "local":
+            inputs["max_workers"] = Int(args.max_workers)
+        result, record = run_step(recorder, MultiStructureOptimizeWorkChain, **inputs)
+        records.append(dict(record, generation=gen))
+        state["rslt_data"] = result["rslt_data"]
+        snapshots = {name: result[name] for name in ("opt_struc_snapshot", "init_struc_snapshot") if name in result}
+        if gen == generations:
+            break
+
+        result, record = run_step(recorder, NextSgWorkChain, **state, **snapshots)
+        records.append(dict(record, generation=gen))
+        state.update(
+            initial_structures_group_pk=result["next_structures_group_pk"],
+            rslt_data=result["rslt_data"],
+            detail_data=result["detail_data"],
+        )
+        id_queueing = result["id_queueing"]
+    return records
+
+
+def get_versions():
+    versions = {"python": platform.python_version(), "aiida-core": aiida.__version__}
+    for package in ("aiida_cryspy", "cryspy", "pymatgen", "ase"):
+        try:
+            versions[package] = getattr(__import__(package), "__version__", None)
+        except ImportError:
+            versions[package] = None
+    return versions
+
+
+def print_records(population, records):
+    print(f"--- population {population} ---")
+    for record in records:
+        phases = "  ".join(
+            f"{phase} {stats['seconds']:.2f} s" + (f" {stats['peak_mib']:.0f} MiB" if stats["peak_mib"] is not None else "")
+            for phase, stats in record["phases"].items()
+        )
+        print(f"gen {record['generation']:3d} {record['workchain']:38s} {record['wall_seconds']:8.2f} s  other {record['other_seconds']:7.2f} s  {phases}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000], help="population sizes (n_pop)")
+    parser.add_argument("--generations", type=int, default=2, help="number of optimized generations per search")
+    parser.add_argument("--cryspy-in", help="template cryspy.in (n_pop and the [EA] counts are rescaled to each size)")
+    parser.add_argument("--parameters", help="json file of the optimization parameters (default: EMT + FIRE)")
+    parser.add_argument("--steps", type=int, default=50, help="FIRE steps of the default parameters (0: single-point stub)")
+    parser.add_argument("--executor", default="batched", choices=("batched", "local", "calcjob"))
+    parser.add_argument("--max-workers", type=int, default=0, help="worker processes of the local executor")
+    parser.add_argument("--no-memory", action="store_true", help="do not trace memory (tracemalloc slows Python code down)")
+    parser.add_argument("--output", default="benchmark_generation.json")
+    args = parser.parse_args()
+
+    template = DEFAULT_CRYSPY_IN
+    if args.cryspy_in:
+        with open(args.cryspy_in) as handle:
+            template = handle.read()
+    parameters = make_parameters(args.steps)
+    if args.parameters:
+        with open(args.parameters) as handle:
+            parameters = json.load(handle)
+
+    recorder = PhaseRecorder(trace_memory=not args.no_memory)
+    instrument(recorder)
+    if recorder.trace_memory:
+        tracemalloc.start()
+
+    results = {
+        "benchmark": "generation",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "versions": get_versions(),
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "runs": [],
+    }
+    for population in args.sizes:
+        cryspy_in = make_cryspy_in(template, population)
+        t0 = time.perf_counter()
+        records = run_search(recorder, cryspy_in, args.generations, parameters, args)
+        results["runs"].append({
+            "population": population,
+            "generations": args.generations,
+            "wall_seconds": round(time.perf_counter() - t0, 6),
+            "steps": records,
+        })
+        print_records(population, records)
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
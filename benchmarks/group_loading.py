@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Groupからの構造読み込みのベンチマーク。
+
+group.nodes を1つずつ辿る従来の方法と、QueryBuilder 1回で読み込む
+aiida_cryspy.utils.groups.load_structures を比較する。
+
+    python group_loading.py --n 10000
+"""
+import argparse
+import time
+
+from aiida import load_profile
+# AiiDAプロファイルのロード
+load_profile()
+
+import numpy as np
+from aiida.orm import Group, load_group
+from aiida.plugins import DataFactory
+from pymatgen.core import Lattice, Structure
+
+from aiida_cryspy.utils.groups import load_structures, load_structure_nodes
+
+StructureData = DataFactory("core.structure")
+
+
+def make_group(n, natoms, seed=0):
+    """ランダムな構造 n 個を持つGroupを作る"""
+    rng = np.random.default_rng(seed)
+    group = Group(label=f"cryspy_bench_group_loading_{time.time()}").store()
+    nodes = []
+    for cid in range(n):
+        lattice = Lattice(np.eye(3) * 6.0 + rng.random((3, 3)))
+        struc = Structure(lattice, ["Ba", "Fe", "O"] * (natoms // 3), rng.random((natoms // 3 * 3, 3)))
+        node = StructureData(pymatgen=struc)
+        node.base.extras.set("cryspy_id", cid)
+        nodes.append(node.store())
+    group.add_nodes(nodes)
+    return group
+
+
+def load_by_iteration(group_pk, cryspy_ids=None):
+    """従来の方法"""
+    group = load_group(pk=group_pk)
+    structures = {}
+    for node in group.nodes:
+        cid = node.base.extras.get("cryspy_id")
+        if cid is not None and (cryspy_ids is None or cid in cryspy_ids):
+            structures[cid] = node.get_pymatgen()
+    return structures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=10000, help="number of structures in the group")
+    parser.add_argument("--natoms", type=int, default=30)
+    parser.add_argument("--batch", type=int, default=100, help="size of the cryspy_id subset")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    group = make_group(args.n, args.natoms)
+    print(f"Created Group<{group.pk}> with {args.n} structures in {time.perf_counter() - t0:.1f} s")
+
+    subset = list(range(0, args.n, max(1, args.n // args.batch)))[:args.batch]
+
+    timings = {}
+    t0 = time.perf_counter()
+    old_all = load_by_iteration(group.pk)
+    timings["iterate group.nodes (all)"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    new_all = load_structures(group.pk)
+    timings["load_structures (all)"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    load_by_iteration(group.pk, set(subset))
+    timings[f"iterate group.nodes ({len(subset)} ids)"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    load_structure_nodes(group.pk, subset)
+    timings[f"load_structure_nodes ({len(subset)} ids)"] = time.perf_counter() - t0
+
+    assert old_all.keys() == new_all.keys()
+    assert all(old_all[cid] == new_all[cid] for cid in old_all)
+
+    for label, seconds in timings.items():
+        print(f"{label:40s} {seconds:8.2f} s")
+
+
+if __name__ == "__main__":
+    main()
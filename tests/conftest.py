@@ -0,0 +1,82 @@
+"""Fixtures of the aiida-cryspy tests (a temporary AiiDA profile from aiida-core's pytest fixtures)."""
+import pytest
+from pymatgen.core import Lattice, Structure
+
+pytest_plugins = ['aiida.tools.pytest_fixtures']
+
+
+@pytest.fixture
+def structures():
+    """{cryspy_id: pymatgen.core.Structure} with different numbers of sites and species"""
+    return {
+        0: Structure(Lattice.cubic(3.6), ['Cu'] * 4, [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]]),
+        3: Structure(Lattice.hexagonal(2.9, 4.7), ['Al', 'Cu'], [[1 / 3, 2 / 3, 0.25], [2 / 3, 1 / 3, 0.75]]),
+        7: Structure(Lattice.from_parameters(3.1, 4.2, 5.3, 80, 95, 101), ['Cu', 'Al', 'Al'],
+                     [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]]),
+    }
+
+
+CRYSPY_IN = '''[basic]
+algo = EA
+calc_code = ASE
+nstage = 1
+njob = 5
+jobcmd = zsh
+jobfile = job_cryspy
+
+[structure]
+natot = 4
+atype = Cu Al
+nat = 2 2
+mindist_1 = 1.8 1.8
+mindist_2 = 1.8 1.8
+
+[EA]
+n_pop = 8
+n_crsov = 3
+n_perm = 2
+n_strain = 2
+n_rand = 1
+n_elite = 1
+n_fittest = 4
+slct_func = TNM
+t_size = 2
+maxgen_ea = 0
+
+[ASE]
+ase_python = ase_in.py
+
+[option]
+'''
+
+@pytest.fixture
+def sandbox_root(tmp_path, monkeypatch):
+    """CrySPY sandboxes of the test in a temporary directory"""
+    from aiida_cryspy.utils import sandbox
+
+    root = tmp_path / 'cryspy_runs'
+    monkeypatch.setenv(sandbox.SANDBOX_ROOT_VARIABLE, str(root))
+    return root
+
+
+@pytest.fixture
+def cryspy_in_file():
+    """cryspy.in of a small Cu2Al2 EA search (8 structures per generation)"""
+    import io
+
+    from aiida.orm import SinglefileData
+
+    return SinglefileData(io.BytesIO(CRYSPY_IN.encode()), filename='cryspy.in')
+
+
+@pytest.fixture
+def initialized_run(sandbox_root, cryspy_in_file):
+    """outputs of initialize_workchain for cryspy_in_file"""
+    from aiida.engine import run_get_node
+    from aiida.orm import Str
+
+    from aiida_cryspy.workflows.initialize_WorkChain import initialize_workchain
+
+    results, node = run_get_node(initialize_workchain, cryspy_in_filename=Str('cryspy.in'), cryspy_in_file=cryspy_in_file)
+    assert node.is_finished_ok, node.exit_status
+    return results
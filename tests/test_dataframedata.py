@@ -0,0 +1,69 @@
+"""Round trip of DataframeData in the columnar and the legacy dict storage."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from aiida_cryspy.data.dataframedata import DataframeData
+
+
+@pytest.fixture
+def rslt_data():
+    """rslt_data of an EA run (int, float, object and None columns)"""
+    df = pd.DataFrame({
+        'Gen': [1, 1, 2],
+        'Spg_num': [225, 194, 1],
+        'Spg_sym': ['Fm-3m', 'P6_3/mmc', 'P1'],
+        'E_eV_atom': [-3.5, np.nan, -3.25],
+        'Magmom': [None, None, None],
+        'Opt': [True, False, 'prescreened'],
+    }, index=[0, 5, 9])
+    df[['Gen', 'Spg_num']] = df[['Gen', 'Spg_num']].astype(int)
+    return df
+
+
+@pytest.mark.parametrize('storage', [DataframeData.STORAGE_COLUMNAR, DataframeData.STORAGE_DICT])
+def test_round_trip(rslt_data, storage):
+    if storage == DataframeData.STORAGE_DICT:
+        rslt_data = rslt_data.fillna({'E_eV_atom': 0.0})  # the attributes cannot hold NaN
+    node = DataframeData(rslt_data, storage=storage).store()
+    loaded = DataframeData.collection.get(pk=node.pk)
+    pd.testing.assert_frame_equal(loaded.df, rslt_data, check_dtype=storage == DataframeData.STORAGE_COLUMNAR)
+    assert loaded.columns == list(rslt_data.columns)
+
+
+def test_columnar_files(rslt_data):
+    node = DataframeData(rslt_data).store()
+    assert node.is_columnar
+    assert sorted(node.base.repository.list_object_names()) == sorted(
+        [f'column_{i}.npy' for i in range(len(rslt_data.columns))] + ['index.npy'])
+
+
+def test_read_columns(rslt_data):
+    node = DataframeData(rslt_data).store()
+    pd.testing.assert_frame_equal(node.get_df(columns=['E_eV_atom', 'Gen']), rslt_data[['E_eV_atom', 'Gen']])
+    with pytest.raises(KeyError):
+        node.get_df(columns=['missing'])
+
+
+def test_empty_frame():
+    df = pd.DataFrame(columns=['Spg_num', 'E_eV_atom'])
+    node = DataframeData(df).store()
+    loaded = node.df
+    assert list(loaded.columns) == ['Spg_num', 'E_eV_atom']
+    assert len(loaded) == 0
+
+
+def test_to_columnar(rslt_data):
+    rslt_data = rslt_data.fillna({'E_eV_atom': 0.0})
+    legacy = DataframeData(rslt_data, storage=DataframeData.STORAGE_DICT).store()
+    assert not legacy.is_columnar
+    migrated = legacy.to_columnar().store()
+    assert migrated.is_columnar
+    pd.testing.assert_frame_equal(migrated.df, legacy.df)
+
+
+def test_returned_frame_is_a_copy(rslt_data):
+    node = DataframeData(rslt_data).store()
+    df = node.df
+    df.loc[0, 'E_eV_atom'] = 0.0
+    assert node.df.loc[0, 'E_eV_atom'] == -3.5
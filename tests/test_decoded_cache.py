@@ -0,0 +1,58 @@
+"""Per-process cache of decoded RinData, EAData and DataframeData payloads."""
+import pandas as pd
+import pytest
+
+from aiida_cryspy.data import decoded_cache
+from aiida_cryspy.data.dataframedata import DataframeData
+from aiida_cryspy.data.eadata import EAData
+from aiida_cryspy.data.rindata import RinData
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = decoded_cache.DecodedCache(1024 ** 2)
+    for module in ('aiida_cryspy.data.dataframedata', 'aiida_cryspy.data.eadata', 'aiida_cryspy.data.rindata'):
+        monkeypatch.setattr(f'{module}.DECODED_CACHE', cache)
+    return cache
+
+
+def test_rin_is_read_once(cache):
+    node = RinData({'algo': 'EA', 'nat': [2, 2]}).store()
+    first = node.rin
+    first['nat'].append(4)  # copies are independent of the cached object
+    assert node.rin == {'algo': 'EA', 'nat': [2, 2]}
+    assert cache.get_stats()['misses'] == 1 and cache.get_stats()['hits'] == 1
+
+
+def test_ea_fields_are_read_once(cache, structures):
+    ea_info = pd.DataFrame({'Gen': [2], 'Population': [8]})
+    node = EAData((2, {0: structures[0]}, {0: -3.5}, ea_info, None)).store()
+    node.elite_fitness[0] = 0.0
+    assert node.elite_fitness == {0: -3.5}
+    assert node.elite_struc[0] == structures[0]
+    assert node.elite_struc[0] is not node.elite_struc[0]
+    assert cache.get_stats()['misses'] == 2 and cache.get_stats()['hits'] == 3
+
+
+def test_ea_dataframes_are_cached_decoded(cache):
+    ea_info = pd.DataFrame({'Gen': [2], 'Population': [8]})
+    node = EAData((2, {}, {}, ea_info, None)).store()
+    node.ea_info.loc[0, 'Gen'] = 3
+    pd.testing.assert_frame_equal(node.ea_info, ea_info)
+    assert node.ea_origin is None and node.ea_origin is None
+    assert cache.get_stats()['misses'] == 2 and cache.get_stats()['hits'] == 2
+
+
+def test_unstored_nodes_are_not_cached(cache):
+    node = DataframeData(pd.DataFrame({'E_eV_atom': [-3.5]}))
+    pd.testing.assert_frame_equal(node.df, node.df)
+    assert cache.get_stats()['entries'] == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = decoded_cache.DecodedCache(10)
+    nodes = [RinData({'algo': 'RS'}).store() for _ in range(2)]
+    for node in nodes + nodes[:1]:
+        cache.get(node, 'rin', lambda: ({'algo': 'RS'}, 6), copy=dict)
+    stats = cache.get_stats()
+    assert stats['evictions'] == 2 and stats['entries'] == 1 and stats['hits'] == 0
@@ -0,0 +1,64 @@
+"""EA_WorkChain: the timeline output and the steady-state mode with concurrent optimizations."""
+import pickle
+
+import pytest
+from aiida.engine import run_get_node
+from aiida.orm import Bool, Dict, Int, Str
+
+pytest.importorskip('aiida_mlip')
+pytest.importorskip('cryspy')
+
+from aiida_cryspy.utils import sandbox  # noqa: E402
+from aiida_cryspy.workflows.EA_WorkChain import EA_WorkChain, summarize_timeline  # noqa: E402
+
+PARAMETERS = {
+    'calculator': {'name': 'emt'},
+    'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}, 'setup': {'FrechetCellFilter': True}},
+}
+
+
+def test_summarize_timeline():
+    timeline = summarize_timeline([[0.0, 0, None], [1800.0, 8, -3.5], [3600.0, 16, -3.75]], 'generational')
+    assert timeline == {
+        'mode': 'generational',
+        'elapsed': [0.0, 1800.0, 3600.0],
+        'relaxed': [0, 8, 16],
+        'best_enthalpy': [None, -3.5, -3.75],
+        'relaxations_per_hour': 16.0,
+    }
+    assert summarize_timeline([[0.0, 1, -1.0]], 'steady_state')['relaxations_per_hour'] is None
+    assert summarize_timeline([], 'steady_state') is None
+
+
+def test_steady_state_keeps_every_registered_row(sandbox_root, cryspy_in_file):
+    results, node = run_get_node(
+        EA_WorkChain,
+        max_generations=Int(2),
+        cryspy_in_file=cryspy_in_file,
+        parameters=Dict(PARAMETERS),
+        options=Dict({}),
+        executor=Str('local'),
+        max_workers=Int(1),
+        max_concurrent=Int(4),
+        steady_state=Bool(True),
+        steady_state_batch=Int(2),
+    )
+    assert node.is_finished_ok, node.exit_status
+    rslt_data = results['final_rslt_data'].df
+    assert set(rslt_data['Gen']) == {1, 2}
+
+    # the optimizations ran concurrently and registered into the same sandbox pickles
+    children = [child for child in node.called if child.label.startswith('gen_')]
+    assert any(a.ctime < b.mtime and b.ctime < a.mtime for a in children for b in children if a.pk < b.pk)
+    run_uuid = node.called[0].outputs.cryspy_in.run_uuid
+    pkl_dir = sandbox.get_sandbox(run_uuid) / sandbox.PKL_DIRNAME
+    with (pkl_dir / 'rslt_data.pkl').open('rb') as handle:
+        registered = pickle.load(handle)
+    with (pkl_dir / 'opt_struc_data.pkl').open('rb') as handle:
+        opt_struc_data = pickle.load(handle)
+    assert set(rslt_data.index) <= set(registered.index)
+    assert set(rslt_data.index) <= set(opt_struc_data)
+
+    timeline = results['timeline'].get_dict()
+    assert timeline['mode'] == 'steady_state'
+    assert timeline['relaxed'][-1] == len(rslt_data)
@@ -0,0 +1,69 @@
+"""Round trip of EAData (fields in separate pickle files, gen as an attribute)."""
+import pickle
+
+import pandas as pd
+import pytest
+from pymatgen.core import Lattice, Structure
+
+from aiida_cryspy.data.eadata import EAData
+
+
+@pytest.fixture
+def ea_data():
+    elite_struc = {4: Structure(Lattice.cubic(3.6), ['Cu', 'Al'], [[0, 0, 0], [0.5, 0.5, 0.5]])}
+    elite_fitness = {4: -3.5}
+    ea_info = pd.DataFrame({'Gen': [2], 'Population': [8], 'Crossover': [3]})
+    ea_origin = pd.DataFrame({'Gen': [2], 'Struc_ID': [4], 'Operation': ['crossover'], 'Parent': [(0, 1)]})
+    return 2, elite_struc, elite_fitness, ea_info, ea_origin
+
+
+def assert_same_ea_data(actual, expected):
+    assert actual[0] == expected[0]
+    assert list(actual[1]) == list(expected[1])
+    assert actual[1][4] == expected[1][4]
+    assert actual[2] == expected[2]
+    pd.testing.assert_frame_equal(actual[3], expected[3])
+    pd.testing.assert_frame_equal(actual[4], expected[4])
+
+
+def test_round_trip(ea_data):
+    node = EAData(ea_data).store()
+    loaded = EAData.collection.get(pk=node.pk)
+    assert not loaded.is_legacy
+    assert loaded.gen == 2
+    assert loaded.n_elite == 1
+    assert_same_ea_data(loaded.ea_data, ea_data)
+    assert sorted(loaded.base.repository.list_object_names()) == sorted(f'{name}.pkl' for name in EAData.FIELDS)
+
+
+def test_fields_are_read_separately(ea_data):
+    node = EAData(ea_data).store()
+    assert node.elite_fitness == {4: -3.5}
+    pd.testing.assert_frame_equal(node.ea_origin, ea_data[4])
+
+
+def test_none_fields():
+    node = EAData((1, None, None, None, None)).store()
+    assert node.n_elite == 0
+    assert node.ea_data == (1, None, None, None, None)
+
+
+def test_legacy_node(ea_data):
+    """nodes of the previous format have the whole tuple in one pickle file"""
+    node = EAData(ea_data)
+    node.base.attributes.clear()
+    for name in node.base.repository.list_object_names():
+        node.base.repository.delete_object(name)
+    node.base.repository.put_object_from_bytes(pickle.dumps(ea_data), 'ea_data.pkl')
+    node.base.attributes.set('filename', 'ea_data.pkl')
+    node.store()
+    assert node.is_legacy
+    assert node.gen == 2
+    assert node.n_elite == 1
+    assert_same_ea_data(node.ea_data, ea_data)
+
+
+@pytest.mark.parametrize('value', [(1, 2, 3), ('1', None, None, None, None), (1, [], None, None, None)])
+def test_validation(value):
+    with pytest.raises(TypeError):
+        EAData(value)
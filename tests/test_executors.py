@@ -0,0 +1,52 @@
+"""optimization_WorkChain with the local / batched executors (a RelaxPackCalculation on this machine, EMT)."""
+import numpy as np
+import pytest
+from aiida.engine import run_get_node
+from aiida.orm import Dict, Int, Str, StructureData
+from ase.build import bulk
+
+pytest.importorskip('aiida_mlip')
+pytest.importorskip('cryspy')
+
+from aiida_cryspy.utils import executors  # noqa: E402
+from aiida_cryspy.workflows.optimization_WorkChain import optimization_WorkChain  # noqa: E402
+
+PARAMETERS = {
+    'calculator': {'name': 'emt'},
+    'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}, 'setup': {'FrechetCellFilter': True}},
+}
+
+
+def run_optimization(executor, **inputs):
+    inputs.setdefault('trajectory_policy', Str('last'))
+    results, node = run_get_node(optimization_WorkChain, parameters=Dict(PARAMETERS), executor=Str(executor), **inputs)
+    assert node.is_finished_ok, node.exit_status
+    job = node.called[0]
+    assert job.process_label == 'RelaxPackCalculation'
+    assert job.computer.label == executors.LOCAL_COMPUTER_LABEL
+    return results
+
+
+@pytest.mark.parametrize('executor', ['local', 'batched'])
+def test_single_structure(executor):
+    results = run_optimization(executor, structure=StructureData(ase=bulk('Cu', 'fcc', a=3.7, cubic=True)))
+    assert np.isfinite(results['parameters']['total_energy'])
+    assert len(results['structure'].sites) == 4
+    assert 'trajectory' in results
+
+
+@pytest.mark.parametrize('executor', ['local', 'batched'])
+def test_packed_structures(executor):
+    structures = {
+        '3': StructureData(ase=bulk('Cu', 'fcc', a=3.7, cubic=True)),
+        '5': StructureData(ase=bulk('Al', 'fcc', a=4.2, cubic=True)),
+    }
+    results = run_optimization(executor, structures=structures, max_workers=Int(2))
+    assert set(results['structures']) == set(structures)
+    assert set(results['trajectories']) == set(structures)
+    for result in results['results'].values():
+        assert result['converged']
+
+
+def test_local_code_is_reused():
+    assert executors.get_local_code().pk == executors.get_local_code().pk
@@ -0,0 +1,96 @@
+"""island_EA_WorkChain: migration into the island sandboxes and the global rslt_data view."""
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+from aiida.engine import run_get_node
+from aiida.orm import Dict, Int, Str, WorkflowNode
+
+pytest.importorskip('aiida_mlip')
+pytest.importorskip('cryspy')
+
+from aiida_cryspy.utils import sandbox  # noqa: E402
+from aiida_cryspy.workflows import island_EA_WorkChain as island  # noqa: E402
+
+PARAMETERS = {
+    'calculator': {'name': 'emt'},
+    'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}, 'setup': {'FrechetCellFilter': True}},
+}
+COLUMNS = ['Gen', 'Spg_num', 'E_eV_atom']
+
+
+def load_pickle(run_uuid, name):
+    with (sandbox.get_sandbox(run_uuid) / sandbox.PKL_DIRNAME / f'{name}.pkl').open('rb') as handle:
+        return pickle.load(handle)
+
+
+def test_replace_registered(sandbox_root, structures):
+    run_uuid = str(uuid.uuid4())
+    rslt_data = pd.DataFrame([[1, 225, -3.5], [2, 1, -3.0], [2, 1, np.nan]], index=[0, 3, 7], columns=COLUMNS)
+    sandbox.seed_sandbox(run_uuid, {
+        'opt_struc_data': {0: structures[0], 3: structures[3]},
+        'rslt_data': rslt_data,
+        'elite_struc': {0: structures[0]},
+        'elite_fitness': {0: -3.5},
+    }, {'generation': 2})
+
+    with sandbox.cryspy_sandbox(run_uuid, WorkflowNode().store()):
+        island.replace_registered({
+            0: (structures[3], {'Gen': 2, 'Spg_num': 194, 'E_eV_atom': -3.75}),
+            7: (structures[0], {'Gen': 2, 'Spg_num': 225, 'E_eV_atom': -3.25}),
+        })
+
+    opt_struc_data = load_pickle(run_uuid, 'opt_struc_data')
+    assert opt_struc_data[0] == structures[3] and opt_struc_data[7] == structures[0] and opt_struc_data[3] == structures[3]
+    assert load_pickle(run_uuid, 'rslt_data').loc[[0, 7], 'E_eV_atom'].tolist() == [-3.75, -3.25]
+    assert load_pickle(run_uuid, 'elite_struc') == {0: structures[3]}
+    assert load_pickle(run_uuid, 'elite_fitness') == {0: -3.75}
+
+
+def test_global_rslt_data():
+    node = WorkflowNode().store()
+    assert island.global_rslt_data(node) is None
+
+    frames = {
+        0: pd.DataFrame([[1, 225, -3.5]], index=[0], columns=COLUMNS),
+        1: pd.DataFrame([[1, 1, -3.0], [1, 194, -3.25]], index=[0, 1], columns=COLUMNS),
+    }
+    pks = {str(i): island.PandasFrameData(frame).store().pk for i, frame in frames.items()}
+    node.base.extras.set(island.ISLAND_RSLT_EXTRA, pks)
+    global_rslt_data = island.global_rslt_data(node)
+    assert list(global_rslt_data.columns) == ['Island', 'ID'] + COLUMNS
+    assert global_rslt_data[['Island', 'ID']].values.tolist() == [[0, 0], [1, 0], [1, 1]]
+    assert global_rslt_data['E_eV_atom'].tolist() == [-3.5, -3.0, -3.25]
+
+
+def test_migrants_stay_registered_in_the_next_generation(sandbox_root, cryspy_in_file):
+    results, node = run_get_node(
+        island.island_EA_WorkChain,
+        n_islands=Int(2),
+        migration_interval=Int(1),
+        n_migrants=Int(1),
+        max_generations=Int(2),
+        cryspy_in_file=cryspy_in_file,
+        parameters=Dict(PARAMETERS),
+        options=Dict({}),
+        executor=Str('local'),
+    )
+    assert node.is_finished_ok, node.exit_status
+    migrations = results['migrations'].get_list()
+    assert [(gen, source, dest) for gen, source, _, dest, _, _ in migrations] == [(1, 1, 0), (1, 0, 1)]
+
+    run_uuids = {}
+    for child in node.called:
+        if child.process_label == 'initialize_workchain':
+            run_uuids[int(child.label.split('_')[1])] = child.outputs.cryspy_in.run_uuid
+    for gen, _, _, dest, cid, energy in migrations:
+        # the replaced row survives next_gen_EA in the island outputs and in the island sandbox
+        final = results['island_rslt_data'][f'island_{dest}'].df
+        assert final.loc[cid, 'Gen'] == gen and final.loc[cid, 'E_eV_atom'] == pytest.approx(energy)
+        assert load_pickle(run_uuids[dest], 'rslt_data').loc[cid, 'E_eV_atom'] == pytest.approx(energy)
+        assert load_pickle(run_uuids[dest], 'opt_struc_data')[cid] is not None
+
+    # the view recorded during the run ends at the output
+    pd.testing.assert_frame_equal(island.global_rslt_data(node), results['global_rslt_data'].df)
@@ -0,0 +1,77 @@
+"""Local relaxation engines with EMT: the process pool (including crashing workers) and the local_job script."""
+import json
+
+import numpy as np
+import pytest
+from ase.build import bulk
+
+from aiida_cryspy.engines import ase_relax, local_job, local_pool
+
+PARAMETERS = {
+    'calculator': {'name': 'emt'},
+    'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}, 'setup': {'FrechetCellFilter': True}},
+}
+
+# an EMT calculator that kills its worker process for single-atom cells
+CRASHING_PARAMETERS = dict(PARAMETERS, pre_lines=[
+    'import os\n'
+    'from ase.calculators.emt import EMT\n'
+    'class CrashingEMT(EMT):\n'
+    '    def calculate(self, atoms=None, *args, **kwargs):\n'
+    '        if len(atoms) == 1:\n'
+    '            os._exit(1)\n'
+    '        super().calculate(atoms, *args, **kwargs)\n'
+    'custom_calculator = CrashingEMT\n'
+])
+
+
+@pytest.fixture
+def emt_structures():
+    return {
+        '1': ase_relax.atoms_to_dict(bulk('Cu', 'fcc', a=3.7, cubic=True)),
+        '2': ase_relax.atoms_to_dict(bulk('Al', 'fcc', a=4.2, cubic=True)),
+        '3': ase_relax.atoms_to_dict(bulk('Cu', 'fcc', a=3.5)),
+    }
+
+
+@pytest.fixture(autouse=True)
+def shutdown_pool():
+    yield
+    local_pool.shutdown_pool()
+
+
+def test_pool_relaxes_structures(emt_structures):
+    results = local_pool.relax_structures(emt_structures, PARAMETERS, max_workers=2)
+    assert list(results) == list(emt_structures)
+    for result in results.values():
+        assert result['converged']
+        assert np.isfinite(result['total_energy'])
+
+
+def test_crashing_worker_fails_only_its_structure(emt_structures):
+    results = local_pool.relax_structures(emt_structures, CRASHING_PARAMETERS, max_workers=2)
+    assert list(results) == list(emt_structures)
+    assert 'terminated abruptly' in results['3']['error']
+    assert results['1']['converged'] and results['2']['converged']
+
+
+def test_shutdown_pool(emt_structures):
+    local_pool.relax_structures(emt_structures, PARAMETERS, max_workers=1)
+    pool = local_pool._pool
+    local_pool.shutdown_pool()
+    assert local_pool._pool is None
+    with pytest.raises(RuntimeError):
+        pool.submit(print)
+
+
+@pytest.mark.parametrize('engine', local_job.ENGINES)
+def test_local_job(engine, emt_structures, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = {'parameters': PARAMETERS, 'structures': emt_structures, 'trajectory': {'policy': 'last', 'interval': 1}}
+    (tmp_path / ase_relax.INPUT_FILENAME).write_text(json.dumps(data))
+    assert local_job.main([engine]) == 0
+    for key in emt_structures:
+        result = json.loads((tmp_path / ase_relax.RESULTS_DIRNAME / f'{key}.json').read_text())
+        assert np.isfinite(result['total_energy'])
+        assert len(result['structure']['symbols']) == len(emt_structures[key]['symbols'])
+        assert (tmp_path / ase_relax.RESULTS_DIRNAME / f'{key}{ase_relax.TRAJECTORY_SUFFIX}').is_file()
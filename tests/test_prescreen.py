@@ -0,0 +1,42 @@
+"""Prescreen helpers: enthalpy ranking, selection by fraction / window and the prescreen parameters."""
+import pytest
+from ase.units import GPa
+from pymatgen.core import Lattice, Structure
+
+from aiida_cryspy.utils import prescreen
+
+ENTHALPIES = {'1': -3.0, '2': -3.4, '3': -3.1, '4': -2.5, '5': -3.35}
+
+
+def test_enthalpy_per_atom():
+    struc = Structure(Lattice.cubic(3.0), ['Cu', 'Cu'], [[0, 0, 0], [0.5, 0.5, 0.5]])
+    assert prescreen.enthalpy_per_atom(-7.0, struc, 0.0) == pytest.approx(-3.5)
+    assert prescreen.enthalpy_per_atom(-7.0, struc, 10.0) == pytest.approx((-7.0 + 10.0 * GPa * 27.0) / 2)
+
+
+def test_select_by_fraction():
+    kept, rejected = prescreen.select(ENTHALPIES, keep_fraction=0.5)
+    assert kept == ['2', '5', '3']  # ceil(0.5 * 5), lowest enthalpy first
+    assert rejected == ['1', '4']
+
+
+def test_select_by_window():
+    kept, rejected = prescreen.select(ENTHALPIES, window=0.1)
+    assert kept == ['2', '5']
+    assert rejected == ['3', '1', '4']
+
+
+def test_select_keeps_the_union():
+    kept, _ = prescreen.select(ENTHALPIES, keep_fraction=0.2, window=0.3)
+    assert kept == ['2', '5', '3']
+
+
+def test_select_empty():
+    assert prescreen.select({}, keep_fraction=0.5, window=0.1) == ([], [])
+
+
+def test_prescreen_parameters_do_not_modify_the_input():
+    parameters = {'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}}}
+    assert prescreen.prescreen_parameters(parameters, 0)['optimizer']['run_args'] == {'fmax': 0.05, 'steps': 0}
+    assert parameters['optimizer']['run_args']['steps'] == 200
+    assert prescreen.prescreen_parameters({}, 5) == {'optimizer': {'run_args': {'steps': 5}}}
@@ -0,0 +1,48 @@
+"""Relaxation cache: canonical keys of equivalent structures, lookup of tagged nodes and cloning of hits."""
+from aiida.orm import StructureData
+from pymatgen.core import Lattice, Structure
+
+from aiida_cryspy.utils import relax_cache
+
+PARAMETERS = {'calculator': {'name': 'emt'}}
+
+
+def rocksalt(a=4.2):
+    return Structure.from_spacegroup('Fm-3m', Lattice.cubic(a), ['Na', 'Cl'], [[0, 0, 0], [0.5, 0.5, 0.5]])
+
+
+def test_equivalent_structures_have_the_same_key():
+    struc = rocksalt()
+    supercell = struc.copy()
+    supercell.make_supercell([1, 1, 2])
+    shifted = struc.copy()
+    shifted.translate_sites(list(range(len(shifted))), [0.25, 0.1, 0.0])
+    shuffled = Structure.from_sites(list(reversed(struc.sites)))
+    keys = {relax_cache.relax_key(s, PARAMETERS) for s in (struc, supercell, shifted, shuffled)}
+    assert len(keys) == 1
+
+
+def test_different_structures_or_parameters_have_different_keys():
+    key = relax_cache.relax_key(rocksalt(), PARAMETERS)
+    assert relax_cache.relax_key(rocksalt(4.5), PARAMETERS) != key
+    assert relax_cache.relax_key(rocksalt(), {'calculator': {'name': 'lj'}}) != key
+
+
+def test_split_cached_and_clone():
+    relaxed = StructureData(pymatgen=rocksalt(4.1)).store()
+    key = relax_cache.relax_key(rocksalt(), PARAMETERS)
+    relax_cache.tag_relaxed(relaxed, key, -3.5)
+
+    structure_map = {
+        1: StructureData(pymatgen=rocksalt()),
+        2: StructureData(pymatgen=rocksalt(5.0)),
+    }
+    keys, hits, misses = relax_cache.split_cached(structure_map, PARAMETERS)
+    assert keys[1] == key
+    assert hits == {1: (relaxed.pk, -3.5)}
+    assert list(misses) == [2]
+
+    parameters_node, structure_node = relax_cache.clone_cached(*hits[1])
+    assert structure_node.is_stored and structure_node.pk != relaxed.pk
+    assert structure_node.get_pymatgen() == relaxed.get_pymatgen()
+    assert parameters_node.get_dict() == {'total_energy': -3.5, 'cached_from': relaxed.pk}
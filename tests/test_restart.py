@@ -0,0 +1,84 @@
+"""Restarting EA_WorkChain from a stored generation in a fresh sandbox."""
+import pickle
+import random
+
+import numpy as np
+import pytest
+from aiida.engine import run_get_node
+from aiida.orm import Dict, Int, Str
+
+pytest.importorskip('aiida_mlip')
+cryspy_ctrl_job = pytest.importorskip('cryspy.job.ctrl_job')
+
+from aiida_cryspy.utils import sandbox  # noqa: E402
+from aiida_cryspy.utils.groups import load_structures  # noqa: E402
+from aiida_cryspy.workflows.EA_WorkChain import EA_WorkChain  # noqa: E402
+
+PARAMETERS = {
+    'calculator': {'name': 'emt'},
+    'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}, 'setup': {'FrechetCellFilter': True}},
+}
+
+
+@pytest.fixture
+def seeded_next_gen(monkeypatch):
+    """next_gen_EA with fixed random seeds, so that the same parents give the same next generation"""
+    next_gen_EA = cryspy_ctrl_job.next_gen_EA
+
+    def seeded(*args, **kwargs):
+        random.seed(0)
+        np.random.seed(0)
+        return next_gen_EA(*args, **kwargs)
+
+    monkeypatch.setattr(cryspy_ctrl_job, 'next_gen_EA', seeded)
+
+
+def run_ea(**inputs):
+    results, node = run_get_node(
+        EA_WorkChain,
+        max_generations=Int(2),
+        parameters=Dict(PARAMETERS),
+        options=Dict({}),
+        executor=Str('batched'),
+        **inputs,
+    )
+    assert node.is_finished_ok, node.exit_status
+    return results, node
+
+
+def get_next_sg(node):
+    return next(child for child in node.called if child.process_label == 'next_sg_WorkChain')
+
+
+def test_restart_from_generation_gives_the_same_next_generation(sandbox_root, cryspy_in_file, seeded_next_gen):
+    _, first = run_ea(cryspy_in_file=cryspy_in_file)
+    _, restarted = run_ea(restart_from=Int(first.pk), restart_generation=Int(1))
+    assert not [child for child in restarted.called if child.process_label == 'initialize_workchain']
+
+    # the restart works in its own sandbox, seeded from the generation 1 nodes
+    first_uuid = get_next_sg(first).inputs.cryspy_in.run_uuid
+    restarted_uuid = get_next_sg(restarted).inputs.cryspy_in.run_uuid
+    assert restarted_uuid == restarted.uuid != first_uuid
+    with (sandbox.get_sandbox(restarted_uuid) / sandbox.PKL_DIRNAME / 'ea_info.pkl').open('rb') as handle:
+        assert pickle.load(handle)['Gen'].tolist() == [1, 2]
+
+    # the finished relaxations of generation 1 are reused and the next generation is the same
+    optimizations = [child for child in restarted.called if child.process_label == 'multi_structure_optimize_WorkChain']
+    assert not [child for child in optimizations[0].called if child.label.startswith('opt_')]
+    expected, actual = get_next_sg(first).outputs, get_next_sg(restarted).outputs
+    assert actual.id_queueing.get_list() == expected.id_queueing.get_list()
+    assert actual.detail_data.elite_fitness == expected.detail_data.elite_fitness
+    assert actual.detail_data.ea_origin.equals(expected.detail_data.ea_origin)
+    expected_structures = load_structures(expected.next_structures_group_pk.value)
+    actual_structures = load_structures(actual.next_structures_group_pk.value)
+    assert list(actual_structures) == list(expected_structures)
+    origin = expected.detail_data.ea_origin
+    operations = dict(zip(origin['Struc_ID'], origin['Operation']))
+    for cid, struc in expected_structures.items():
+        if operations[cid] == 'random':
+            # PyXtal draws random structures from its own unseeded generator
+            assert actual_structures[cid].composition == struc.composition
+            continue
+        assert [str(sp) for sp in actual_structures[cid].species] == [str(sp) for sp in struc.species]
+        np.testing.assert_allclose(actual_structures[cid].lattice.matrix, struc.lattice.matrix)
+        np.testing.assert_allclose(actual_structures[cid].frac_coords, struc.frac_coords)
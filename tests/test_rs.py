@@ -0,0 +1,89 @@
+"""RS_WorkChain with several chunks optimized at the same time."""
+import io
+import pickle
+
+import numpy as np
+import pytest
+from aiida.engine import run_get_node
+from aiida.orm import Dict, Int, SinglefileData, Str, load_group
+
+pytest.importorskip('aiida_mlip')
+pytest.importorskip('cryspy')
+
+from aiida_cryspy.utils import sandbox, timing  # noqa: E402
+from aiida_cryspy.workflows.RS_WorkChain import RS_WorkChain, chunk_run_uuid  # noqa: E402
+
+PARAMETERS = {
+    'calculator': {'name': 'emt'},
+    'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}, 'setup': {'FrechetCellFilter': True}},
+}
+CRYSPY_IN = '''[basic]
+algo = RS
+calc_code = ASE
+tot_struc = 8
+nstage = 1
+njob = 5
+jobcmd = zsh
+jobfile = job_cryspy
+
+[structure]
+natot = 4
+atype = Cu Al
+nat = 2 2
+mindist_1 = 1.8 1.8
+mindist_2 = 1.8 1.8
+
+[ASE]
+ase_python = ase_in.py
+
+[option]
+'''
+
+
+def load_pickle(run_uuid, name):
+    with (sandbox.get_sandbox(run_uuid) / sandbox.PKL_DIRNAME / f'{name}.pkl').open('rb') as handle:
+        return pickle.load(handle)
+
+
+def test_overlapping_chunks_are_merged(sandbox_root):
+    results, node = run_get_node(
+        RS_WorkChain,
+        cryspy_in_filename=Str('cryspy.in'),
+        cryspy_in_file=SinglefileData(io.BytesIO(CRYSPY_IN.encode()), filename='cryspy.in'),
+        parameters=Dict(PARAMETERS),
+        options=Dict({}),
+        executor=Str('local'),
+        chunk_size=Int(2),
+        max_chunks_in_flight=Int(4),
+    )
+    assert node.is_finished_ok, node.exit_status
+    ids = list(range(8))
+    chunks = sorted((child for child in node.called if child.label.startswith('rs_chunk_')), key=lambda child: child.pk)
+    assert len(chunks) == 4
+
+    # the chunks were optimized at the same time
+    intervals = sorted((timing.process_interval(chunk) for chunk in chunks), key=lambda i: i['start'])
+    assert any(later['start'] < earlier['finish'] for earlier, later in zip(intervals, intervals[1:]))
+
+    # each chunk registered its structures in its own sandbox
+    for n, chunk in enumerate(chunks):
+        run_uuid = chunk.inputs.cryspy_in.run_uuid
+        assert run_uuid == chunk_run_uuid(node.uuid, n)
+        chunk_ids = sorted(chunk.inputs.id_queueing.get_list())
+        assert chunk_ids == ids[2 * n:2 * n + 2]
+        assert sorted(load_pickle(run_uuid, 'rslt_data').index) == chunk_ids
+        assert sorted(load_pickle(run_uuid, 'opt_struc_data')) == chunk_ids
+
+    # and the search merges all of them
+    rslt_data = results['rslt_data'].df
+    assert list(rslt_data.index) == ids
+    assert np.isfinite(rslt_data['E_eV_atom'].astype(float)).all()
+    assert list(load_pickle(node.uuid, 'rslt_data').index) == ids
+    # the optimized structures stay per chunk
+    assert not (sandbox.get_sandbox(node.uuid) / sandbox.PKL_DIRNAME / 'opt_struc_data.pkl').exists()
+    assert results['chunk_run_uuids'].get_list() == [chunk.inputs.cryspy_in.run_uuid for chunk in chunks]
+    snapshots = results['chunk_opt_struc_snapshot']
+    assert sorted(snapshots) == [f'chunk_{n}' for n in range(4)]
+    assert all(snapshots[f'chunk_{n}'].pk == chunk.outputs.opt_struc_snapshot.pk for n, chunk in enumerate(chunks))
+    group = load_group(pk=results['optimized_structures_group_pk'].value)
+    assert sorted(n.base.extras.get('cryspy_id') for n in group.nodes) == ids
@@ -0,0 +1,139 @@
+"""Database locks of CrySPY runs and several searches initialized at the same time."""
+import asyncio
+import pickle
+import time
+import uuid
+
+import pytest
+from aiida.common import exceptions
+from aiida.engine import WorkChain, run_get_node
+from aiida.manage import get_manager
+from aiida.orm import Str, WorkflowNode, load_group
+
+from aiida_cryspy.utils import sandbox
+
+
+class LockingWorkChain(sandbox.SandboxLockMixin, WorkChain):
+    """Changes into the sandbox of run_uuid once"""
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('run_uuid', valid_type=Str)
+        spec.outline(cls.use_sandbox)
+
+    def use_sandbox(self):
+        with sandbox.cryspy_sandbox(self.inputs.run_uuid.value, self.node):
+            self.node.base.extras.set('entered', time.time())
+
+
+def hold_lock(run_uuid, terminated=False):
+    """lock run_uuid for a stored process node that is still running (or terminated)"""
+    holder = WorkflowNode().store()
+    if terminated:
+        holder.set_process_state('finished')
+    assert sandbox.try_acquire_lock(run_uuid, holder)
+    return holder
+
+
+@pytest.fixture
+def run_uuid():
+    return str(uuid.uuid4())
+
+
+def run_all(runner, processes):
+    async def step_all():
+        await asyncio.gather(*(process.step_until_terminated() for process in processes))
+
+    runner.run_until_complete(step_all())
+
+
+def test_lock_is_released(sandbox_root, run_uuid):
+    holder = WorkflowNode().store()
+    assert sandbox.try_acquire_lock(run_uuid, holder)
+    assert sandbox.is_locked(run_uuid)
+    assert sandbox.try_acquire_lock(run_uuid, holder)  # the holder itself, e.g. after a restart from a checkpoint
+    assert not sandbox.try_acquire_lock(run_uuid, WorkflowNode().store())
+    sandbox.release_lock(run_uuid)
+    assert not sandbox.is_locked(run_uuid)
+
+
+def test_lock_of_a_running_holder_is_kept(sandbox_root, run_uuid):
+    hold_lock(run_uuid)
+    assert not sandbox.try_acquire_lock(run_uuid, WorkflowNode().store())
+    assert sandbox.is_locked(run_uuid)
+
+
+@pytest.mark.parametrize('terminated', [True, False])
+def test_lock_of_a_terminated_or_deleted_holder_is_stale(sandbox_root, run_uuid, terminated):
+    holder = hold_lock(run_uuid, terminated=terminated)
+    if not terminated:
+        WorkflowNode.collection.delete(holder.pk)
+    assert not sandbox.is_locked(run_uuid)
+    assert not sandbox.try_acquire_lock(run_uuid, WorkflowNode().store())  # removes the stale lock
+    assert sandbox.try_acquire_lock(run_uuid, WorkflowNode().store())
+
+
+def test_waiting_for_the_lock_does_not_block_the_event_loop(sandbox_root, run_uuid, monkeypatch):
+    monkeypatch.setattr(sandbox, 'LOCK_TIMEOUT', 10.0)
+    (sandbox_root / run_uuid).mkdir(parents=True)
+    hold_lock(run_uuid)
+    loop = get_manager().get_runner().loop
+    released = []
+
+    def release():
+        released.append(time.time())
+        sandbox.release_lock(run_uuid)
+
+    loop.call_later(1.0, release)  # only runs if the waiting step gives control back to the loop
+    _, node = run_get_node(LockingWorkChain, run_uuid=Str(run_uuid))
+    assert node.is_finished_ok
+    assert released and node.base.extras.get('entered') >= released[0]
+    assert not sandbox.is_locked(run_uuid)
+
+
+def test_waiting_for_the_lock_times_out(sandbox_root, run_uuid, monkeypatch):
+    monkeypatch.setattr(sandbox, 'LOCK_TIMEOUT', 0.5)
+    (sandbox_root / run_uuid).mkdir(parents=True)
+    hold_lock(run_uuid)
+    with pytest.raises(sandbox.RunLockedError):
+        run_get_node(LockingWorkChain, run_uuid=Str(run_uuid))
+
+
+def test_concurrent_initializations(sandbox_root, cryspy_in_file):
+    pytest.importorskip('aiida_mlip')
+    pytest.importorskip('cryspy')
+    from aiida_cryspy.workflows.initialize_WorkChain import initialize_workchain
+
+    runner = get_manager().get_runner()
+    cryspy_in_file.store()
+    processes = [
+        runner.instantiate_process(initialize_workchain, cryspy_in_filename=Str('cryspy.in'), cryspy_in_file=cryspy_in_file)
+        for _ in range(4)
+    ]
+    run_all(runner, processes)
+
+    run_uuids = set()
+    for process in processes:
+        assert process.node.is_finished_ok, process.node.exit_status
+        run_uuid = process.node.outputs.cryspy_in.run_uuid
+        run_uuids.add(run_uuid)
+        # every search has its own sandbox with the CrySPY files of its own initial structures
+        path = sandbox.get_sandbox(run_uuid)
+        assert sandbox.is_initialized(run_uuid)
+        with (path / sandbox.PKL_DIRNAME / 'init_struc_data.pkl').open('rb') as handle:
+            init_struc_data = pickle.load(handle)
+        group = load_group(pk=process.node.outputs.initial_structures_group_pk.value)
+        assert sorted(init_struc_data) == sorted(n.base.extras.get('cryspy_id') for n in group.nodes)
+        with pytest.raises(exceptions.NotExistent):
+            load_group(label=f'{sandbox.LOCK_GROUP_PREFIX}{run_uuid}')
+    assert len(run_uuids) == len(processes)
+
+
+def test_processes_of_the_same_run_take_turns(sandbox_root, run_uuid):
+    (sandbox_root / run_uuid).mkdir(parents=True)
+    runner = get_manager().get_runner()
+    processes = [runner.instantiate_process(LockingWorkChain, run_uuid=Str(run_uuid)) for _ in range(4)]
+    run_all(runner, processes)
+    assert all(process.node.is_finished_ok for process in processes)
+    assert not sandbox.is_locked(run_uuid)
@@ -0,0 +1,107 @@
+"""Array-job schedulers: job ids and task states of SGE array jobs, and per-task output files."""
+import subprocess
+
+from aiida.common.datastructures import CodeRunMode
+from aiida.schedulers.datastructures import JobState, JobTemplate, JobTemplateCodeInfo
+
+from aiida_cryspy.schedulers.local_array import LocalArrayScheduler
+from aiida_cryspy.schedulers.sge_array import SgeArrayScheduler, task_output_path
+
+QSTAT_XML = """<?xml version='1.0'?>
+<job_info xmlns:xsd="http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qstat/qstat.xsd">
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>123</JB_job_number>
+      <JB_name>aiida-1</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>r</state>
+      <JAT_start_time>2026-01-01T00:00:00</JAT_start_time>
+      <queue_name>all.q@node1</queue_name>
+      <slots>1</slots>
+      <tasks>1</tasks>
+    </job_list>
+    <job_list state="running">
+      <JB_job_number>123</JB_job_number>
+      <JB_name>aiida-1</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>r</state>
+      <JAT_start_time>2026-01-01T00:00:00</JAT_start_time>
+      <queue_name>all.q@node2</queue_name>
+      <slots>1</slots>
+      <tasks>2</tasks>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>123</JB_job_number>
+      <JB_name>aiida-1</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>qw</state>
+      <JB_submission_time>2026-01-01T00:00:00</JB_submission_time>
+      <slots>1</slots>
+      <tasks>3-4:1</tasks>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>124</JB_job_number>
+      <JB_name>aiida-2</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>qw</state>
+      <JB_submission_time>2026-01-01T00:00:00</JB_submission_time>
+      <slots>1</slots>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+
+def make_job_template(directive):
+    code_info = JobTemplateCodeInfo(cmdline_params=['bash', '-c', 'echo out $SGE_TASK_ID; echo err $SGE_TASK_ID >&2'])
+    job_tmpl = JobTemplate()
+    job_tmpl.job_name = 'array'
+    job_tmpl.sched_output_path = '_scheduler-stdout.txt'
+    job_tmpl.sched_error_path = '_scheduler-stderr.txt'
+    job_tmpl.custom_scheduler_commands = directive
+    job_tmpl.codes_info = [code_info]
+    job_tmpl.codes_run_mode = CodeRunMode.SERIAL
+    return job_tmpl
+
+
+def test_task_output_path():
+    assert task_output_path('_scheduler-stdout.txt', '3') == '_scheduler-stdout.3.txt'
+    assert task_output_path('out', '*') == 'out.*'
+
+
+def test_sge_submit_output_strips_task_range():
+    scheduler = SgeArrayScheduler()
+    assert scheduler._parse_submit_output(0, '123.1-4:1\n', '') == '123'
+    assert scheduler._parse_submit_output(0, '124\n', '') == '124'
+
+
+def test_sge_joblist_merges_tasks():
+    jobs = {job.job_id: job for job in SgeArrayScheduler()._parse_joblist_output(0, QSTAT_XML, '')}
+    assert set(jobs) == {'123', '124'}
+    assert jobs['123'].job_state == JobState.RUNNING
+    assert jobs['123'].num_mpiprocs == 2
+    assert jobs['124'].job_state == JobState.QUEUED
+
+
+def test_sge_per_task_output():
+    job_tmpl = make_job_template('#$ -t 1-4')
+    job_tmpl.job_resource = SgeArrayScheduler.create_job_resource(parallel_env='smp', tot_num_mpiprocs=1)
+    script = SgeArrayScheduler().get_submit_script(job_tmpl)
+    assert '#$ -o _scheduler-stdout.$TASK_ID.txt' in script
+    assert '#$ -e _scheduler-stderr.$TASK_ID.txt' in script
+    assert '#$ -t 1-4' in script
+    # the template is left unchanged
+    assert job_tmpl.sched_output_path == '_scheduler-stdout.txt'
+
+
+def test_local_array_per_task_output(tmp_path):
+    job_tmpl = make_job_template('#$ -t 1-3')
+    job_tmpl.job_resource = LocalArrayScheduler.create_job_resource(num_machines=1, num_mpiprocs_per_machine=2)
+    script = LocalArrayScheduler().get_submit_script(job_tmpl)
+    (tmp_path / 'submit.sh').write_text(script)
+    subprocess.run(['bash', 'submit.sh'], cwd=tmp_path, check=True)
+    for task in (1, 2, 3):
+        assert (tmp_path / f'_scheduler-stdout.{task}.txt').read_text() == f'out {task}\n'
+        assert (tmp_path / f'_scheduler-stderr.{task}.txt').read_text() == f'err {task}\n'
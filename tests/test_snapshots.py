@@ -0,0 +1,110 @@
+"""Snapshots of groups (make_snapshot / load_structures_incremental) against a full load of the group."""
+import numpy as np
+import pytest
+from aiida.orm import Group, StructureData
+from pymatgen.core import Lattice, Structure
+
+from aiida_cryspy.data.structurecollectiondata import StructureCollectionData
+from aiida_cryspy.utils.groups import (
+    load_snapshot,
+    load_structures,
+    load_structures_incremental,
+    make_snapshot,
+    snapshot_id_map,
+    store_structures,
+)
+
+
+def assert_same_structures(actual, expected):
+    assert list(actual) == list(expected)
+    for cid, struc in expected.items():
+        assert actual[cid].site_properties == struc.site_properties
+        assert [str(sp) for sp in actual[cid].species] == [str(sp) for sp in struc.species]
+        np.testing.assert_allclose(actual[cid].lattice.matrix, struc.lattice.matrix)
+        np.testing.assert_allclose(actual[cid].frac_coords, struc.frac_coords, atol=1e-12)
+
+
+def add_kind_named_structure(group, cid):
+    """a structure with custom kind names (Cu1, Cu2), as made by magnetic calculations"""
+    node = StructureData(cell=Lattice.cubic(3.6).matrix.tolist())
+    node.append_atom(position=(0.0, 0.0, 0.0), symbols='Cu', name='Cu1')
+    node.append_atom(position=(1.8, 1.8, 0.0), symbols='Cu', name='Cu2')
+    node.base.extras.set('cryspy_id', cid)
+    node.store()
+    group.add_nodes(node)
+    return node
+
+
+@pytest.fixture
+def group(structures):
+    group = Group(label='test_snapshots').store()
+    store_structures(structures, group)
+    yield group
+    Group.collection.delete(group.pk)
+
+
+def test_snapshot_matches_full_load(group):
+    add_kind_named_structure(group, 10)
+    structures, id_map = load_structures_incremental(group.pk)
+    snapshot = make_snapshot(group.pk, structures, id_map).store()
+
+    assert snapshot.has_kind_names
+    loaded, loaded_map = load_snapshot(snapshot)
+    assert loaded_map == id_map
+    assert_same_structures(loaded, load_structures(group.pk))
+    assert loaded[10].site_properties == {'kind_name': ['Cu1', 'Cu2']}
+    assert loaded[0].site_properties == {}
+
+
+def test_delta_snapshots(group, structures):
+    first, first_map = load_structures_incremental(group.pk)
+    snapshot_1 = make_snapshot(group.pk, first, first_map).store()
+
+    # generation 2: one structure added, one replaced by a newer node
+    new = {11: structures[0], 3: structures[7]}
+    store_structures(new, group)
+    second, second_map = load_structures_incremental(group.pk, snapshot_1)
+    snapshot_2 = make_snapshot(group.pk, second, second_map, previous=snapshot_1).store()
+
+    assert sorted(snapshot_2.ids) == [3, 11]  # only the delta is stored
+    assert snapshot_2.base.attributes.get('previous') == snapshot_1.uuid
+    assert snapshot_2.base.attributes.get('n_structures') == 4
+    assert snapshot_id_map(snapshot_2) == second_map
+    assert_same_structures(load_snapshot(snapshot_2)[0], load_structures(group.pk))
+    assert_same_structures(load_snapshot(snapshot_2, [3])[0], {3: structures[7]})
+
+    # generation 3: nothing changed
+    third, third_map = load_structures_incremental(group.pk, snapshot_2)
+    snapshot_3 = make_snapshot(group.pk, third, third_map, previous=snapshot_2).store()
+    assert len(snapshot_3) == 0
+    assert_same_structures(load_snapshot(snapshot_3)[0], load_structures(group.pk))
+
+
+def test_removed_structures(group, structures):
+    first, first_map = load_structures_incremental(group.pk)
+    snapshot_1 = make_snapshot(group.pk, first, first_map).store()
+    group.remove_nodes([node for node in group.nodes if node.base.extras.get('cryspy_id') == 7])
+
+    second, second_map = load_structures_incremental(group.pk, snapshot_1)
+    snapshot_2 = make_snapshot(group.pk, second, second_map, previous=snapshot_1).store()
+    assert snapshot_2.base.attributes.get('removed') == [7]
+    assert list(load_snapshot(snapshot_2)[0]) == [0, 3]
+
+
+def test_snapshot_of_another_group_is_not_a_delta(group, structures):
+    other = Group(label='test_snapshots_other').store()
+    store_structures({0: structures[0]}, other)
+    other_snapshot = make_snapshot(other.pk, *load_structures_incremental(other.pk)).store()
+
+    structures_, id_map = load_structures_incremental(group.pk, other_snapshot)
+    snapshot = make_snapshot(group.pk, structures_, id_map, previous=other_snapshot)
+    assert 'previous' not in snapshot.base.attributes.keys()
+    assert len(snapshot) == 3
+
+
+def test_kind_names_round_trip():
+    struc = Structure(Lattice.cubic(3.6), ['Cu', 'Cu'], [[0, 0, 0], [0.5, 0.5, 0]],
+                      site_properties={'kind_name': ['Cu1', 'Cu2']})
+    node = StructureCollectionData({5: struc}).store()
+    assert node.get_structure(5).site_properties == {'kind_name': ['Cu1', 'Cu2']}
+    assert node.structurecollection[5].site_properties == {'kind_name': ['Cu1', 'Cu2']}
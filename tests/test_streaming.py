@@ -0,0 +1,73 @@
+"""Streaming registration of multi_structure_optimize_WorkChain with several relaxations running at the same time."""
+import pickle
+
+import numpy as np
+import pytest
+from aiida.engine import run_get_node
+from aiida.orm import Dict, Int, Str, load_group, load_node
+
+pytest.importorskip('aiida_mlip')
+pytest.importorskip('cryspy')
+
+from aiida_cryspy.utils import sandbox, timing  # noqa: E402
+from aiida_cryspy.workflows.optimization_WorkChain import multi_structure_optimize_WorkChain  # noqa: E402
+
+PARAMETERS = {
+    'calculator': {'name': 'emt'},
+    'optimizer': {'name': 'FIRE', 'run_args': {'fmax': 0.05, 'steps': 200}, 'setup': {'FrechetCellFilter': True}},
+}
+
+
+def optimize(run, **inputs):
+    results, node = run_get_node(
+        multi_structure_optimize_WorkChain,
+        initial_structures_group_pk=run['initial_structures_group_pk'],
+        optimized_structures_group_pk=run['optimized_structures_group_pk'],
+        rslt_data=run['rslt_data'],
+        cryspy_in=run['cryspy_in'],
+        detail_data=run['detail_data'],
+        id_queueing=run['id_queueing'],
+        parameters=Dict(PARAMETERS),
+        executor=Str('local'),
+        max_workers=Int(1),
+        **inputs,
+    )
+    assert node.is_finished_ok, node.exit_status
+    return results, node
+
+
+def load_pickle(run, name):
+    path = sandbox.get_sandbox(run['cryspy_in'].run_uuid) / 'data' / 'pkl_data' / f'{name}.pkl'
+    with path.open('rb') as handle:
+        return pickle.load(handle)
+
+
+def test_concurrent_children_are_registered_as_they_finish(initialized_run):
+    results, node = optimize(initialized_run, max_concurrent=Int(4), pack_size=Int(1))
+    ids = sorted(initialized_run['id_queueing'].get_list())
+    children = [child for child in node.called if child.label.startswith('opt_')]
+    assert len(children) == len(ids)
+
+    # every structure is registered once, in rslt_data, the optimized group and the sandbox pickles
+    rslt_data = results['rslt_data'].df
+    assert sorted(rslt_data.index) == ids
+    assert np.isfinite(rslt_data['E_eV_atom'].astype(float)).all()
+    group = load_group(pk=initialized_run['optimized_structures_group_pk'].value)
+    assert sorted(n.base.extras.get('cryspy_id') for n in group.nodes) == ids
+    assert sorted(load_pickle(initialized_run, 'opt_struc_data')) == ids
+    assert sorted(load_pickle(initialized_run, 'rslt_data').index) == ids
+
+    # relaxations overlapped and each structure was registered before the last one finished
+    intervals = sorted((n.base.extras.get(timing.STRUCTURE_TIMING_EXTRA) for n in group.nodes), key=lambda i: i['start'])
+    assert any(later['start'] < earlier['finish'] for earlier, later in zip(intervals, intervals[1:]))
+    assert min(i['registered'] for i in intervals) < max(i['finish'] for i in intervals)
+    for interval in intervals:
+        assert interval['registered'] >= interval['finish']
+
+
+def test_resume_skips_registered_structures(initialized_run):
+    _, first = optimize(initialized_run, pack_size=Int(4))
+    results, node = optimize(initialized_run, pack_size=Int(4), resume_from=Int(first.pk))
+    assert not [child for child in node.called if child.label.startswith('opt_')]
+    assert sorted(results['rslt_data'].df.index) == sorted(initialized_run['id_queueing'].get_list())
+    assert load_node(first.pk).is_finished_ok
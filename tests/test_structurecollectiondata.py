@@ -0,0 +1,65 @@
+"""Round trip of the packed StructureCollectionData format."""
+import numpy as np
+import pytest
+
+from aiida_cryspy.data.structurecollectiondata import StructureCollectionData, pack_structures, unpack_structures
+
+
+def assert_same_structure(actual, expected):
+    assert [str(sp) for sp in actual.species] == [str(sp) for sp in expected.species]
+    np.testing.assert_allclose(actual.lattice.matrix, expected.lattice.matrix)
+    np.testing.assert_allclose(actual.frac_coords, expected.frac_coords)
+
+
+def test_pack_unpack(structures):
+    arrays, species = pack_structures(structures)
+    assert species == ['Al', 'Cu']
+    assert arrays['offsets'].tolist() == [0, 4, 6, 9]
+    unpacked = unpack_structures(arrays, species)
+    assert list(unpacked) == list(structures)
+    for cid, struc in structures.items():
+        assert_same_structure(unpacked[cid], struc)
+
+
+def test_pack_empty():
+    arrays, species = pack_structures({})
+    assert species == []
+    assert unpack_structures(arrays, species) == {}
+
+
+@pytest.mark.parametrize('store', [False, True])
+def test_round_trip(structures, store):
+    node = StructureCollectionData(structures)
+    if store:
+        node.store()
+    assert node.ids == [0, 3, 7]
+    assert len(node) == 3
+    decoded = node.structurecollection
+    for cid, struc in structures.items():
+        assert_same_structure(decoded[cid], struc)
+    assert list(node.get_structurecollection(ids=[7, 0])) == [7, 0]
+
+
+@pytest.mark.parametrize('store', [False, True])
+def test_get_structure(structures, store):
+    node = StructureCollectionData(structures)
+    if store:
+        node.store()
+    for cid, struc in structures.items():
+        assert_same_structure(node.get_structure(cid), struc)
+    with pytest.raises(KeyError):
+        node.get_structure(1)
+
+
+def test_get_array_rows(structures):
+    node = StructureCollectionData(structures).store()
+    np.testing.assert_array_equal(node.get_array_rows('frac_coords', 4, 6), node.get_array('frac_coords')[4:6])
+    np.testing.assert_array_equal(node.get_array_rows('lattices', 2, 3), node.get_array('lattices')[2:3])
+    assert node.get_array_rows('species_indices', 9, 9).shape == (0,)
+
+
+def test_pack_disordered():
+    from pymatgen.core import Lattice, Structure
+    disordered = Structure(Lattice.cubic(3.6), [{'Cu': 0.5, 'Al': 0.5}], [[0, 0, 0]])
+    with pytest.raises(ValueError):
+        pack_structures({0: disordered})
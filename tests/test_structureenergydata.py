@@ -0,0 +1,73 @@
+"""Round trip of StructureEnergyData and top-k access with sorted_by()."""
+import math
+
+import numpy as np
+import pytest
+
+from aiida_cryspy.data.structureenergydata import StructureEnergyData
+
+
+def assert_same_structure(actual, expected):
+    assert [str(sp) for sp in actual.species] == [str(sp) for sp in expected.species]
+    np.testing.assert_allclose(actual.lattice.matrix, expected.lattice.matrix)
+    np.testing.assert_allclose(actual.frac_coords, expected.frac_coords)
+
+
+@pytest.fixture
+def energies():
+    return {0: -14.0, 3: -6.5, 7: -9.0}
+
+
+@pytest.fixture
+def enthalpies():
+    return {0: -3.5, 3: -3.25, 7: float('nan')}
+
+
+@pytest.mark.parametrize('store', [False, True])
+def test_round_trip(structures, energies, enthalpies, store):
+    node = StructureEnergyData(structures, energies, enthalpies)
+    if store:
+        node.store()
+        node = StructureEnergyData.collection.get(pk=node.pk)
+    assert node.ids == [0, 3, 7]
+    assert len(node) == 3
+    assert node.get_values('energy') == energies
+    values = node.get_values('enthalpy')
+    assert values[0] == -3.5 and values[3] == -3.25 and math.isnan(values[7])
+    for cid, volume in node.get_values('volume').items():
+        assert volume == pytest.approx(structures[cid].volume)
+    decoded = node.get_structures()
+    for cid, struc in structures.items():
+        assert_same_structure(decoded[cid], struc)
+    assert list(node.get_structures(ids=[7])) == [7]
+
+
+def test_string_ids(structures, energies, enthalpies):
+    node = StructureEnergyData(
+        {str(cid): struc for cid, struc in structures.items()},
+        {str(cid): value for cid, value in energies.items()},
+        {str(cid): value for cid, value in enthalpies.items()},
+    )
+    assert node.ids == [0, 3, 7]
+
+
+def test_sorted_by(structures, energies, enthalpies):
+    node = StructureEnergyData(structures, energies, enthalpies).store()
+    assert [entry['id'] for entry in node.sorted_by('enthalpy')] == [0, 3, 7]  # NaN last
+    assert [entry['id'] for entry in node.sorted_by('energy', reverse=True)] == [3, 7, 0]
+
+    best = node.sorted_by('enthalpy', k=1)
+    assert len(best) == 1
+    assert best[0]['id'] == 0 and best[0]['energy'] == -14.0 and best[0]['enthalpy'] == -3.5
+    assert_same_structure(best[0]['structure'], structures[0])
+    assert 'structure' not in node.sorted_by('volume', k=2, structures=False)[0]
+
+    with pytest.raises(ValueError):
+        node.sorted_by('magmom')
+
+
+def test_empty():
+    node = StructureEnergyData({}, {}, {}).store()
+    assert len(node) == 0
+    assert node.sorted_by('enthalpy') == []
+    assert node.get_structures() == {}
@@ -0,0 +1,138 @@
+"""Sliding window of child processes (SlidingWindowMixin), including children that finish together."""
+import uuid
+
+import pytest
+from aiida.engine import WorkChain, run_get_node, while_
+from aiida.manage import get_manager
+from aiida.orm import Int, List, QueryBuilder, Str, WorkflowNode, load_node
+
+from aiida_cryspy.utils import sandbox
+from aiida_cryspy.utils.window import SlidingWindowMixin
+
+
+class ChildWorkChain(WorkChain):
+    """finishes in its first step, so the children submitted in one step finish together"""
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('value', valid_type=Int)
+        spec.output('value', valid_type=Int)
+        spec.outline(cls.finish)
+
+    def finish(self):
+        self.out('value', self.inputs.value)
+
+
+class LockedChildWorkChain(sandbox.SandboxLockMixin, ChildWorkChain):
+    """finishes once the sandbox lock of run_uuid is free"""
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('run_uuid', valid_type=Str)
+
+    def finish(self):
+        with sandbox.cryspy_sandbox(self.inputs.run_uuid.value, self.node):
+            pass
+        super().finish()
+
+
+class WindowWorkChain(SlidingWindowMixin, WorkChain):
+    """submits n_children children, at most max_concurrent at a time, and collects their outputs"""
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('n_children', valid_type=Int)
+        spec.input('max_concurrent', valid_type=Int)
+        spec.input('locked_run_uuid', valid_type=Str, required=False, help='the first child waits for this lock')
+        spec.output('values', valid_type=List)
+        spec.output('max_running', valid_type=Int)
+        spec.outline(
+            cls.setup,
+            while_(cls.has_work)(cls.submit_children, cls.process_children),
+            cls.finalize,
+        )
+
+    def setup(self):
+        self.ctx.queue = list(range(self.inputs.n_children.value))
+        self.ctx.in_flight = []
+        self.ctx.collected = []
+        self.ctx.max_running = 0
+
+    def has_work(self):
+        return len(self.ctx.queue) > 0 or len(self.ctx.in_flight) > 0
+
+    def submit_children(self):
+        while self.ctx.queue and len(self.ctx.in_flight) < self.inputs.max_concurrent.value:
+            value = self.ctx.queue.pop(0)
+            if value == 0 and 'locked_run_uuid' in self.inputs:
+                node = self.submit(LockedChildWorkChain, value=Int(value), run_uuid=self.inputs.locked_run_uuid)
+            else:
+                node = self.submit(ChildWorkChain, value=Int(value))
+            self.ctx.in_flight.append(node.pk)
+        self.ctx.max_running = max(self.ctx.max_running, len(self.ctx.in_flight))
+        self.wait_for_next([load_node(pk) for pk in self.ctx.in_flight])
+
+    def process_children(self):
+        self.clear_wait()
+        for pk in list(self.ctx.in_flight):
+            node = load_node(pk)
+            if node.is_terminated:
+                self.ctx.in_flight.remove(pk)
+                self.ctx.collected.append(node.outputs.value.value)
+
+    def finalize(self):
+        self.out('values', List(list=sorted(self.ctx.collected)).store())
+        self.out('max_running', Int(self.ctx.max_running).store())
+
+
+@pytest.mark.parametrize('n_children, max_concurrent', [(2, 2), (7, 3), (5, 1)])
+def test_all_children_processed_once(n_children, max_concurrent):
+    results, node = run_get_node(WindowWorkChain, n_children=Int(n_children), max_concurrent=Int(max_concurrent))
+    assert node.is_finished_ok
+    assert results['values'].get_list() == list(range(n_children))
+    assert results['max_running'].value == max_concurrent
+
+
+def test_children_finishing_together():
+    """two children that finish in the same loop iteration are both processed, neither one twice"""
+    results, node = run_get_node(WindowWorkChain, n_children=Int(2), max_concurrent=Int(2))
+    assert node.is_finished_ok
+    assert results['values'].get_list() == [0, 1]
+    children = node.called
+    assert len(children) == 2
+    assert all(child.is_finished_ok for child in children)
+
+
+def count_finished_children():
+    query = QueryBuilder().append(WorkflowNode, filters={
+        'attributes.process_label': 'ChildWorkChain', 'attributes.process_state': 'finished'})
+    return query.count()
+
+
+def test_window_is_refilled_before_the_oldest_child_finishes(sandbox_root, monkeypatch):
+    """younger children that finish first free their slots while the oldest child is still running"""
+    monkeypatch.setattr(sandbox, 'LOCK_TIMEOUT', 30.0)
+    run_uuid = str(uuid.uuid4())
+    (sandbox_root / run_uuid).mkdir(parents=True)
+    holder = WorkflowNode().store()
+    assert sandbox.try_acquire_lock(run_uuid, holder)
+    loop = get_manager().get_runner().loop
+    n_finished = count_finished_children()
+
+    def release_when_younger_children_finished():
+        # with a window waiting only for the oldest child, the younger ones never finish and the oldest one times out
+        if count_finished_children() < n_finished + 3:
+            loop.call_later(0.2, release_when_younger_children_finished)
+        else:
+            sandbox.release_lock(run_uuid)
+
+    loop.call_later(0.2, release_when_younger_children_finished)
+    results, node = run_get_node(WindowWorkChain, n_children=Int(4), max_concurrent=Int(2), locked_run_uuid=Str(run_uuid))
+    assert node.is_finished_ok
+    assert results['values'].get_list() == list(range(4))
+    oldest = min(node.called, key=lambda child: child.pk)
+    assert oldest.process_label == 'LockedChildWorkChain'
+    assert all(child.ctime < oldest.mtime for child in node.called)